@@ -1,22 +1,21 @@
-#! python3.6
+#! python3.8
 
 import os
 import sys
 from functools import partial
 import logging.handlers
 import atexit
+import shutil
 from pathlib import Path # for schedule
 from textwrap import dedent # schedule
-from time import sleep # schedule
 
 import appdirs
 import click
-import schedule
-import arrow
 
 from screenshotto.__init__ import (APPNAME, VERSION_STRING, CONFIG_PATH,
                                    CONFIG_DIR)
-from screenshotto.log import logger_setup, handle_exception
+from screenshotto.log import (logger_setup, handle_exception, set_log_queue,
+                              set_debug_buffer)
 from screenshotto.clickaliases import ClickAliasedGroup
 
 log_dir = appdirs.user_log_dir(APPNAME, False)
@@ -27,8 +26,10 @@ sys.excepthook = uncaught_exception_handler
 
 log.debug(VERSION_STRING)
 
+# Everything else (config, Pillow, arrow, ...) is imported by the commands
+# that need it, so --help and --version don't pay for it.
 from screenshotto.util import save_screenshot, attach_console
-from screenshotto import config
+from screenshotto import capture
 
 SCHEDFP = Path(CONFIG_DIR) / "schedule.txt"
 
@@ -43,6 +44,9 @@ def set_debug(debug=True):
                 loghandler.flushLevel = logging.DEBUG
             else:
                 conhandler.setLevel(logging.INFO)
+            if loghandler.dropped:
+                log.debug(f"{loghandler.dropped} earlier message(s) didn't "
+                          "fit in the debug buffer")
             # 'send' all log messages that have been queued until this point
             log.debug("Flushing log.")
             loghandler.flush()
@@ -53,6 +57,26 @@ def set_debug(debug=True):
             loghandler.capacity = 1
 
 
+def configure_debug_buffer():
+    """
+    The console's debug buffer exists before the config is loaded, so its
+    limits are applied once it has been.
+    """
+    from screenshotto import config
+    set_debug_buffer(log, config.get_int("debug_buffer_records"),
+                     config.get_int("debug_buffer_bytes"))
+
+
+def configure_log_queue():
+    """
+    Long running commands log a lot, so let the config decide what happens
+    when the disk can't keep up.
+    """
+    from screenshotto import config
+    set_log_queue(log, config.get_int("log_queue_size"),
+                  config.data["log_queue_policy"])
+
+
 def keep_open():
     input("\nPress enter to close...")
 
@@ -64,6 +88,70 @@ def echo(*args, **kwargs):
         pass
 
 
+def parse_when(ctx, param, value):
+    """
+    click callback for date/time options: what was typed -> unix time.
+    """
+    if not value:
+        return None
+    import arrow
+    try:
+        return arrow.get(value, tzinfo="local").timestamp()
+    except ValueError:
+        raise click.BadParameter(f"'{value}' isn't a date/time like "
+                                 "'2018-06-16 09:00'")
+
+
+def parse_monitor(ctx, param, value):
+    """
+    click callback for --monitor: ('1', '3') -> '1,3', checked.
+    Whether the monitors exist is up to check_targets().
+    """
+    if not value:
+        return None
+    from screenshotto.regions import parse_monitors
+    value = ",".join(value)
+    try:
+        parse_monitors(value)
+    except ValueError as exc:
+        raise click.BadParameter(str(exc))
+    return value
+
+
+def parse_region(ctx, param, value):
+    """
+    click callback for --region: a name from the config, 'window', or
+    x,y,width,height.
+    """
+    if not value:
+        return None
+    from screenshotto import config
+    from screenshotto.regions import parse_rect, parse_regions
+    value = value.strip()
+    if value == "window" or value in parse_regions(config.data["regions"]):
+        return value
+    try:
+        parse_rect(value)
+    except ValueError as exc:
+        raise click.BadParameter(f"{exc}, a name from the 'regions' "
+                                 "option, or 'window'")
+    return value
+
+
+def check_targets(monitors, region):
+    """
+    Makes sure --monitor / --region are on the screen, now that we know
+    the backend.
+    """
+    from screenshotto.capture import get_backend
+    from screenshotto.regions import targets
+    try:
+        targets(get_backend())
+    except AssertionError as exc:
+        raise click.BadParameter(
+            str(exc), param_hint="'--region'" if region else "'--monitor'")
+
+
 CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
 
 @click.group(context_settings=CONTEXT_SETTINGS, cls=ClickAliasedGroup,
@@ -74,8 +162,23 @@ CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
               help="Show debug messages")
 @click.option("--version", "-v", is_flag=True,
               help="Print version number")
+@click.option("--backend", "-b", type=click.Choice(sorted(capture.backends)),
+              help="Capture backend to use instead of the one in the config")
+@click.option("--profile", is_flag=True,
+              help="Profile the command and report where the time went")
+@click.option("--profile-sample", is_flag=True,
+              help="Like --profile, but sample every thread's stack and save "
+                   "a flame graph ('folded' format) instead of using cProfile")
+@click.option("--monitor", "-m", "monitors", multiple=True,
+              callback=parse_monitor,
+              help="Only capture this monitor (1, 2, ... or 'all'), "
+                   "to its own file. Can be given more than once.")
+@click.option("--region", "-r", callback=parse_region,
+              help="Only capture this region: x,y,width,height, a name "
+                   "from the config file, or 'window'")
 @click.pass_context
-def cli(ctx, show_window, debug, version):
+def cli(ctx, show_window, debug, version, backend, profile, profile_sample,
+        monitors, region):
     """
     Capture a screenshot of the entire screen (all monitors) and save it.
     \n
@@ -97,8 +200,37 @@ def cli(ctx, show_window, debug, version):
 
     if debug:
         log.debug("Debug mode")
+    if ctx.invoked_subcommand:
+        configure_debug_buffer()
     set_debug(debug) # important to set this either way so log is flushed!
 
+    if profile or profile_sample:
+        from screenshotto.profiling import Profile
+        profiler = Profile("sample" if profile_sample else "cprofile",
+                           log.logfp.parent)
+
+        def report():
+            for line in profiler.stop():
+                echo(line, err=True)
+
+        profiler.start()
+        ctx.call_on_close(report)
+
+    if backend:
+        log.debug(f"Using '{backend}' capture backend")
+        from screenshotto import config
+        config.data["capture_backend"] = backend
+
+    if monitors or region:
+        from screenshotto import config
+        if monitors:
+            log.debug(f"Capturing monitor(s) {monitors}")
+            config.data["monitors"] = monitors
+        if region:
+            log.debug(f"Capturing region '{region}'")
+            config.data["region"] = region
+        check_targets(monitors, region)
+
     if version:
         echo(VERSION_STRING)
     elif not ctx.invoked_subcommand:
@@ -110,13 +242,317 @@ def cli(ctx, show_window, debug, version):
              aliases=["capture", "save", "ss"],
              help="Capture and save a screenshot without user interaction")
 def screenshot():
-    imgfp = save_screenshot()
-    echo(f"\nScreenshot saved to:\n\t{imgfp}")
+    imgfps = save_screenshot()
+    if not imgfps:
+        echo("\nScreen hasn't changed. Screenshot skipped.")
+    else:
+        echo("\nScreenshot saved to:\n\t" + "\n\t".join(map(str, imgfps)))
+
+
+@cli.command(name="burst",
+             help="Capture a number of screenshots at a steady frame rate. "
+                  "Every frame is saved as a numbered image in img_dir: "
+                  "extra outputs, dedup and session storage don't apply.")
+@click.option("--fps", default=5.0, show_default=True,
+              help="Frames per second")
+@click.option("--count", "-n", default=50, show_default=True,
+              help="Number of frames")
+def burst(fps, count):
+    from screenshotto.burst import burst as burst_
+    configure_log_queue()
+    if fps <= 0 or count < 1:
+        raise click.BadParameter("--fps and --count have to be positive")
+    for line in burst_(fps, count):
+        echo(line)
+
+
+@cli.command(name="daemon",
+             help="Stay running and capture whenever 'trigger' asks")
+@click.option("--stop", is_flag=True, help="Stop the running daemon")
+def daemon(stop):
+    from screenshotto import daemon as daemon_
+    if stop:
+        try:
+            daemon_.request("stop")
+        except (OSError, EOFError) as exc:
+            echo(exc)
+        return
+    configure_log_queue()
+    echo(f"Listening on {daemon_.address()}. Ctrl+C to stop.")
+    try:
+        daemon_.serve()
+    except RuntimeError as exc:
+        raise click.ClickException(str(exc))
+
+
+@cli.command(name="trigger",
+             aliases=["t"],
+             help="Ask the running daemon to capture a screenshot")
+@click.option("--no-wait", is_flag=True,
+              help="Return as soon as the screen is grabbed, without "
+                   "waiting for the image to be written")
+def trigger(no_wait):
+    from screenshotto import daemon as daemon_
+    try:
+        reply = daemon_.request("capture", background=no_wait)
+    except (OSError, EOFError) as exc:
+        raise click.ClickException(f"{exc}. Start it with "
+                                   "'screenshotto daemon'.")
+    if not reply["ok"]:
+        raise click.ClickException(reply["error"])
+    if reply["skipped"]:
+        echo("\nScreen hasn't changed. Screenshot skipped.")
+    elif no_wait:
+        echo("\nScreenshot being saved to:\n\t"
+             + "\n\t".join(reply["paths"]))
+    else:
+        echo("\nScreenshot saved to:\n\t" + "\n\t".join(reply["paths"]))
+
+
+@cli.command(name="export",
+             help="Save a screenshot from a session file as a normal image")
+@click.argument("session", type=click.Path(exists=True, dir_okay=False))
+@click.option("--at", "-t", "when", callback=parse_when,
+              help="Date/time of the screenshot, e.g. '2018-06-16 09:00'. "
+                   "The latest screenshot at or before this is used. "
+                   "Defaults to the last one in the session.")
+@click.option("--out", "-o", type=click.Path(dir_okay=False),
+              help="Image file to write. Defaults to the usual filename "
+                   "in img_dir.")
+def export(session, when, out):
+    from datetime import datetime
+    from screenshotto.session import SessionReader
+    from screenshotto.durable import save
+    from screenshotto.util import allocate_fp
+    reader = SessionReader(session)
+    if not len(reader):
+        raise click.ClickException("That session has no screenshots in it.")
+    if when is not None:
+        if when < reader.index["t"][0]:
+            raise click.ClickException("That session has no screenshots "
+                                       "that early.")
+        i = reader.find(when)
+    else:
+        i = len(reader) - 1
+    img, timestamp = reader.frame(i)
+    imgfp = out or allocate_fp(datetime.fromtimestamp(timestamp))
+    imgfp, _ = save(img, imgfp)
+    echo(f"\nScreenshot {i + 1} of {len(reader)} exported to:\n\t{imgfp}")
+
+
+@cli.command(name="compact",
+             help="Recompress saved screenshots to save space")
+@click.option("--profile", "-p", default="small", show_default=True,
+              type=click.Choice(["fastest", "fast", "balanced", "small",
+                                 "custom"]),
+              help="Encoder profile to recompress with")
+@click.option("--format", "-f", "fmt", type=click.Choice(["png", "jpeg", "webp"]),
+              help="Convert images to this format")
+@click.option("--workers", "-w", type=int,
+              help="Number of processes. Defaults to one per core.")
+@click.option("--dir", "-d", "img_dir", type=click.Path(file_okay=False),
+              help="Directory to compact. Defaults to img_dir.")
+def compact(profile, fmt, workers, img_dir):
+    from screenshotto import config
+    from screenshotto.compact import compact as compact_
+    img_dir = img_dir or config.data["img_dir"]
+    stats = compact_(img_dir, profile, fmt, workers)
+    if not stats["files"]:
+        echo(f"Nothing to do. {stats['skipped']} image(s) already compacted.")
+        return
+    saved = stats["before"] - stats["after"]
+    secs = max(stats["seconds"], 1e-9)
+    done = (stats["files"] - stats["failed"] - stats["lossy"]
+            - stats["shared"])
+    echo(f"Compacted {done} image(s), skipped {stats['skipped']}, "
+         f"left {stats['lossy']} lossy one(s) and {stats['shared']} linked "
+         f"from elsewhere alone, {stats['failed']} failed.")
+    echo(f"Saved {saved / 2**20:.1f} MiB "
+         f"({stats['before'] / 2**20:.1f} -> {stats['after'] / 2**20:.1f} MiB) "
+         f"in {secs:.1f}s: {done / secs:.1f} images/s, "
+         f"{stats['before'] / secs / 2**20:.1f} MiB/s")
+
+
+@cli.command(name="reshard",
+             help="Move saved screenshots into the subdirs layout from "
+                  "the config file")
+@click.option("--workers", "-w", type=int, default=16, show_default=True,
+              help="Number of files to move at once")
+@click.option("--dir", "-d", "img_dir", type=click.Path(file_okay=False),
+              help="Directory to reshard. Defaults to img_dir.")
+def reshard(workers, img_dir):
+    from screenshotto import config
+    from screenshotto.reshard import reshard as reshard_
+    img_dir = img_dir or config.data["img_dir"]
+    try:
+        stats = reshard_(img_dir, config.data["subdirs"], workers)
+    except ValueError as exc:
+        raise click.ClickException(str(exc))
+    if not stats["files"]:
+        echo("Nothing to do. Every screenshot is already in the right place.")
+        return
+    secs = max(stats["seconds"], 1e-9)
+    echo(f"Moved {stats['moved']} image(s) into {stats['dirs']} "
+         f"director{'y' if stats['dirs'] == 1 else 'ies'}, "
+         f"{stats['failed']} failed, in {secs:.1f}s "
+         f"({stats['moved'] / secs:.0f} images/s)")
+
+
+@cli.command(name="prune",
+             help="Delete old screenshots according to the retention "
+                  "rules in the config file")
+@click.option("--dry-run", "-n", is_flag=True,
+              help="Only list what would be deleted")
+def prune(dry_run):
+    from screenshotto.retention import Retention
+    manager = Retention()
+    if not manager.enabled:
+        raise click.ClickException("No retention rules are set. Set "
+                                   "keep_for, keep_count, keep_size or "
+                                   "thinning in the config file.")
+    manager.load()
+    if dry_run:
+        doomed = manager.expired()
+        for _, fp, _ in doomed:
+            echo(fp)
+        size = sum(entry[2] for entry in doomed)
+        echo(f"Would delete {len(doomed)} screenshot(s), "
+             f"{size / 2**20:.1f} MiB")
+        return
+    deleted, freed = manager.enforce()
+    echo(f"Deleted {deleted} screenshot(s), {freed / 2**20:.1f} MiB. "
+         f"{manager.count} left, {manager.bytes / 2**20:.1f} MiB.")
+
+
+@cli.command(name="stats",
+             help="Summarise the screenshots taken so far")
+@click.option("--from", "-f", "start", callback=parse_when,
+              help="Only count screenshots from this date/time on")
+@click.option("--to", "-t", "end", callback=parse_when,
+              help="Only count screenshots up to this date/time")
+def stats(start, end):
+    from datetime import datetime
+    from screenshotto import events
+    path = events.event_log_path()
+    if not path.exists():
+        raise click.ClickException(f"No screenshots recorded in '{path}' yet.")
+    result = events.aggregate(events.iter_events(path, start, end))
+    if not result["events"]:
+        echo("No screenshots in that time.")
+        return
+    first = datetime.fromtimestamp(result["first"])
+    last = datetime.fromtimestamp(result["last"])
+    echo(f"{result['events']} screenshots from {first:%Y-%m-%d %H:%M:%S} "
+         f"to {last:%Y-%m-%d %H:%M:%S}")
+    echo(f"{result['saved']} saved, "
+         f"{result['bytes'] / 2**20:.1f} MiB written")
+    echo("Dedup: " + ", ".join(f"{k} {v}" for k, v
+                               in sorted(result["dedup"].items())))
+    echo(result["capture_ms"].summary("capture"))
+    echo(result["encode_ms"].summary("encode"))
+
+
+@cli.command(name="find",
+             help="List saved screenshots from the catalog")
+@click.option("--from", "-f", "start", callback=parse_when,
+              help="Only screenshots from this date/time on")
+@click.option("--to", "-t", "end", callback=parse_when,
+              help="Only screenshots up to this date/time")
+@click.option("--latest", "-n", type=int,
+              help="Only the last this many. Defaults to 10 without "
+                   "--from or --to.")
+@click.option("--target", help="Only this monitor (e.g. 'm1') or region")
+@click.option("--output", "-o",
+              help="Copies for this extra output instead ('all' for "
+                   "every copy)")
+@click.option("--details", "-l", is_flag=True,
+              help="Show the size, dimensions and hash too")
+def find(start, end, latest, target, output, details):
+    from datetime import datetime
+    from screenshotto import catalog
+    if start is None and end is None and not latest:
+        latest = 10
+    rows = catalog.find(start, end, latest, target,
+                        "*" if output == "all" else output)
+    if not rows:
+        raise click.ClickException("No screenshots found. If they were "
+                                   "taken before the catalog was turned "
+                                   "on, run 'screenshotto reindex'.")
+    for row in rows:
+        line = (f"{datetime.fromtimestamp(row['t']):%Y-%m-%d %H:%M:%S}  "
+                f"{row['path']}")
+        if details:
+            line += (f"  {row['w']}x{row['h']}  {row['bytes']}  "
+                     f"{row['target'] or '-'}  {row['profile'] or '-'}  "
+                     f"{row['hash'] or '-'}")
+        echo(line)
+
+
+@cli.command(name="reindex",
+             help="Rebuild the catalog from the screenshots on disk")
+@click.option("--workers", "-w", type=int, default=16, show_default=True,
+              help="Number of files to read at once")
+@click.option("--dir", "-d", "img_dir", type=click.Path(file_okay=False),
+              help="Directory to catalogue. Defaults to img_dir and every "
+                   "extra output's dir.")
+def reindex(workers, img_dir):
+    from screenshotto.catalog import reindex as reindex_
+    stats = reindex_([img_dir] if img_dir else None, workers)
+    secs = max(stats["seconds"], 1e-9)
+    echo(f"Catalogued {stats['files']} image(s), {stats['failed']} "
+         f"unreadable, {stats['removed']} gone, in {secs:.1f}s "
+         f"({stats['files'] / secs:.0f} images/s)")
+
+
+@cli.command(name="benchmark",
+             aliases=["bench"],
+             help="Measure capture and save speed without touching img_dir")
+@click.option("--count", "-n", default=20, show_default=True,
+              type=click.IntRange(min=1),
+              help="Number of frames to capture")
+@click.option("--format", "-f", "ext", default=".png", show_default=True,
+              help="File extension to save as")
+@click.option("--profiles", is_flag=True,
+              help="Compare encode time and size of every encoder profile "
+                   "instead")
+@click.option("--startup", is_flag=True,
+              help="Measure how long the command line takes to start instead")
+@click.option("--loggers", is_flag=True,
+              help="Show that getting a logger costs the same however deep "
+                   "the call stack is instead")
+@click.option("--stream", is_flag=True,
+              help="Save PNGs with the streaming encoder instead of Pillow")
+@click.option("--budget", type=float,
+              help="With --startup, fail if startup takes longer than this "
+                   "many milliseconds")
+def benchmark(count, ext, profiles, startup, loggers, stream, budget):
+    from screenshotto import bench
+    if loggers:
+        for line in bench.logger_benchmark():
+            echo(line)
+        return
+    if startup:
+        report, wall_ms, _ = bench.startup_benchmark(os.path.abspath(__file__))
+        for line in report:
+            echo(line)
+        if budget and wall_ms > budget:
+            raise click.ClickException(f"Startup took {wall_ms:.1f} ms. "
+                                       f"The budget is {budget:g} ms.")
+        return
+    if profiles:
+        report = bench.profile_benchmark()
+    else:
+        if stream and ext.lower() != ".png":
+            raise click.BadParameter("--stream only works with .png")
+        report = bench.capture_benchmark(count, ext=ext, stream=stream)
+    for line in report:
+        echo(line)
 
 
 @cli.command(name="config", help="Open config file")
 def open_config_for_edit():
     # default config is generated automatically when config.py is imported
+    from screenshotto import config
     #os.startfile(CONFIG_PATH, "edit")
     click.edit(filename=CONFIG_PATH)
 
@@ -139,7 +575,9 @@ def write_default_schedule():
     # Uncomment one or more of the example lines below, or add your own here:
 
 
-    ## https://schedule.readthedocs.io/en/stable/
+    ## Same syntax as https://schedule.readthedocs.io/en/stable/
+    ## but fractions of a second work too
+    #schedule.every(0.5).seconds.do(job)
     #schedule.every().second.do(job)
     #schedule.every(10).seconds.do(job)
     #schedule.every(30).to(60).seconds.do(job)
@@ -186,43 +624,53 @@ def schedule_run(ctx):
     if not os.path.isfile(SCHEDFP):
         echo("You don't have a schedule set up!\n")
         ctx.invoke(schedule_edit)
-    template = dedent("""
-        def job():
-            termw, _ = click.get_terminal_size()
-            print("\\r" + " ".ljust(termw), end="")
-            click.get_current_context().invoke(screenshot)
-            print()
-
-
-        {usercode}
-
-        termw, _ = click.get_terminal_size()
-        while True:
-            nextrun = schedule.next_run()
-            if not nextrun:
-                log.debug("Schedule has no jobs defined")
-                cmdpath = ctx.command_path.split()
-                cmdpath[-1] = "edit"
-                cmdpath = " ".join(cmdpath)
-                echo("Schedule has no jobs defined! "
-                           "Maybe try '" + cmdpath + "'")
-                break
-            nextrun = arrow.get(schedule.next_run(), "local")
-            timestr = nextrun.humanize()
-            timestr = timestr.replace("just now", "imminently")
-            if timestr == "in seconds":
-                secs = (nextrun - arrow.now()).total_seconds()
-                timestr = "in " + str(int(secs)) + " seconds"
-            print(("\\r" + "Next screenshot will be captured "
-                  + timestr + "...").ljust(termw),
-                  end="")
-            schedule.run_pending()
-            sleep(1)
-        """)
+    from datetime import date
+    from screenshotto.scheduler import Scheduler, parse_schedule, ScheduleError
     with open(SCHEDFP, "r") as f:
-        code = template.format(usercode=f.read())
-    #print(code)
-    exec(code)
+        try:
+            jobs = parse_schedule(f.read())
+        except ScheduleError as exc:
+            raise click.ClickException(str(exc))
+    if not jobs:
+        log.debug("Schedule has no jobs defined")
+        cmdpath = ctx.command_path.split()
+        cmdpath[-1] = "edit"
+        echo("Schedule has no jobs defined! "
+             f"Maybe try '{' '.join(cmdpath)}'")
+        return
+
+    termw, _ = shutil.get_terminal_size()
+
+    def job(_):
+        print("\r" + " ".ljust(termw), end="")
+        imgfps = save_screenshot(background=True)
+        if not imgfps:
+            echo("\nScreen hasn't changed. Screenshot skipped.")
+        else:
+            echo("\nScreenshot saving to:\n\t"
+                 + "\n\t".join(map(str, imgfps)))
+        print()
+
+    def waiting(nextrun):
+        timestr = nextrun.strftime("%H:%M:%S")
+        if nextrun.date() != date.today():
+            timestr = nextrun.strftime("%a %d %B %H:%M:%S")
+        print(("\rNext screenshot will be captured at "
+               + timestr + "...").ljust(termw), end="")
+
+    configure_log_queue()
+    from screenshotto import retention
+    retention.start()
+    scheduler = Scheduler(jobs, job)
+    try:
+        scheduler.run(on_wait=waiting)
+    except KeyboardInterrupt:
+        print()
+    finally:
+        report = scheduler.report()
+        log.debug("\n".join(["Schedule stats:"] + report))
+        for line in report:
+            echo(line)
 
 
 
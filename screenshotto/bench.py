@@ -0,0 +1,306 @@
+"""
+Benchmarks for the capture -> encode -> save path.
+Images are written to a temporary directory, never to img_dir.
+"""
+import os
+import tempfile
+from pathlib import Path
+from time import perf_counter
+
+from .log import get_logger
+
+log = get_logger(__name__)
+
+
+def percentile(values, pct):
+    """
+    Nearest-rank percentile of 'values'. pct is 0-100.
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(int(round(pct / 100 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+class Histogram:
+    """
+    Approximate percentiles of any number of values (e.g. milliseconds) in
+    constant memory. Buckets are about 2% wide.
+    """
+    growth = 1.02
+
+    def __init__(self):
+        import math
+        self._log = math.log
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+
+    def add(self, value):
+        value = max(value, 0.0)
+        key = int(self._log(value + 1) / self._log(self.growth))
+        self.buckets[key] = self.buckets.get(key, 0) + 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+
+    def percentile(self, pct):
+        if not self.count:
+            return 0.0
+        rank = pct / 100 * self.count
+        seen = 0
+        for key in sorted(self.buckets):
+            seen += self.buckets[key]
+            if seen >= rank:
+                # middle of the bucket
+                return min(self.growth ** (key + 0.5) - 1, self.max)
+        return self.max
+
+
+    def summary(self, name):
+        return (f"{name:<10} mean {self.mean:8.2f} ms   "
+                f"p50 {self.percentile(50):8.2f}   "
+                f"p95 {self.percentile(95):8.2f}   "
+                f"p99 {self.percentile(99):8.2f}   "
+                f"max {self.max:8.2f}")
+
+
+def summarise(name, times):
+    """
+    One line of stats for a list of durations in seconds.
+    """
+    if not times:
+        return f"{name:<10} -"
+    ms = [t * 1000 for t in times]
+    return (f"{name:<10} mean {sum(ms) / len(ms):8.2f} ms   "
+            f"p50 {percentile(ms, 50):8.2f}   "
+            f"p95 {percentile(ms, 95):8.2f}   "
+            f"p99 {percentile(ms, 99):8.2f}")
+
+
+def peak_rss(children=False):
+    """
+    Most memory this process has had resident so far, in bytes.
+    With children=True, the most any finished child process had instead.
+    0 if we can't tell.
+    """
+    import sys
+
+    if sys.platform == "win32":
+        if children:
+            return 0
+        import ctypes
+        from ctypes import wintypes
+
+        class Counters(ctypes.Structure):
+            _fields_ = [("cb", wintypes.DWORD),
+                        ("PageFaultCount", wintypes.DWORD),
+                        ("PeakWorkingSetSize", ctypes.c_size_t),
+                        ("WorkingSetSize", ctypes.c_size_t),
+                        ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                        ("PagefileUsage", ctypes.c_size_t),
+                        ("PeakPagefileUsage", ctypes.c_size_t)]
+
+        counters = Counters()
+        counters.cb = ctypes.sizeof(counters)
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        if not ctypes.windll.psapi.GetProcessMemoryInfo(
+                process, ctypes.byref(counters), counters.cb):
+            return 0
+        return counters.PeakWorkingSetSize
+    import resource
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    peak = resource.getrusage(who).ru_maxrss
+    # kilobytes on linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def capture_benchmark(count=20, backend=None, ext=".png", stream=False):
+    """
+    Captures 'count' frames with the given (or configured) backend and
+    saves each one, with Pillow or (stream=True) the streaming PNG encoder.
+    Returns a list of report lines.
+    """
+    from .capture import get_backend
+    from .encoders import stream_rows
+    from .pngstream import encode_image
+
+    grabber = get_backend(backend)
+    rows = stream_rows() or 64
+    grab_times = []
+    save_times = []
+    total_bytes = 0
+    pixels = 0
+    rss_before = peak_rss()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        start = perf_counter()
+        for i in range(count):
+            t0 = perf_counter()
+            img = grabber.grab()
+            t1 = perf_counter()
+            fp = Path(tmpdir) / f"{i}{ext}"
+            if stream:
+                with open(fp, "wb") as f:
+                    encode_image(img, f, rows)
+            else:
+                img.save(fp)
+            t2 = perf_counter()
+            grab_times.append(t1 - t0)
+            save_times.append(t2 - t1)
+            total_bytes += os.path.getsize(fp)
+            pixels = img.size[0] * img.size[1]
+        elapsed = perf_counter() - start
+
+    rss = peak_rss()
+    encoder = f"the streaming encoder, {rows} rows at a time" if stream \
+              else "Pillow"
+    report = [
+        f"Backend '{grabber.name}', {count} frames of "
+        f"{pixels / 1e6:.1f} megapixels, saved as {ext} by {encoder}",
+        summarise("capture", grab_times),
+        summarise("save", save_times),
+        f"Throughput {count / elapsed:.2f} frames/s, "
+        f"{count * pixels / elapsed / 1e6:.1f} megapixels/s, "
+        f"{total_bytes / count / 1024:.0f} KiB per frame",
+        f"Peak memory {rss / 2**20:.1f} MiB "
+        f"({(rss - rss_before) / 2**20:.1f} MiB more than before capturing)",
+    ]
+    for line in report:
+        log.debug(line)
+    return report
+
+
+def profile_benchmark(count=3, backend=None, formats=("png", "webp", "jpeg")):
+    """
+    Encodes one sample frame with every encoder profile in every format.
+    Returns a list of report lines.
+    """
+    from io import BytesIO
+    from .capture import get_backend
+    from .encoders import PROFILE_NAMES, encode
+
+    img = get_backend(backend).grab()
+    report = [f"Sample frame {img.size[0]}x{img.size[1]}, "
+              f"best of {count} encodes",
+              f"{'profile':<10} {'format':<6} {'ms':>9} {'KiB':>9} "
+              f"{'MB/s':>8}"]
+    raw_bytes = img.size[0] * img.size[1] * 3
+    for fmt in formats:
+        for profile in PROFILE_NAMES:
+            times = []
+            for _ in range(count):
+                buf = BytesIO()
+                t0 = perf_counter()
+                encode(img, buf, profile, fmt.upper())
+                times.append(perf_counter() - t0)
+            best = min(times)
+            report.append(f"{profile:<10} {fmt:<6} {best * 1000:9.1f} "
+                          f"{buf.tell() / 1024:9.0f} "
+                          f"{raw_bytes / best / 1e6:8.1f}")
+    for line in report:
+        log.debug(line)
+    return report
+
+
+def parse_importtime(stderr):
+    """
+    Parses the output of python -X importtime.
+    Returns [(cumulative microseconds, module name)] for top level imports.
+    """
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        try:
+            _, cumulative, name = line[len("import time:"):].split("|")
+            cumulative = int(cumulative)
+        except ValueError:
+            # the header line
+            continue
+        # nested imports are indented under whatever imported them
+        if not name[1:].startswith(" "):
+            imports.append((cumulative, name.strip()))
+    return imports
+
+
+def startup_benchmark(script, args=("--version",), runs=10):
+    """
+    Times how long 'python script *args' takes from start to exit, and
+    where its import time goes.
+    Returns (report lines, best wall time in ms, import time in ms).
+    """
+    import subprocess
+    import sys
+
+    cmd = [sys.executable, str(script)] + list(args)
+    walls = []
+    for _ in range(runs):
+        t0 = perf_counter()
+        subprocess.run(cmd, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL, check=True)
+        walls.append(perf_counter() - t0)
+    result = subprocess.run([sys.executable, "-X", "importtime"] + cmd[1:],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                            universal_newlines=True, check=True)
+    imports = sorted(parse_importtime(result.stderr), reverse=True)
+    import_ms = sum(us for us, _ in imports) / 1000
+    wall_ms = min(walls) * 1000
+
+    report = [f"'{' '.join(cmd[1:])}'",
+              f"Startup {wall_ms:.1f} ms (best of {runs}), "
+              f"of which imports {import_ms:.1f} ms",
+              "Slowest top level imports:"]
+    report += [f"    {us / 1000:8.2f} ms  {name}" for us, name in imports[:10]]
+    for line in report:
+        log.debug(line)
+    return report, wall_ms, import_ms
+
+
+def _at_depth(depth, func):
+    if depth <= 1:
+        return func()
+    return _at_depth(depth - 1, func)
+
+
+def logger_benchmark(depths=(1, 10, 100, 500), calls=2000):
+    """
+    Times get_logger() called from different stack depths, next to
+    inspect.stack() (which is what logger naming used to cost).
+    Returns a list of report lines.
+    """
+    import inspect
+    from .log import get_logger
+
+    def loggers():
+        for i in range(calls):
+            get_logger("screenshotto.bench")
+
+    def stacks():
+        for i in range(calls // 100 or 1):
+            inspect.stack()
+
+    report = [f"{'depth':>6} {'get_logger':>14} {'inspect.stack':>16}"]
+    for depth in depths:
+        t0 = perf_counter()
+        _at_depth(depth, loggers)
+        per_logger = (perf_counter() - t0) / calls
+        t0 = perf_counter()
+        _at_depth(depth, stacks)
+        per_stack = (perf_counter() - t0) / (calls // 100 or 1)
+        report.append(f"{depth:>6} {per_logger * 1e6:11.3f} us "
+                      f"{per_stack * 1e6:13.1f} us")
+    for line in report:
+        log.debug(line)
+    return report
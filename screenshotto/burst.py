@@ -0,0 +1,108 @@
+"""
+Capture a fixed number of frames at a steady frame rate.
+Frames are grabbed on deadlines measured from the start of the burst, so
+a slow frame doesn't push every later one back. If we fall more than a
+whole frame behind, that frame is dropped rather than bunching up.
+Encoding happens on the encoder pipeline's threads.
+Every frame is saved whole, as its own numbered image: unlike a normal
+screenshot, bursts don't go to the extra outputs and ignore the dedup
+and storage options.
+"""
+from time import monotonic, perf_counter, sleep
+
+from .log import get_logger
+
+log = get_logger(__name__)
+
+
+def burst_fp(imgfp, n):
+    """
+    Burst frames are numbered so frames captured in the same
+    second (or minute) don't overwrite each other.
+    """
+    return imgfp.with_name(f"{imgfp.stem} {n:05d}{imgfp.suffix}")
+
+
+def burst(fps, count):
+    """
+    Captures 'count' frames at 'fps' frames per second.
+    Returns a list of report lines.
+    """
+    from datetime import datetime
+    from .bench import peak_rss, summarise
+    from .capture import get_backend
+    from .events import new_event
+    from .pipeline import new_pipeline
+    from . import profiling
+    from .regions import targets
+    from .shmring import ProcessPipeline
+    from .util import allocate_fp, capture_seq, image_fp, target_fp
+
+    profiling.configure()
+    grabber = get_backend()
+    # the monitors / region to grab every frame
+    areas = targets(grabber)
+    pipeline = new_pipeline()
+    period = 1 / fps
+    grab_times = []
+    lateness = []
+    captured = 0
+    missed = 0
+    first_fp = None
+
+    start = monotonic()
+    for n in range(count):
+        deadline = start + n * period
+        now = monotonic()
+        if now > deadline + period:
+            missed += 1
+            continue
+        if now < deadline:
+            sleep(deadline - now)
+        lateness.append(max(monotonic() - deadline, 0.0))
+        seq = capture_seq(datetime.now())
+        for label, rect in areas:
+            t0 = perf_counter()
+            with profiling.span("capture"):
+                if rect is None:
+                    img = grabber.grab()
+                else:
+                    img = grabber.grab_region(rect)
+            grab_times.append(perf_counter() - t0)
+            event = new_event(img, grab_times[-1], grabber)
+            event["dedup"] = "off"
+            if label:
+                event["target"] = label
+                event["rect"] = list(rect)
+            imgfp = allocate_fp(
+                datetime.now(),
+                lambda dt, seq: burst_fp(target_fp(image_fp(dt, seq), label),
+                                         n),
+                seq=seq)
+            first_fp = first_fp or imgfp
+            pipeline.submit(img, imgfp, event)
+        captured += 1
+    capture_secs = monotonic() - start
+    pipeline.close()
+    total_secs = monotonic() - start
+
+    report = [
+        f"Burst of {count} frames at {fps:g} fps, starting with "
+        f"'{first_fp}'",
+        f"Captured {captured}, missed {missed} (capture too slow), "
+        f"dropped {pipeline.dropped} (encoders too slow), "
+        f"{pipeline.failed} failed to save",
+        f"Achieved {captured / capture_secs:.2f} fps captured, "
+        f"{pipeline.saved / len(areas) / total_secs:.2f} fps saved "
+        f"(done {total_secs - capture_secs:.2f}s after the last capture)",
+        summarise("late", lateness),
+        summarise("capture", grab_times),
+        summarise("encode", list(pipeline.encode_times)),
+        f"Peak memory {peak_rss() / 2**20:.1f} MiB",
+    ]
+    if isinstance(pipeline, ProcessPipeline):
+        report[-1] += (f", {peak_rss(children=True) / 2**20:.1f} MiB "
+                       "in an encoder process")
+    for line in report:
+        log.debug(line)
+    return report
@@ -0,0 +1,279 @@
+"""
+Capture backends.
+A backend grabs the screen and hands back a PIL image of the whole
+virtual desktop. Which one gets used comes from the 'capture_backend'
+config option, or --backend on the command line.
+"""
+import os
+from pathlib import Path
+
+from .log import get_logger
+
+log = get_logger(__name__)
+
+backends = {}
+_instances = {}
+
+
+def register(name):
+    """
+    Class decorator. Makes a backend available under 'name'.
+    """
+    def decorator(cls):
+        cls.name = name
+        backends[name] = cls
+        return cls
+    return decorator
+
+
+def get_backend(name=None):
+    """
+    Returns the (cached) backend instance called 'name',
+    or the one from the config file if name is None.
+    Backends are only started once per process so they stay warm.
+    """
+    from . import config
+
+    name = name or config.data["capture_backend"]
+    if name not in _instances:
+        try:
+            cls = backends[name]
+        except KeyError:
+            raise ValueError(f"Unknown capture backend '{name}'. "
+                             f"Choose from: {', '.join(sorted(backends))}")
+        log.debug(f"Starting '{name}' capture backend")
+        _instances[name] = cls()
+    return _instances[name]
+
+
+def parse_size(s):
+    """
+    '1920x1080' -> (1920, 1080)
+    """
+    w, h = s.lower().split("x")
+    return int(w), int(h)
+
+
+
+class CaptureBackend:
+    name = None
+
+    def grab(self):
+        """
+        Returns a PIL image of the entire virtual desktop.
+        """
+        raise NotImplementedError
+
+
+    def grab_region(self, rect):
+        """
+        Returns a PIL image of just the (left, top, right, bottom) 'rect',
+        in the same coordinates as monitors().
+        Backends that can grab part of the screen should, so the cost
+        depends on the size of 'rect' rather than the whole desktop.
+        """
+        return self.grab().crop(rect)
+
+
+    def monitors(self):
+        """
+        Returns a list of (left, top, right, bottom) rects, one per monitor,
+        relative to the top left of the image returned by grab().
+        Every backend has to say, from what it knows about the screen
+        rather than by grabbing it: this is called to check --monitor and
+        --region and for every event, so it must be cheap.
+        """
+        raise NotImplementedError
+
+
+    def close(self):
+        pass
+
+
+
+@register("desktopmagic")
+class DesktopmagicBackend(CaptureBackend):
+    def __init__(self):
+        from desktopmagic import screengrab_win32
+        self._sg = screengrab_win32
+
+
+    def grab(self):
+        return self._sg.getScreenAsImage()
+
+
+    def grab_region(self, rect):
+        left, top = self._origin()
+        l, t, r, b = rect
+        return self._sg.getRectAsImage((l + left, t + top, r + left, b + top))
+
+
+    def _origin(self):
+        # desktopmagic gives us rects in virtual screen coordinates,
+        # where the primary monitor's top left is 0,0
+        rects = list(self._sg.getDisplayRects())
+        return min(r[0] for r in rects), min(r[1] for r in rects)
+
+
+    def monitors(self):
+        left, top = self._origin()
+        return [(l - left, t - top, r - left, b - top)
+                for l, t, r, b in self._sg.getDisplayRects()]
+
+
+
+@register("synthetic")
+class SyntheticBackend(CaptureBackend):
+    """
+    Generates deterministic fake frames in memory.
+    Each monitor is a flat background with a band of noise whose height is
+    'entropy' * the monitor height. The band moves down a little each frame
+    so consecutive frames differ like a real (if boring) desktop would.
+    With the same seed you always get the same sequence of frames.
+    """
+    def __init__(self, size=None, monitors=None, entropy=None, seed=None):
+        from . import config
+
+        self.size = parse_size(size or config.data["synthetic_size"])
+        if monitors is None:
+            monitors = config.get_int("synthetic_monitors")
+        if entropy is None:
+            entropy = config.get_float("synthetic_entropy")
+        if seed is None:
+            seed = config.get_int("synthetic_seed")
+        self.num_monitors = max(1, monitors)
+        self.entropy = min(max(entropy, 0.0), 1.0)
+        self.seed = seed
+        self.frame = 0
+        log.debug(f"Synthetic frames: {self.num_monitors} x "
+                  f"{self.size[0]}x{self.size[1]}, entropy {self.entropy}")
+
+
+    def monitors(self):
+        w, h = self.size
+        return [(i * w, 0, (i + 1) * w, h) for i in range(self.num_monitors)]
+
+
+    def grab(self):
+        w, h = self.size
+        return self.grab_region((0, 0, w * self.num_monitors, h))
+
+
+    def grab_region(self, rect):
+        import random
+        from PIL import Image
+
+        w, h = self.size
+        l, t, r, b = rect
+        img = Image.new("RGB", (r - l, b - t))
+        band = round(h * self.entropy)
+        for i, (left, top, right, bottom) in enumerate(self.monitors()):
+            # only draw the monitors that are in 'rect'
+            if right <= l or left >= r or bottom <= t or top >= b:
+                continue
+            shade = (self.seed + i * 40) % 200 + 30
+            img.paste((shade, shade, shade),
+                      (left - l, top - t, right - l, bottom - t))
+            if band:
+                rng = random.Random((self.seed * 1000003 + self.frame) * 31
+                                    + i)
+                nbytes = w * band * 3
+                noise = rng.getrandbits(nbytes * 8).to_bytes(nbytes, "little")
+                noise = Image.frombytes("RGB", (w, band), noise)
+                y = (self.frame * max(band // 4, 1)) % (h - band + 1)
+                img.paste(noise, (left - l, top + y - t))
+        self.frame += 1
+        return img
+
+
+
+@register("framebuffer")
+class FramebufferBackend(CaptureBackend):
+    """
+    Reads raw pixels from a linux framebuffer device such as /dev/fb0.
+    Geometry comes from sysfs.
+    """
+    rawmodes = {32: "BGRX", 24: "BGR", 16: "BGR;16"}
+
+    def __init__(self, device=None):
+        from . import config
+
+        self.device = device or config.data["framebuffer"]
+        sysfs = Path("/sys/class/graphics") / os.path.basename(self.device)
+        size = (sysfs / "virtual_size").read_text().strip()
+        self.size = tuple(int(x) for x in size.split(","))
+        self.bpp = int((sysfs / "bits_per_pixel").read_text())
+        try:
+            self.stride = int((sysfs / "stride").read_text())
+        except OSError:
+            self.stride = self.size[0] * self.bpp // 8
+        assert self.bpp in self.rawmodes, \
+               f"Unsupported framebuffer depth: {self.bpp} bits per pixel"
+        log.debug(f"Framebuffer {self.device}: "
+                  f"{self.size[0]}x{self.size[1]} @ {self.bpp}bpp")
+
+
+    def grab(self):
+        return self.grab_region((0, 0) + self.size)
+
+
+    def grab_region(self, rect):
+        from PIL import Image
+
+        l, t, r, b = rect
+        # only read the rows we need, then crop the columns
+        with open(self.device, "rb") as f:
+            f.seek(t * self.stride)
+            data = f.read(self.stride * (b - t))
+        img = Image.frombuffer("RGB", (self.size[0], b - t), data, "raw",
+                               self.rawmodes[self.bpp], self.stride, 1)
+        if (l, r) != (0, self.size[0]):
+            img = img.crop((l, 0, r, b - t))
+        return img
+
+
+    def monitors(self):
+        return [(0, 0) + self.size]
+
+
+
+@register("replay")
+class ReplayBackend(CaptureBackend):
+    """
+    Cycles through an image file, or every image in a directory.
+    Everything is decoded up front so only the 'capture' gets measured.
+    """
+    extensions = {".png", ".jpg", ".jpeg", ".bmp", ".gif", ".tif", ".tiff",
+                  ".webp", ".ppm"}
+
+    def __init__(self, path=None):
+        from PIL import Image
+        from . import config
+
+        path = path or config.data["replay_path"]
+        assert path, "Set replay_path in the config file to use the " \
+                     "'replay' backend"
+        path = Path(path)
+        assert path.exists(), f"replay_path '{path}' does not exist"
+        if path.is_dir():
+            files = sorted(f for f in path.iterdir()
+                           if f.suffix.lower() in self.extensions)
+        else:
+            files = [path]
+        assert files, f"No images to replay in '{path}'"
+        self.frames = []
+        for fp in files:
+            with Image.open(fp) as img:
+                self.frames.append(img.convert("RGB"))
+        self.frame = 0
+        log.debug(f"Replaying {len(self.frames)} image(s) from '{path}'")
+
+
+    def grab(self):
+        img = self.frames[self.frame % len(self.frames)]
+        self.frame += 1
+        return img.copy()
+
+
+    def monitors(self):
+        return [(0, 0) + self.frames[self.frame % len(self.frames)].size]
@@ -0,0 +1,452 @@
+"""
+Catalog of every saved screenshot in an SQLite database, so finding the
+ones from a point in time is an index lookup rather than a walk over
+img_dir. One row per image file:
+    t        unix time of the capture
+    path     where it is
+    bytes    size of the file
+    w, h     size of the image
+    target   which monitor ('m1', ...) or region, NULL for the whole desktop
+    output   which extra output it's a copy for, NULL for the main one
+    profile  encoder profile it was saved with, NULL if we don't know
+    hash     blake2b of the file (hard linked duplicates share one)
+Rows come from the events recorded for each capture (session files have
+their own index, so they're left out). They're written by a background
+thread in batches, one transaction each, and it does the hashing too, so
+capture never waits on the database.
+'screenshotto reindex' rebuilds the rows for a directory from the files
+in it, on a pool of threads.
+"""
+import atexit
+import hashlib
+import os
+import queue
+import re
+import sqlite3
+import threading
+from pathlib import Path
+from time import perf_counter
+
+from .log import get_logger
+
+log = get_logger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS captures (
+    id INTEGER PRIMARY KEY,
+    t REAL NOT NULL,
+    path TEXT NOT NULL UNIQUE,
+    bytes INTEGER,
+    w INTEGER,
+    h INTEGER,
+    target TEXT,
+    output TEXT,
+    profile TEXT,
+    hash TEXT
+);
+CREATE INDEX IF NOT EXISTS captures_t ON captures (t);
+CREATE INDEX IF NOT EXISTS captures_target_t ON captures (target, t);
+CREATE INDEX IF NOT EXISTS captures_hash ON captures (hash);
+"""
+COLUMNS = ("t", "path", "bytes", "w", "h", "target", "output", "profile",
+           "hash")
+INSERT = (f"INSERT INTO captures ({', '.join(COLUMNS)}) "
+          f"VALUES ({', '.join(':' + c for c in COLUMNS)})")
+# what adding a path that's already there changes, with {0} the prefix for
+# the new values
+UPDATES = ("t = {0}t, bytes = {0}bytes, w = {0}w, h = {0}h, hash = {0}hash, "
+           "target = coalesce({0}target, target), "
+           "output = coalesce({0}output, output), "
+           "profile = coalesce({0}profile, profile)")
+# for reindex, where a profile the catalog already has wins over the guess
+KEEP_PROFILE_UPDATES = UPDATES.replace("coalesce({0}profile, profile)",
+                                       "coalesce(profile, {0}profile)")
+# INSERT ... ON CONFLICT DO UPDATE needs SQLite 3.24
+HAS_UPSERT = sqlite3.sqlite_version_info >= (3, 24, 0)
+BATCH = 500
+
+_catalog = None
+_lock = threading.Lock()
+
+
+def catalog_path():
+    import appdirs
+    from . import config
+    from .__init__ import APPNAME
+
+    path = config.data["catalog_file"]
+    if not path:
+        path = os.path.join(appdirs.user_data_dir(APPNAME, False),
+                            "catalog.sqlite")
+    return Path(path)
+
+
+def connect(path=None):
+    path = Path(path or catalog_path())
+    path.parent.mkdir(parents=True, exist_ok=True)
+    db = sqlite3.connect(str(path), check_same_thread=False)
+    db.execute("PRAGMA journal_mode = WAL")
+    db.execute("PRAGMA synchronous = NORMAL")
+    db.executescript(SCHEMA)
+    return db
+
+
+def upsert(db, rows, keep_profile=False):
+    """
+    Adds 'rows' (dicts with every one of COLUMNS), or updates the ones
+    whose path is already there.
+    """
+    updates = KEEP_PROFILE_UPDATES if keep_profile else UPDATES
+    if HAS_UPSERT:
+        db.executemany(f"{INSERT} ON CONFLICT (path) DO UPDATE SET "
+                       + updates.format("excluded."), rows)
+        return
+    update = f"UPDATE captures SET {updates.format(':')} WHERE path = :path"
+    for row in rows:
+        if not db.execute(update, row).rowcount:
+            db.execute(INSERT, row)
+
+
+def file_hash(fp):
+    h = hashlib.blake2b(digest_size=16)
+    with open(fp, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def get_catalog():
+    """
+    The catalog, or None if it's turned off.
+    """
+    global _catalog
+    from . import config
+
+    if not config.get_bool("catalog"):
+        return None
+    with _lock:
+        if _catalog is None:
+            _catalog = Catalog(catalog_path())
+    return _catalog
+
+
+def added(event):
+    """
+    Catalogs the file a capture 'event' was saved to, if there is one.
+    Safe to call from the encoder threads.
+    """
+    from . import config
+    from .compact import IMAGE_EXTS
+
+    path = event.get("path")
+    if not path or os.path.splitext(path)[1].lower() not in IMAGE_EXTS:
+        return
+    catalog = get_catalog()
+    if catalog is None:
+        return
+    output = event.get("output")
+    profile = config.data["encoder_profile"]
+    if output in config.outputs:
+        profile = config.outputs[output]["encoder_profile"] or profile
+    row = {"t": event["t"], "path": os.path.abspath(path),
+           "bytes": event.get("bytes"), "w": event.get("w"),
+           "h": event.get("h"), "target": event.get("target"),
+           "output": output, "profile": profile, "hash": None}
+    catalog.put(("add", row))
+
+
+def removed(paths):
+    catalog = get_catalog()
+    if catalog is not None:
+        for fp in paths:
+            catalog.put(("remove", os.path.abspath(fp)))
+
+
+def moved(src, dest, size=None, profile=None):
+    """
+    'src' is now 'dest'. Pass 'size' if the contents changed too, and
+    'profile' if they were encoded again (e.g. recompressed).
+    """
+    catalog = get_catalog()
+    if catalog is not None:
+        catalog.put(("move", os.path.abspath(src), os.path.abspath(dest),
+                     size, profile))
+
+
+
+class Catalog:
+    """
+    Writes changes to the catalog on a background thread.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.db = connect(self.path)
+        self.queue = queue.Queue()
+        self._db_lock = threading.Lock()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="catalog",
+                                        daemon=True)
+        self._thread.start()
+        # in case nothing closes us first (see close())
+        atexit.register(self.close)
+
+
+    def put(self, item):
+        if self._closed:
+            # something finished after we were closed
+            self._write([item])
+        else:
+            self.queue.put(item)
+
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < BATCH:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in batch
+            self._write([item for item in batch if item is not None])
+            if stop:
+                return
+
+
+    def _write(self, batch):
+        """
+        Applies 'batch' in one transaction.
+        """
+        if not batch:
+            return
+        with self._db_lock:
+            try:
+                with self.db:
+                    for item in batch:
+                        getattr(self, "_" + item[0])(*item[1:])
+            except sqlite3.Error:
+                log.exception(f"Couldn't update the catalog '{self.path}'")
+
+
+    @staticmethod
+    def _hash(fp):
+        try:
+            return file_hash(fp)
+        except OSError:
+            # gone already
+            return None
+
+
+    def _add(self, row):
+        if row["bytes"] is None:
+            # a hard link to an earlier frame
+            try:
+                row["bytes"] = os.path.getsize(row["path"])
+            except OSError:
+                pass
+        row["hash"] = self._hash(row["path"])
+        upsert(self.db, [row])
+
+
+    def _remove(self, fp):
+        self.db.execute("DELETE FROM captures WHERE path = ?", (fp,))
+
+
+    def _move(self, src, dest, size, profile=None):
+        if size is None:
+            self.db.execute("UPDATE captures SET path = ? WHERE path = ?",
+                            (dest, src))
+            return
+        self.db.execute("UPDATE captures SET path = ?, bytes = ?, hash = ?, "
+                        "profile = coalesce(?, profile) WHERE path = ?",
+                        (dest, size, self._hash(dest), profile, src))
+
+
+    def close(self):
+        """
+        Writes everything queued so far and stops the thread. Anything
+        that comes in after that is written straight away.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self.queue.put(None)
+        self._thread.join()
+
+
+
+def close():
+    """
+    Finish writing the catalog. The encoder pipelines call this once
+    they've written (and synced) their last images, so nothing recorded
+    at exit is left in the queue.
+    """
+    if _catalog is not None:
+        _catalog.close()
+
+
+
+def find(start=None, end=None, latest=None, target=None, output=None,
+         path=None):
+    """
+    Rows (as dicts) for screenshots between 'start' and 'end' (unix times),
+    oldest first. 'latest' keeps only the last that many.
+    'target' is a monitor or region label, or '' for the whole desktop.
+    'output' is the name of an extra output, '*' for every copy, or None
+    for the main screenshots.
+    """
+    path = Path(path or catalog_path())
+    if not path.exists():
+        return []
+    where, params = [], []
+    if start is not None:
+        where.append("t >= ?")
+        params.append(start)
+    if end is not None:
+        where.append("t <= ?")
+        params.append(end)
+    if target is not None:
+        where.append("target IS ?")
+        params.append(target or None)
+    if output != "*":
+        where.append("output IS ?")
+        params.append(output)
+    sql = f"SELECT {', '.join(COLUMNS)} FROM captures"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    if latest:
+        sql += f" ORDER BY t DESC LIMIT {int(latest)}"
+    else:
+        sql += " ORDER BY t"
+    t0 = perf_counter()
+    db = sqlite3.connect(str(path))
+    try:
+        rows = [dict(zip(COLUMNS, row)) for row in db.execute(sql, params)]
+    finally:
+        db.close()
+    log.debug(f"Catalog query took {(perf_counter() - t0) * 1000:.2f}ms")
+    if latest:
+        rows.reverse()
+    return rows
+
+
+def labels():
+    """
+    Names that can appear at the end of a filename as a target.
+    """
+    from . import config
+    from .regions import parse_regions
+
+    try:
+        named = set(parse_regions(config.data["regions"]))
+    except ValueError:
+        named = set()
+    return named | {"window", "region"}
+
+
+def guess_target(fp, names):
+    """
+    The monitor or region label in a filename made by util.target_fp, if
+    there is one. It's followed by ' (2)' etc. or a burst frame number at
+    most.
+    """
+    words = re.sub(r" \(\d+\)$", "", Path(fp).stem).split(" ")
+    for word in words[-2:][::-1]:
+        if word in names or re.fullmatch(r"m\d+", word):
+            return word
+    return None
+
+
+def scan(fp, output, profile, names):
+    """
+    A catalog row for image file 'fp', read from the file itself.
+    Runs on the reindex threads.
+    """
+    from PIL import Image
+
+    st = os.stat(fp)
+    with Image.open(fp) as img:
+        w, h = img.size
+    return {"t": st.st_mtime, "path": os.path.abspath(fp),
+            "bytes": st.st_size, "w": w, "h": h,
+            "target": guess_target(fp, names), "output": output,
+            "profile": profile, "hash": file_hash(fp)}
+
+
+def reindex(dirs=None, workers=None, path=None):
+    """
+    Rebuilds the rows for every image under each directory in 'dirs' from
+    the files themselves. Defaults to img_dir and every extra output's
+    dir.
+    Which output a file is a copy of comes from the output dirs in the
+    config file (or, for outputs saved in img_dir, the extension). Its
+    profile is the one configured for that output, unless the catalog
+    already knew better. Capture times come from the files' modification
+    times.
+    Returns a dict of stats.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from . import config
+    from .compact import find_images
+    from .outputs import output_dirs, shared_exts
+
+    img_dir = os.path.abspath(config.data["img_dir"])
+    separate = output_dirs(img_dir)
+    shared = shared_exts(img_dir)
+    profiles = {None: config.data["encoder_profile"]}
+    for name, options in config.outputs.items():
+        profiles[name] = options["encoder_profile"] or profiles[None]
+    if dirs is None:
+        dirs = [img_dir] + sorted(separate)
+
+    def output_for(fp):
+        # the deepest output dir it's in, if any
+        for top in sorted(separate, key=len, reverse=True):
+            if fp.startswith(os.path.join(top, "")):
+                return separate[top]
+        return shared.get(os.path.splitext(fp)[1].lower())
+
+    def try_scan(fp):
+        fp = os.path.abspath(fp)
+        output = output_for(fp)
+        try:
+            return scan(fp, output, profiles.get(output), names)
+        except Exception as exc:
+            log.warning(f"Couldn't read '{fp}': {exc}")
+            return None
+
+    names = labels()
+    stats = {"files": 0, "failed": 0, "removed": 0, "seconds": 0.0}
+    start = perf_counter()
+    db = connect(path)
+    try:
+        for top in dirs:
+            top = os.path.abspath(top)
+            # output dirs inside this one are done on their own
+            nested = [d for d in separate
+                      if d != top and d.startswith(os.path.join(top, ""))]
+            files = list(find_images(top, nested))
+            log.info(f"Cataloguing {len(files)} image(s) in '{top}'")
+            with ThreadPoolExecutor(max_workers=workers or 16) as pool:
+                rows = [row for row in pool.map(try_scan, files,
+                                                chunksize=64)
+                        if row is not None]
+            stats["files"] += len(rows)
+            stats["failed"] += len(files) - len(rows)
+            prefix = os.path.join(top, "")
+            skip = [os.path.join(d, "") for d in nested]
+            found = {row["path"] for row in rows}
+            with db:
+                gone = [(fp,) for fp, in db.execute(
+                            "SELECT path FROM captures "
+                            "WHERE substr(path, 1, ?) = ?",
+                            (len(prefix), prefix))
+                        if fp not in found
+                        and not any(fp.startswith(d) for d in skip)]
+                db.executemany("DELETE FROM captures WHERE path = ?", gone)
+                upsert(db, rows, keep_profile=True)
+            stats["removed"] += len(gone)
+    finally:
+        db.close()
+    stats["seconds"] = perf_counter() - start
+    return stats
@@ -0,0 +1,238 @@
+"""
+Recompress (or convert) screenshots after the fact, using every core.
+Capture can then use a fast encoder profile and the hard work happens
+later, when nobody's waiting on it.
+
+Finished files are recorded in a manifest in img_dir, one line per file,
+so an interrupted run picks up where it left off and files that are
+already done aren't touched again.
+"""
+import os
+from pathlib import Path
+from time import perf_counter
+
+from .log import get_logger
+
+log = get_logger(__name__)
+
+MANIFEST_FN = ".screenshotto-compact"
+IMAGE_EXTS = {".png", ".jpg", ".jpeg", ".webp", ".bmp", ".tif", ".tiff"}
+FORMAT_EXTS = {"png": ".png", "jpeg": ".jpg", "webp": ".webp"}
+
+
+def read_manifest(manifest_fp):
+    """
+    {relative path: (size, mtime_ns, target)} for every file already done.
+    """
+    done = {}
+    try:
+        with open(manifest_fp, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    relpath, size, mtime, target = line.rstrip("\n").split("\t")
+                    done[relpath] = (int(size), int(mtime), target)
+                except ValueError:
+                    # half written line from an interrupted run
+                    continue
+    except FileNotFoundError:
+        pass
+    return done
+
+
+def find_images(img_dir, exclude=()):
+    """
+    Every image file under 'img_dir', except in hidden directories and
+    the directories in 'exclude'.
+    """
+    exclude = {os.path.abspath(d) for d in exclude}
+    for dirpath, dirnames, filenames in os.walk(img_dir):
+        dirnames[:] = [d for d in dirnames if not d.startswith(".")
+                       and os.path.abspath(os.path.join(dirpath, d))
+                       not in exclude]
+        for fn in filenames:
+            if fn.startswith("."):
+                continue
+            if os.path.splitext(fn)[1].lower() in IMAGE_EXTS:
+                yield Path(dirpath) / fn
+
+
+def webp_is_lossy(fp):
+    """
+    Whether WebP file 'fp' holds a lossy ('VP8 ') rather than a lossless
+    ('VP8L') image. Walks the RIFF chunks, as extended files put others
+    (ICC profile, alpha...) first.
+    """
+    with open(fp, "rb") as f:
+        f.seek(12)
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                return False
+            kind, size = header[:4], int.from_bytes(header[4:], "little")
+            if kind in (b"VP8 ", b"VP8L"):
+                return kind == b"VP8 "
+            f.seek(size + size % 2, os.SEEK_CUR)
+
+
+def is_lossy(img, fp):
+    return (img.format == "JPEG"
+            or (img.format == "WEBP" and webp_is_lossy(fp)))
+
+
+def compact_file(fp, profile, fmt=None, fsync="file", links=()):
+    """
+    Recompresses 'fp' with encoder 'profile', converting it to 'fmt'
+    ('png', 'jpeg', 'webp') if given.
+    The new file is written next to the old one and renamed over it, so
+    there's never a half written image. It keeps the old one's
+    permissions and modification time. Without a format change the result
+    is only kept if it's smaller. A format change never replaces another
+    file: if the new name is taken, ' (2)' etc. is added. Unless 'fsync'
+    is 'none' the new file is synced to disk before it replaces the old
+    one.
+    'links' are the other paths hard linked to 'fp' (see dedup). The image
+    is only encoded once, and they're all linked to the new file again.
+    Lossy images (JPEG, lossy WebP) are left alone, as encoding them again
+    would only lose more.
+    Returns ([(old path, new path)], bytes before, bytes after), or None
+    if 'fp' was left alone for being lossy.
+    Runs in a worker process.
+    """
+    import stat
+    import tempfile
+    from PIL import Image
+    from .durable import fsync_dir, fsync_path
+    from .encoders import encode, image_format
+    from .util import move_free
+
+    fp = Path(fp)
+    paths = [Path(p) for p in links] + [fp]
+    st = fp.stat()
+    before = st.st_size
+    dest = fp.with_suffix(FORMAT_EXTS[fmt]) if fmt else fp
+    pil_fmt = image_format(dest)
+    with Image.open(fp) as img:
+        if is_lossy(img, fp):
+            return None
+        if pil_fmt == "JPEG" and img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        fd, tmp = tempfile.mkstemp(suffix=".compact.tmp",
+                                   prefix=f".{dest.stem}.", dir=dest.parent)
+        os.close(fd)
+        try:
+            encode(img, tmp, profile, pil_fmt)
+        except BaseException:
+            os.remove(tmp)
+            raise
+    after = os.path.getsize(tmp)
+    if dest == fp and after >= before:
+        os.remove(tmp)
+        return [(p, p) for p in paths], before, before
+    # mkstemp makes it private to us
+    os.chmod(tmp, stat.S_IMODE(st.st_mode))
+    # keep the capture time on the file
+    os.utime(tmp, ns=(st.st_atime_ns, st.st_mtime_ns))
+    if fsync != "none":
+        fsync_path(tmp)
+    moves = []
+    dirs = set()
+    # 'fp' last, as the others are linked from its temporary file
+    for path in paths:
+        if path == fp:
+            src = tmp
+        else:
+            src = path.with_name(f".{path.stem}.{os.getpid()}.compact.tmp")
+            os.link(tmp, src)
+        new = path.with_suffix(FORMAT_EXTS[fmt]) if fmt else path
+        if new != path:
+            # there may be another image with the new name already
+            new = move_free(src, new)
+            os.remove(path)
+        else:
+            os.replace(src, new)
+        moves.append((path, new))
+        dirs.add(new.parent)
+    if fsync != "none":
+        for dirpath in dirs:
+            fsync_dir(dirpath)
+    return moves, before, after
+
+
+def compact(img_dir, profile="small", fmt=None, workers=None):
+    """
+    Compacts every image under 'img_dir' that isn't in the manifest yet.
+    Returns a dict of stats.
+    """
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    from . import catalog, config
+
+    # workers don't live long enough to sync a batch, so 'batch' syncs
+    # every file
+    fsync = config.data["fsync"]
+    img_dir = Path(img_dir)
+    manifest_fp = img_dir / MANIFEST_FN
+    target = f"{profile}:{fmt or '-'}"
+    done = read_manifest(manifest_fp)
+
+    # the paths to do for each file, as dedup hard links the same image
+    # to several
+    todo = {}
+    skipped = 0
+    for fp in find_images(img_dir):
+        st = fp.stat()
+        relpath = fp.relative_to(img_dir).as_posix()
+        if done.get(relpath) == (st.st_size, st.st_mtime_ns, target):
+            skipped += 1
+            continue
+        key = (st.st_dev, st.st_ino)
+        todo.setdefault(key, (st.st_nlink, []))[1].append(fp)
+    stats = {"files": sum(len(paths) for _, paths in todo.values()),
+             "skipped": skipped, "failed": 0, "lossy": 0, "shared": 0,
+             "before": 0, "after": 0, "seconds": 0.0}
+    groups = []
+    for nlink, paths in todo.values():
+        if nlink > len(paths):
+            # linked from somewhere we aren't compacting. Encoding it
+            # again would only make another copy.
+            log.debug(f"'{paths[0]}' is linked from outside '{img_dir}'")
+            stats["shared"] += len(paths)
+        else:
+            groups.append(paths)
+    if not groups:
+        return stats
+    log.info(f"Compacting {len(groups)} image(s) in '{img_dir}' "
+             f"with the '{profile}' profile")
+
+    start = perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as pool, \
+         open(manifest_fp, "a", encoding="utf-8") as manifest:
+        futures = {pool.submit(compact_file, str(paths[0]), profile, fmt,
+                               fsync, [str(fp) for fp in paths[1:]]): paths
+                   for paths in groups}
+        for future in as_completed(futures):
+            paths = futures[future]
+            try:
+                result = future.result()
+            except Exception as exc:
+                log.warning(f"Couldn't compact '{paths[0]}': {exc}")
+                stats["failed"] += len(paths)
+                continue
+            if result is None:
+                # lossy. It's recorded so it isn't looked at again.
+                stats["lossy"] += len(paths)
+                moves = [(fp, fp) for fp in paths]
+            else:
+                moves, before, after = result
+                stats["before"] += before
+                stats["after"] += after
+                if after != before:
+                    for src, dest in moves:
+                        catalog.moved(src, dest, after, profile)
+            for _, dest in moves:
+                st = os.stat(dest)
+                relpath = Path(dest).relative_to(img_dir).as_posix()
+                manifest.write(f"{relpath}\t{st.st_size}"
+                               f"\t{st.st_mtime_ns}\t{target}\n")
+            manifest.flush()
+    stats["seconds"] = perf_counter() - start
+    return stats
@@ -1,18 +1,17 @@
 # -*- coding: utf-8 -*-
 
 import os
+import sys
 from configparser import SafeConfigParser, NoSectionError
-from logging import getLogger
 import re
 
 import appdirs
 
-from .log import modulename
+from .log import get_logger
 from .__init__ import APPNAME
-from . import knownpaths
 from .validpath import is_pathname_valid, is_path_exists_or_creatable
 
-log = getLogger(modulename())
+log = get_logger(__name__)
 log.debug("Helo its me ur config")
 
 config_dir = appdirs.user_config_dir(APPNAME, False)
@@ -23,8 +22,14 @@ config_path = os.path.join(config_dir, configfn)
 
 def default_dir():
     log.debug("Determining default img_dir")
-    img_dir = knownpaths.get_path(knownpaths.FOLDERID.Pictures,
-                        knownpaths.UserHandle.current)
+    if sys.platform == "win32":
+        from . import knownpaths
+        img_dir = knownpaths.get_path(knownpaths.FOLDERID.Pictures,
+                            knownpaths.UserHandle.current)
+    else:
+        # no known folders off windows, but it's nice to be able to run
+        # (and benchmark) headless on linux boxes
+        img_dir = os.path.join(os.path.expanduser("~"), "Pictures")
     assert is_path_exists_or_creatable(img_dir), \
            f"'{img_dir}' is not a valid path"
     if is_pathname_valid(APPNAME):
@@ -41,8 +46,100 @@ def default_dir():
 data = {
     "img_dir": default_dir,
     "strftime": "%Y-%m-%d %H%M",
-    "filename": "{strftime}.png"
+    "filename": "{strftime}.png",
+    "subdirs": "",
+    "capture_backend": "desktopmagic",
+    "synthetic_size": "1920x1080",
+    "synthetic_monitors": "1",
+    "synthetic_entropy": "0.1",
+    "synthetic_seed": "0",
+    "framebuffer": "/dev/fb0",
+    "replay_path": "",
+    "monitors": "",
+    "region": "",
+    "regions": "",
+    "encoder_workers": "2",
+    "encoder_processes": "0",
+    "queue_size": "4",
+    "queue_policy": "block",
+    "fsync": "batch",
+    "fsync_batch_files": "20",
+    "fsync_batch_secs": "5",
+    "dedup": "off",
+    "dedup_threshold": "0.1",
+    "storage": "images",
+    "session_strftime": "%Y-%m-%d",
+    "keyframe_interval": "60",
+    "tile_size": "64",
+    "encoder_profile": "balanced",
+    "png_compress_level": "6",
+    "png_optimize": "no",
+    "jpeg_quality": "75",
+    "jpeg_optimize": "no",
+    "webp_quality": "80",
+    "webp_lossless": "no",
+    "webp_method": "4",
+    "png_stream_rows": "0",
+    "log_queue_size": "10000",
+    "log_queue_policy": "block",
+    "debug_buffer_records": "5000",
+    "debug_buffer_bytes": "1048576",
+    "keep_for": "",
+    "keep_count": "0",
+    "keep_size": "",
+    "thinning": "",
+    "events": "yes",
+    "event_log": "",
+    "catalog": "yes",
+    "catalog_file": "",
+    "trace_sinks": "",
+    "trace_file": "",
+}
+
+# Keep hold of the defaults so a garbage value in the file can fall back
+defaults = data.copy()
+
+# Extra outputs, from [output NAME] sections: name -> {option: value}
+# Every screenshot is also saved to each of these.
+OUTPUT_PREFIX = "output "
+output_defaults = {
+    "dir": "",
+    "filename": "{strftime}.png",
+    "scale": "1",
+    "encoder_profile": "",
 }
+outputs = {}
+
+
+def get_int(key):
+    try:
+        return int(data[key])
+    except ValueError:
+        log.warning(f"'{data[key]}' is not a whole number. "
+                    f"Using the default for {key} instead.")
+        return int(defaults[key])
+
+
+def get_float(key):
+    try:
+        return float(data[key])
+    except ValueError:
+        log.warning(f"'{data[key]}' is not a number. "
+                    f"Using the default for {key} instead.")
+        return float(defaults[key])
+
+
+_truthy = ("1", "yes", "true", "on")
+_falsy = ("0", "no", "false", "off", "")
+
+
+def get_bool(key):
+    val = str(data[key]).strip().lower()
+    if val in _truthy or val in _falsy:
+        return val in _truthy
+    log.warning(f"'{data[key]}' is not yes or no. "
+                f"Using the default for {key} instead.")
+    return str(defaults[key]).strip().lower() in _truthy
 
 
 def get_config():
@@ -82,7 +179,7 @@ def generate_config(configdata=None):
 
     config.set(sect, "\n; How to format the date/time")
     config.set(sect, "; See http://strftime.org/ or "
-               "https://docs.python.org/3.6/library/datetime.html"
+               "https://docs.python.org/3/library/datetime.html"
                "#strftime-and-strptime-behavior for a reference")
     config.set(sect, "; '%c' gives a complete date and time "
                "appropriate to your locale")
@@ -97,13 +194,222 @@ def generate_config(configdata=None):
                "where the time is formatted as specified "
                "in the 'strftime' option ")
     config.set(sect, "; You might like to use 'Desktop - {strftime}.png'")
-    config.set(sect, "; You can choose not to include {strftime} at all"
-               " but then every new image would overwrite the previous one.")
+    config.set(sect, "; You can also use {ms} (milliseconds, 000-999), "
+               "{us} (microseconds) and {seq} (a number that goes up "
+               "with every screenshot, e.g. {seq:06d})")
+    config.set(sect, "; Screenshots never overwrite each other. If the name "
+               "is taken, the next {seq} is used, or ' (2)', ' (3)'... "
+               "is added if there's no {seq}.")
     config.set(sect, "; The image format is based on the extension"
                ", so you can use .png, .jpg, and so on "
                "and the image will be in that format.")
     config.set(sect, "filename", configdata["filename"])
 
+    config.set(sect, "\n; Sort screenshots into subdirectories of img_dir "
+               "by the date they were taken,")
+    config.set(sect, "; so no one directory ends up with too many files "
+               "in it. e.g. {Y}/{m}/{d} or {Y}-{m}/{d}/{H}")
+    config.set(sect, "; {Y} year, {m} month, {d} day, {H} hour, {M} minute. "
+               "Leave empty to put them all straight in img_dir.")
+    config.set(sect, "; Run 'screenshotto reshard' after changing this "
+               "to move existing screenshots.")
+    config.set(sect, "subdirs", configdata["subdirs"])
+
+    config.set(sect, "\n; Where screenshots come from")
+    config.set(sect, "; 'desktopmagic' grabs the real screen (all monitors, windows only)")
+    config.set(sect, "; 'synthetic' generates fake frames in memory "
+               "- handy for benchmarking and testing without a screen")
+    config.set(sect, "; 'framebuffer' reads raw pixels from a linux "
+               "framebuffer device")
+    config.set(sect, "; 'replay' cycles through the image(s) in replay_path")
+    config.set(sect, "capture_backend", configdata["capture_backend"])
+
+    config.set(sect, "\n; Synthetic frames: resolution of each monitor, "
+               "number of monitors side by side,")
+    config.set(sect, "; entropy from 0 (flat colour, compresses to nothing) "
+               "to 1 (pure noise), and a seed")
+    config.set(sect, "; The same seed always produces the same frames.")
+    config.set(sect, "synthetic_size", configdata["synthetic_size"])
+    config.set(sect, "synthetic_monitors", configdata["synthetic_monitors"])
+    config.set(sect, "synthetic_entropy", configdata["synthetic_entropy"])
+    config.set(sect, "synthetic_seed", configdata["synthetic_seed"])
+
+    config.set(sect, "\n; Framebuffer device for the 'framebuffer' backend")
+    config.set(sect, "framebuffer", configdata["framebuffer"])
+
+    config.set(sect, "\n; Image file, or directory of images, "
+               "for the 'replay' backend")
+    config.set(sect, "replay_path", configdata["replay_path"])
+
+    config.set(sect, "\n; Only capture some monitors, each to its own file: "
+               "'all', or numbers like '1,3'.")
+    config.set(sect, "; Leave empty to capture the whole desktop "
+               "as one image.")
+    config.set(sect, "monitors", configdata["monitors"])
+    config.set(sect, "; Or only capture one rectangle: x,y,width,height "
+               "in pixels from the top left of the desktop,")
+    config.set(sect, "; one of the names from 'regions', or 'window' for "
+               "the window in front (windows only)")
+    config.set(sect, "region", configdata["region"])
+    config.set(sect, "; Named rectangles, separated by semicolons, e.g. "
+               "dashboard=0,0,1920,1080; clock=3640,0,200,80")
+    config.set(sect, "regions", configdata["regions"])
+
+    config.set(sect, "\n; When capturing on a schedule, images are compressed "
+               "and saved in the background")
+    config.set(sect, "; by this many threads")
+    config.set(sect, "encoder_workers", configdata["encoder_workers"])
+    config.set(sect, "; Or, if this is more than 0, by this many processes "
+               "instead. Frames are passed to them through shared memory,")
+    config.set(sect, "; so this spreads the encoding over more cores.")
+    config.set(sect, "encoder_processes", configdata["encoder_processes"])
+    config.set(sect, "; At most this many captured images can be waiting "
+               "to be saved")
+    config.set(sect, "queue_size", configdata["queue_size"])
+    config.set(sect, "; What to do when that many are already waiting: "
+               "'block' waits for room,")
+    config.set(sect, "; 'drop_newest' skips the new screenshot, "
+               "'drop_oldest' skips the oldest waiting one")
+    config.set(sect, "queue_policy", configdata["queue_policy"])
+
+    config.set(sect, "\n; Images are written to a temporary file and "
+               "renamed when complete, so there are never half written ones.")
+    config.set(sect, "; How hard to make sure they survive a crash "
+               "or power cut:")
+    config.set(sect, "; 'none' leaves it to the OS (fastest), "
+               "'file' syncs every image to disk (safest, slowest),")
+    config.set(sect, "; 'batch' syncs every image, but their directories "
+               "only every fsync_batch_files images or fsync_batch_secs")
+    config.set(sect, "; seconds, whichever comes first. (a crash can lose "
+               "the last batch, but never leaves an empty image)")
+    config.set(sect, "fsync", configdata["fsync"])
+    config.set(sect, "fsync_batch_files", configdata["fsync_batch_files"])
+    config.set(sect, "fsync_batch_secs", configdata["fsync_batch_secs"])
+
+    config.set(sect, "\n; What to do when the screen hasn't changed "
+               "since the last screenshot")
+    config.set(sect, "; 'off' saves it anyway, 'skip' doesn't save it, "
+               "'link' makes a hard link to the last image instead")
+    config.set(sect, "dedup", configdata["dedup"])
+    config.set(sect, "; The screen counts as unchanged when less than "
+               "this percentage of it is different")
+    config.set(sect, "dedup_threshold", configdata["dedup_threshold"])
+
+    config.set(sect, "\n; 'images' saves every screenshot as its own file")
+    config.set(sect, "; 'session' puts them all in one .sshot file per "
+               "session, only storing the parts of the screen that changed")
+    config.set(sect, "; Use 'screenshotto export' to get images back out "
+               "of a session file.")
+    config.set(sect, "; Every run starts with a complete screenshot, so "
+               "this only saves space with 'schedule' or 'daemon'.")
+    config.set(sect, "storage", configdata["storage"])
+    config.set(sect, "; Session files are named by this strftime format, "
+               "so '%Y-%m-%d' starts a new session every day")
+    config.set(sect, "session_strftime", configdata["session_strftime"])
+    config.set(sect, "; Store a complete screenshot every this many "
+               "screenshots. Lower is more robust, higher is smaller")
+    config.set(sect, "keyframe_interval", configdata["keyframe_interval"])
+    config.set(sect, "; Size in pixels of the squares the screen is split "
+               "into when looking for changes")
+    config.set(sect, "tile_size", configdata["tile_size"])
+
+    config.set(sect, "\n; How hard to compress images")
+    config.set(sect, "; 'fastest' doesn't compress PNGs at all "
+               "(run 'screenshotto compact' later to shrink them),")
+    config.set(sect, "; 'fast', 'balanced' (the usual), 'small', "
+               "or 'custom' to use the settings below")
+    config.set(sect, "; Run 'screenshotto benchmark --profiles' to see "
+               "how they compare on your machine.")
+    config.set(sect, "encoder_profile", configdata["encoder_profile"])
+    config.set(sect, "; Custom profile. PNG compression is 0 (none) to 9 "
+               "(smallest, slowest)")
+    config.set(sect, "png_compress_level", configdata["png_compress_level"])
+    config.set(sect, "png_optimize", configdata["png_optimize"])
+    config.set(sect, "; JPEG and WebP quality is 1 (awful) to 100 (best)")
+    config.set(sect, "jpeg_quality", configdata["jpeg_quality"])
+    config.set(sect, "jpeg_optimize", configdata["jpeg_optimize"])
+    config.set(sect, "webp_quality", configdata["webp_quality"])
+    config.set(sect, "; Lossless WebP is usually smaller than PNG")
+    config.set(sect, "webp_lossless", configdata["webp_lossless"])
+    config.set(sect, "; WebP effort, 0 (fast) to 6 (smallest)")
+    config.set(sect, "webp_method", configdata["webp_method"])
+    config.set(sect, "; If more than 0, PNGs are compressed this many rows "
+               "at a time by screenshotto's own encoder,")
+    config.set(sect, "; which needs much less memory than Pillow's for "
+               "big multi-monitor screenshots. 64 is a good start.")
+    config.set(sect, "png_stream_rows", configdata["png_stream_rows"])
+
+    config.set(sect, "\n; The log file is written in the background. "
+               "When this many messages are waiting to be written")
+    config.set(sect, "; 'block' waits for the disk, 'drop' skips "
+               "debug and info messages (warnings and errors are always kept)")
+    config.set(sect, "; Only used while running a schedule, burst or daemon.")
+    config.set(sect, "log_queue_size", configdata["log_queue_size"])
+    config.set(sect, "log_queue_policy", configdata["log_queue_policy"])
+    config.set(sect, "; Console messages are held back until we know "
+               "whether to show debug ones. At most this many,")
+    config.set(sect, "; and this many bytes of text. The oldest go first.")
+    config.set(sect, "debug_buffer_records", configdata["debug_buffer_records"])
+    config.set(sect, "debug_buffer_bytes", configdata["debug_buffer_bytes"])
+
+    config.set(sect, "\n; Delete old screenshots while running a schedule "
+               "or the daemon (or with 'screenshotto prune').")
+    config.set(sect, "; Leave these empty (or 0) to keep everything.")
+    config.set(sect, "; Delete screenshots older than this, e.g. '30d'. "
+               "Units are s, m, h, d and w")
+    config.set(sect, "keep_for", configdata["keep_for"])
+    config.set(sect, "; Keep at most this many screenshots")
+    config.set(sect, "keep_count", configdata["keep_count"])
+    config.set(sect, "; Keep at most this much, e.g. '500M' or '20G'")
+    config.set(sect, "keep_size", configdata["keep_size"])
+    config.set(sect, "; Keep fewer screenshots as they get older. "
+               "Comma separated list of AGE:INTERVAL,")
+    config.set(sect, "; e.g. '1h:1m, 1d:1h' keeps everything from the "
+               "last hour, one a minute after that,")
+    config.set(sect, "; and one an hour once they're more than a day old")
+    config.set(sect, "thinning", configdata["thinning"])
+    config.set(sect, "\n; Keep a record of every screenshot "
+               "(timings, sizes, where it went) for 'screenshotto stats'")
+    config.set(sect, "events", configdata["events"])
+    config.set(sect, "; Where to keep it. Leave empty for the default, "
+               "in the user data directory")
+    config.set(sect, "event_log", configdata["event_log"])
+    config.set(sect, "; Keep an index of every screenshot file (time, size, "
+               "monitor, hash...) for 'screenshotto find'")
+    config.set(sect, "catalog", configdata["catalog"])
+    config.set(sect, "; Where to keep it. Leave empty for the default, "
+               "in the user data directory")
+    config.set(sect, "catalog_file", configdata["catalog_file"])
+
+    config.set(sect, "\n; Time each stage of taking a screenshot. "
+               "Comma separated list of any of:")
+    config.set(sect, "; 'log' (debug messages), 'json' (lines appended to "
+               "trace_file), 'histogram' (kept in memory)")
+    config.set(sect, "trace_sinks", configdata["trace_sinks"])
+    config.set(sect, "trace_file", configdata["trace_file"])
+
+    config.set(sect, "\n; Every screenshot can also be saved somewhere else "
+               "at the same time, e.g. smaller, or as a jpeg.")
+    config.set(sect, "; Add a section like this for each one "
+               "(without the semicolons):")
+    config.set(sect, ";   [output thumbnails]")
+    config.set(sect, ";   dir = C:\\Screenshots\\thumbs      "
+               "(empty for img_dir)")
+    config.set(sect, ";   filename = {strftime}.jpg         "
+               "(the extension picks the format)")
+    config.set(sect, ";   scale = 320x180                    "
+               "(a fraction like 0.5, or a size to fit inside)")
+    config.set(sect, ";   encoder_profile = fast             "
+               "(empty for the one above)")
+    config.set(sect, "; An output saved in img_dir needs a different file "
+               "type from the screenshots there.")
+
+    for name, options in outputs.items():
+        section = OUTPUT_PREFIX + name
+        config.add_section(section)
+        for key, default in output_defaults.items():
+            config.set(section, key, options.get(key, default))
+
     write_cfg(config)
     _old_data = configdata.copy()
 
@@ -137,7 +443,13 @@ try:
         # replace some common, invalid windows filename characters
         # for the options that eventually affect/turn into filenames
         if setting_name in ["strftime", "filename"]:
-            val, num_invalid_chars = re.subn(r"[<>:\"/\\|?*]", "_", val)
+            # leave {placeholders} alone so format specs like {ms:03d} work
+            parts = re.split(r"(\{[^{}]*\})", val)
+            num_invalid_chars = 0
+            for i in range(0, len(parts), 2):
+                parts[i], n = re.subn(r"[<>:\"/\\|?*]", "_", parts[i])
+                num_invalid_chars += n
+            val = "".join(parts)
             if num_invalid_chars:
                 log.warning(f"Replaced {num_invalid_chars} characters that are "
                             "not allowed in windows filenames "
@@ -149,6 +461,12 @@ except NoSectionError:
     log.warning(f"No '{APPNAME}' section in config. Maybe somebody fucked it up? "
                 "It'll fix itself.")
 
+for section in config.sections():
+    if section.startswith(OUTPUT_PREFIX):
+        name = section[len(OUTPUT_PREFIX):].strip()
+        outputs[name] = dict(output_defaults)
+        outputs[name].update(config.items(section))
+
 _old_data = data.copy()
 
 log.debug(data)
@@ -0,0 +1,227 @@
+"""
+Long-running capture daemon and its thin client.
+The daemon keeps the capture backend, Pillow's encoders and the config
+loaded, and listens on a named pipe (windows) or unix socket (elsewhere).
+The client only needs the standard library (and appdirs), so
+    python -m screenshotto.daemon
+triggers a capture without paying for click, arrow, schedule, etc.
+
+Messages are pickled, so both ends prove they know a secret key, kept in
+a file only the user can read, before anything is sent. The socket lives
+in a directory only the user can get into.
+"""
+import os
+import sys
+import tempfile
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+
+from .__init__ import APPNAME
+from .log import get_logger
+
+log = get_logger(__name__)
+
+
+def run_dir():
+    """
+    Private directory for the socket. XDG_RUNTIME_DIR already is one.
+    Otherwise it's a directory of our own in the temp dir, which nobody
+    else may own or be able to get into.
+    """
+    if os.environ.get("XDG_RUNTIME_DIR"):
+        return os.environ["XDG_RUNTIME_DIR"]
+    return os.path.join(tempfile.gettempdir(), f"{APPNAME}-{os.getuid()}")
+
+
+def make_run_dir():
+    import stat
+
+    rundir = run_dir()
+    try:
+        os.mkdir(rundir, 0o700)
+    except FileExistsError:
+        pass
+    st = os.lstat(rundir)
+    if (not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid()
+            or st.st_mode & 0o077):
+        raise RuntimeError(f"'{rundir}' isn't a private directory of ours. "
+                           "Not listening there.")
+
+
+def address():
+    """
+    Where the daemon listens. One per user.
+    """
+    if sys.platform == "win32":
+        user = os.environ.get("USERNAME", "")
+        return rf"\\.\pipe\{APPNAME}-{user}"
+    return os.path.join(run_dir(), f"{APPNAME}.sock")
+
+
+def key_path():
+    import appdirs
+
+    return os.path.join(appdirs.user_config_dir(APPNAME, False), "daemon.key")
+
+
+def authkey(create=False):
+    """
+    The secret both ends need to know. The daemon makes it the first time
+    ('create'), readable only by the user.
+    Raises FileNotFoundError if there isn't one and we're not making it.
+    """
+    import secrets
+
+    fp = key_path()
+    if create:
+        os.makedirs(os.path.dirname(fp), exist_ok=True)
+        try:
+            fd = os.open(fp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except FileExistsError:
+            pass
+        else:
+            with os.fdopen(fd, "wb") as f:
+                f.write(secrets.token_hex(32).encode())
+        if sys.platform != "win32" and os.stat(fp).st_mode & 0o077:
+            os.chmod(fp, 0o600)
+    with open(fp, "rb") as f:
+        return f.read().strip()
+
+
+def request(cmd, **kwargs):
+    """
+    Sends 'cmd' to the running daemon and returns its reply (a dict).
+    Raises ConnectionError if there's no daemon listening (or it isn't
+    ours).
+    """
+    try:
+        conn = Client(address(), authkey=authkey())
+    except (FileNotFoundError, ConnectionRefusedError) as exc:
+        raise ConnectionError("The screenshotto daemon is not running") \
+              from exc
+    except AuthenticationError as exc:
+        raise ConnectionError("Whatever is listening on the daemon's "
+                              "address doesn't have our key") from exc
+    with conn:
+        conn.send(dict(kwargs, cmd=cmd))
+        return conn.recv()
+
+
+def is_running():
+    try:
+        return request("ping")["ok"]
+    except (ConnectionError, EOFError, OSError):
+        return False
+
+
+def _handle(msg):
+    from .util import save_screenshot
+
+    cmd = msg.get("cmd")
+    if cmd == "capture":
+        # with 'background' we reply as soon as the frame is grabbed and
+        # the files are still being written when the client sees them.
+        # Otherwise the reply waits until they're complete.
+        imgfps = save_screenshot(background=msg.get("background", False))
+        paths = [str(fp) for fp in imgfps]
+        return {"ok": True, "path": paths[0] if paths else None,
+                "paths": paths, "skipped": not paths}
+    if cmd == "ping":
+        return {"ok": True, "pid": os.getpid()}
+    if cmd == "stop":
+        return {"ok": True, "stopping": True}
+    return {"ok": False, "error": f"Unknown command '{cmd}'"}
+
+
+def warm_up():
+    """
+    Do all the slow, once-only work now rather than on the first capture.
+    """
+    from PIL import Image
+    from . import config
+    from .capture import get_backend
+    from .pipeline import get_pipeline
+
+    Image.init()
+    get_backend()
+    get_pipeline()
+    log.debug(f"Daemon warmed up with '{config.data['capture_backend']}'")
+
+
+def serve():
+    """
+    Handle capture requests until somebody sends 'stop'.
+    """
+    if sys.platform != "win32":
+        make_run_dir()
+    addr = address()
+    key = authkey(create=True)
+    if sys.platform != "win32" and os.path.exists(addr):
+        if is_running():
+            raise RuntimeError(f"A daemon is already listening on {addr}")
+        log.debug(f"Removing stale socket {addr}")
+        os.remove(addr)
+
+    warm_up()
+    from . import retention
+    retention.start()
+    # the socket is never anyone else's, not even for a moment
+    old_umask = os.umask(0o077) if sys.platform != "win32" else None
+    try:
+        listener = Listener(addr, authkey=key)
+    finally:
+        if old_umask is not None:
+            os.umask(old_umask)
+    with listener:
+        log.info(f"Daemon listening on {addr}")
+        while True:
+            try:
+                conn = listener.accept()
+            except (OSError, AuthenticationError, EOFError) as exc:
+                log.warning(f"Failed to accept connection: {exc}")
+                continue
+            with conn:
+                try:
+                    msg = conn.recv()
+                except EOFError:
+                    continue
+                log.debug(f"Daemon got {msg}")
+                try:
+                    reply = _handle(msg)
+                except Exception as exc:
+                    log.exception("Daemon request failed")
+                    reply = {"ok": False, "error": repr(exc)}
+                try:
+                    conn.send(reply)
+                except OSError:
+                    log.warning("Client hung up before we could reply")
+                if reply.get("stopping"):
+                    break
+    from .pipeline import get_pipeline
+    get_pipeline().close()
+    log.info("Daemon stopped")
+
+
+def main(argv=None):
+    """
+    Thin client: python -m screenshotto.daemon [capture|ping|stop]
+    """
+    argv = sys.argv[1:] if argv is None else argv
+    cmd = argv[0] if argv else "capture"
+    try:
+        reply = request(cmd)
+    except (OSError, EOFError) as exc:
+        print(exc, file=sys.stderr)
+        return 2
+    if not reply["ok"]:
+        print(reply["error"], file=sys.stderr)
+        return 1
+    if reply.get("skipped"):
+        print("Screen hasn't changed. Screenshot skipped.")
+    else:
+        print("\n".join(reply.get("paths") or [str(reply)]))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
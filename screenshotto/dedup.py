@@ -0,0 +1,115 @@
+"""
+Skip saving screenshots of a screen that hasn't changed.
+Each frame is shrunk to a small greyscale signature. Every pixel of the
+signature stands for a block of the screen, so comparing signatures is a
+cheap block diff. If fewer than 'dedup_threshold' percent of the blocks
+changed, the frame counts as a duplicate.
+"""
+import os
+
+from .log import get_logger
+
+log = get_logger(__name__)
+
+MODES = ("off", "skip", "link")
+SIGNATURE_SIZE = (128, 72)
+# how much a block's average brightness can wobble before it counts as changed
+BLOCK_TOLERANCE = 8
+
+_deduplicators = {}
+
+
+def get_deduplicator(label=None):
+    """
+    Each monitor / region ('label') is compared with its own last frame.
+    """
+    if label not in _deduplicators:
+        _deduplicators[label] = Deduplicator()
+    return _deduplicators[label]
+
+
+def signature(img):
+    from PIL import Image
+
+    return img.resize(SIGNATURE_SIZE, Image.BOX).convert("L")
+
+
+def changed_percent(sig_a, sig_b):
+    """
+    Percentage of blocks that differ between two signatures.
+    """
+    from PIL import ImageChops
+
+    diff = ImageChops.difference(sig_a, sig_b)
+    changed = diff.point(lambda v: 255 if v > BLOCK_TOLERANCE else 0)
+    return changed.histogram()[255] / (sig_a.size[0] * sig_a.size[1]) * 100
+
+
+
+class Deduplicator:
+    def __init__(self, mode=None, threshold=None):
+        from . import config
+
+        if mode is None:
+            mode = config.data["dedup"]
+        if threshold is None:
+            threshold = config.get_float("dedup_threshold")
+        if mode not in MODES:
+            log.warning(f"Unknown dedup mode '{mode}'. Using 'off'.")
+            mode = "off"
+        self.mode = mode
+        self.threshold = threshold
+        self.last_sig = None
+        self.last_fp = None
+        self.skipped = 0
+
+
+    @property
+    def enabled(self):
+        return self.mode != "off"
+
+
+    def check(self, img):
+        """
+        Compares 'img' to the last kept frame.
+        Returns "new" (nothing to compare to), "changed" or, for a
+        duplicate, the dedup mode ("skip" or "link").
+        """
+        sig = signature(img)
+        if self.last_sig is None or self.last_sig.size != sig.size:
+            self.last_sig = sig
+            return "new"
+        pct = changed_percent(self.last_sig, sig)
+        if pct > self.threshold:
+            self.last_sig = sig
+            return "changed"
+        self.skipped += 1
+        log.debug(f"{pct:.2f}% of the screen changed. Duplicate.")
+        return self.mode
+
+
+    def kept(self, imgfp):
+        """
+        Remember where the last kept frame was saved.
+        """
+        self.last_fp = imgfp
+
+
+    def link(self, imgfp):
+        """
+        Hard link the last kept frame to 'imgfp'.
+        Returns False if that's not possible (e.g. the filesystem doesn't
+        do hard links, the last frame hasn't been written yet, or another
+        process has taken 'imgfp').
+        """
+        from .util import release
+
+        if self.last_fp is None or self.last_fp == imgfp:
+            return False
+        try:
+            os.link(self.last_fp, imgfp)
+        except OSError as exc:
+            log.debug(f"Could not link '{self.last_fp}' to '{imgfp}': {exc}")
+            return False
+        release(imgfp)
+        return True
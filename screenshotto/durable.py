@@ -0,0 +1,200 @@
+"""
+Crash safe saving.
+Images are written to a hidden temporary file in the same directory and
+given the real name when they're complete, so nothing ever sees a half
+written image. The name is only claimed then, and never replaces a file
+that's already there: if another process got there first, the image gets
+' (2)' etc. added. How hard we try to get them onto the disk is the
+'fsync' config option:
+    none    rename straight away and let the OS write it when it likes
+    file    fsync every image, rename it, and fsync its directory
+    batch   fsync every image before it's renamed, but only fsync the
+            directories every 'fsync_batch_files' images or
+            'fsync_batch_secs' seconds, whichever comes first. A crash or
+            power cut can lose the names of images from the last batch,
+            but a name never points at an incomplete file.
+"""
+import atexit
+import os
+import threading
+
+from .log import get_logger
+
+log = get_logger(__name__)
+
+POLICIES = ("none", "file", "batch")
+
+_syncer = None
+_syncer_lock = threading.Lock()
+
+
+def get_syncer():
+    """
+    The shared syncer, set up on first use with the config options.
+    """
+    global _syncer
+    with _syncer_lock:
+        if _syncer is None:
+            _syncer = Syncer()
+        return _syncer
+
+
+def flush():
+    """
+    Sync every image still waiting for a batch sync.
+    """
+    if _syncer is not None:
+        _syncer.flush()
+
+
+def tmp_path(fp):
+    """
+    Hidden name next to 'fp' for writing it. Unique per thread so the
+    encoder threads never share one.
+    """
+    return fp.with_name(f".{fp.name}.{os.getpid()}-"
+                        f"{threading.get_ident()}.tmp")
+
+
+def fsync_path(fp):
+    # windows can only fsync something opened for writing
+    flags = os.O_RDWR if os.name == "nt" else os.O_RDONLY
+    fd = os.open(fp, flags | getattr(os, "O_BINARY", 0))
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def fsync_dir(dirpath):
+    """
+    Makes a rename in 'dirpath' stick. Not possible (or needed) on windows.
+    """
+    if os.name == "nt":
+        return
+    try:
+        fd = os.open(dirpath, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def save(img, fp, profile=None, fmt=None):
+    """
+    Encodes 'img' to 'fp' without ever leaving a partial file there.
+    Returns (the path it ended up at, the number of bytes written).
+    """
+    from .encoders import encode, image_format
+
+    fmt = fmt or image_format(fp)
+    return save_with(fp, lambda f: encode(img, f, profile, fmt))
+
+
+def save_with(fp, write):
+    """
+    Like save(), but 'write(f)' writes the file's contents to f.
+    """
+    from pathlib import Path
+
+    fp = Path(fp)
+    tmp = tmp_path(fp)
+    syncer = get_syncer()
+    try:
+        with open(tmp, "wb") as f:
+            write(f)
+            size = f.tell()
+            if syncer.policy != "none":
+                f.flush()
+                os.fsync(f.fileno())
+        fp = syncer.commit(tmp, fp)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+    return fp, size
+
+
+
+class Syncer:
+    """
+    Puts finished (and, unless the policy is 'none', already fsynced)
+    temporary files in place and gets the renames onto the disk according
+    to the fsync policy.
+    """
+    def __init__(self, policy=None, batch_files=None, batch_secs=None):
+        from . import config
+
+        if policy is None:
+            policy = config.data["fsync"]
+        if batch_files is None:
+            batch_files = config.get_int("fsync_batch_files")
+        if batch_secs is None:
+            batch_secs = config.get_float("fsync_batch_secs")
+        if policy not in POLICIES:
+            log.warning(f"Unknown fsync policy '{policy}'. Using 'file'.")
+            policy = "file"
+        self.policy = policy
+        self.batch_files = max(batch_files, 1)
+        self.batch_secs = max(batch_secs, 0.0)
+        # directories with renames that haven't been synced, and how many
+        self.pending = set()
+        self.pending_files = 0
+        self.synced = 0
+        self._lock = threading.Lock()
+        self._timer = None
+        atexit.register(self.flush)
+
+
+    def commit(self, tmp, fp):
+        """
+        'tmp' is completely written. Give it its real name 'fp', or the
+        first free one after it.
+        Returns the name it got.
+        """
+        from .util import move_free
+
+        fp = move_free(tmp, fp)
+        if self.policy == "none":
+            return fp
+        if self.policy == "file":
+            fsync_dir(fp.parent)
+            self.synced += 1
+            return fp
+        # the contents are on the disk already, only the directory entries
+        # wait for the batch
+        with self._lock:
+            self.pending.add(fp.parent)
+            self.pending_files += 1
+            full = self.pending_files >= self.batch_files
+            if not full and self._timer is None:
+                self._timer = threading.Timer(self.batch_secs, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        if full:
+            self.flush()
+        return fp
+
+
+    def flush(self):
+        """
+        fsync the directories of everything waiting in the batch.
+        """
+        with self._lock:
+            dirs, self.pending = self.pending, set()
+            files, self.pending_files = self.pending_files, 0
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not files:
+                return
+            for dirpath in dirs:
+                fsync_dir(dirpath)
+            self.synced += files
+        log.debug(f"Synced {files} image(s) to disk")
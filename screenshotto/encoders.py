@@ -0,0 +1,116 @@
+"""
+Encoder profiles.
+The image format still comes from the filename's extension. The profile
+decides how hard that format gets compressed.
+"""
+from .log import get_logger
+
+log = get_logger(__name__)
+
+PROFILES = {
+    # no compression at all - recompress later with 'screenshotto compact'
+    "fastest": {
+        "png": {"compress_level": 0},
+        "jpeg": {"quality": 60},
+        "webp": {"quality": 50, "method": 0},
+    },
+    "fast": {
+        "png": {"compress_level": 1},
+        "jpeg": {"quality": 85},
+        "webp": {"quality": 75, "method": 2},
+    },
+    # Pillow's defaults
+    "balanced": {
+        "png": {"compress_level": 6},
+        "jpeg": {"quality": 75},
+        "webp": {"quality": 80, "method": 4},
+    },
+    "small": {
+        "png": {"compress_level": 9, "optimize": True},
+        "jpeg": {"quality": 85, "optimize": True, "progressive": True},
+        "webp": {"lossless": True, "quality": 100, "method": 6},
+    },
+}
+# 'custom' takes its settings from the individual config options
+PROFILE_NAMES = tuple(PROFILES) + ("custom",)
+
+
+def custom_profile():
+    from . import config
+
+    return {
+        "png": {"compress_level": config.get_int("png_compress_level"),
+                "optimize": config.get_bool("png_optimize")},
+        "jpeg": {"quality": config.get_int("jpeg_quality"),
+                 "optimize": config.get_bool("jpeg_optimize")},
+        "webp": {"quality": config.get_int("webp_quality"),
+                 "lossless": config.get_bool("webp_lossless"),
+                 "method": config.get_int("webp_method")},
+    }
+
+
+def image_format(fp):
+    """
+    Pillow's name for the format of 'fp', based on its extension.
+    e.g. 'PNG', 'JPEG', 'WEBP'
+    """
+    import os
+    from PIL import Image
+
+    ext = os.path.splitext(str(fp))[1].lower()
+    Image.init()
+    try:
+        return Image.EXTENSION[ext]
+    except KeyError:
+        raise ValueError(f"Don't know what image format '{ext}' is. "
+                         "Check the filename option in the config file.")
+
+
+def save_options(fmt, profile=None):
+    """
+    Keyword arguments for PIL.Image.save() for format 'fmt' ('PNG' etc.)
+    with the given (or configured) encoder profile.
+    """
+    from . import config
+
+    profile = profile or config.data["encoder_profile"]
+    if profile == "custom":
+        options = custom_profile()
+    else:
+        try:
+            options = PROFILES[profile]
+        except KeyError:
+            log.warning(f"Unknown encoder_profile '{profile}'. "
+                        "Using 'balanced'.")
+            options = PROFILES["balanced"]
+    return dict(options.get(fmt.lower(), {}))
+
+
+def stream_rows():
+    """
+    Rows per band for the streaming PNG encoder, or 0 to use Pillow's.
+    """
+    from . import config
+
+    return max(config.get_int("png_stream_rows"), 0)
+
+
+def encode(img, fp, profile=None, fmt=None):
+    """
+    Saves 'img' to 'fp' (a path or file object) with an encoder profile.
+    """
+    from .pngstream import MODES
+
+    fmt = fmt or image_format(fp)
+    options = save_options(fmt, profile)
+    rows = stream_rows()
+    if fmt == "PNG" and rows and img.mode in MODES:
+        from .pngstream import encode_image
+        level = options.get("compress_level", 6)
+        if hasattr(fp, "write"):
+            encode_image(img, fp, rows, level)
+        else:
+            with open(fp, "wb") as f:
+                encode_image(img, f, rows, level)
+        return
+    img.save(fp, format=fmt, **options)
@@ -0,0 +1,184 @@
+"""
+Structured log of every capture.
+One JSON object per line, appended to 'event_log':
+    t           unix time of the capture
+    w, h        size of the captured image
+    monitors    [left, top, right, bottom] of each monitor
+    target      which monitor ('m1', ...) or region (absent for the
+                whole desktop)
+    rect        [left, top, right, bottom] of what was grabbed, if it
+                wasn't the whole desktop
+    capture_ms  time spent grabbing the screen
+    encode_ms   time spent encoding and writing (absent when not saved)
+    bytes       size of the file written
+    path        where it went
+    dedup       new / changed / skip / link, or off
+    output      which extra output this copy was for (absent for the
+                main one). These share the capture with the main event.
+Every INDEX_EVERY events (and at the start of each run) the time and file
+offset of the event are added to a small binary index next to it, so
+reading from a point in time doesn't have to start at the beginning.
+"""
+import json
+import os
+import struct
+import threading
+from bisect import bisect_right
+from pathlib import Path
+from time import time
+
+from .log import get_logger
+
+log = get_logger(__name__)
+
+INDEX = struct.Struct("<dQ")        # timestamp, offset
+INDEX_EVERY = 1000
+
+_event_log = None
+_lock = threading.Lock()
+
+
+def event_log_path():
+    import appdirs
+    from . import config
+    from .__init__ import APPNAME
+
+    path = config.data["event_log"]
+    if not path:
+        path = os.path.join(appdirs.user_data_dir(APPNAME, False),
+                            "events.jsonl")
+    return Path(path)
+
+
+def index_path(path):
+    return Path(str(path) + ".idx")
+
+
+def new_event(img, capture_secs, backend=None):
+    """
+    Starts an event for a frame that was just captured.
+    """
+    event = {"t": round(time(), 3), "w": img.size[0], "h": img.size[1],
+             "capture_ms": round(capture_secs * 1000, 3)}
+    if backend is not None:
+        event["monitors"] = [list(r) for r in backend.monitors()]
+    return event
+
+
+def record(event):
+    """
+    Appends 'event' to the event log, if it's turned on, and catalogs the
+    file it was saved to.
+    Safe to call from the encoder threads.
+    """
+    global _event_log
+    from . import catalog, config
+
+    catalog.added(event)
+    if not config.get_bool("events"):
+        return
+    with _lock:
+        if _event_log is None:
+            _event_log = EventLog(event_log_path())
+        _event_log.write(event)
+
+
+
+class EventLog:
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.f = open(self.path, "ab")
+        self.idx = open(index_path(self.path), "ab")
+        self.count = 0
+
+
+    def write(self, event):
+        line = json.dumps(event, separators=(",", ":")).encode() + b"\n"
+        if self.count % INDEX_EVERY == 0:
+            self.idx.write(INDEX.pack(event["t"], self.f.tell()))
+            self.idx.flush()
+        self.f.write(line)
+        self.f.flush()
+        self.count += 1
+
+
+    def close(self):
+        self.f.close()
+        self.idx.close()
+
+
+
+def start_offset(path, start):
+    """
+    File offset to start reading from to find every event from 'start' on.
+    """
+    try:
+        data = index_path(path).read_bytes()
+    except FileNotFoundError:
+        return 0
+    entries = [INDEX.unpack_from(data, i)
+               for i in range(0, len(data) - len(data) % INDEX.size,
+                              INDEX.size)]
+    # encoder threads can finish a little out of order, so start one index
+    # entry earlier than strictly needed
+    i = bisect_right([t for t, _ in entries], start) - 2
+    return entries[i][1] if i >= 0 else 0
+
+
+def iter_events(path, start=None, end=None):
+    """
+    Streams events between 'start' and 'end' (unix times) from the file.
+    """
+    with open(path, "rb") as f:
+        if start is not None:
+            f.seek(start_offset(path, start))
+        for line in f:
+            try:
+                event = json.loads(line)
+            except ValueError:
+                # half written line from a crash
+                continue
+            t = event.get("t", 0)
+            if start is not None and t < start:
+                continue
+            if end is not None and t > end:
+                # allow for a little disorder before giving up
+                if t > end + 60:
+                    break
+                continue
+            yield event
+
+
+def aggregate(events):
+    """
+    Summary stats over any number of events without keeping them around.
+    """
+    from .bench import Histogram
+
+    stats = {"events": 0, "saved": 0, "bytes": 0, "first": None,
+             "last": None, "dedup": {},
+             "capture_ms": Histogram(), "encode_ms": Histogram()}
+    for event in events:
+        if "output" in event:
+            # another copy of a capture that's already counted
+            if "encode_ms" in event:
+                stats["saved"] += 1
+                stats["bytes"] += event.get("bytes", 0)
+                stats["encode_ms"].add(event["encode_ms"])
+            continue
+        stats["events"] += 1
+        t = event.get("t")
+        if stats["first"] is None or t < stats["first"]:
+            stats["first"] = t
+        if stats["last"] is None or t > stats["last"]:
+            stats["last"] = t
+        dedup = event.get("dedup", "off")
+        stats["dedup"][dedup] = stats["dedup"].get(dedup, 0) + 1
+        if "capture_ms" in event:
+            stats["capture_ms"].add(event["capture_ms"])
+        if "encode_ms" in event:
+            stats["saved"] += 1
+            stats["bytes"] += event.get("bytes", 0)
+            stats["encode_ms"].add(event["encode_ms"])
+    return stats
@@ -1,28 +1,43 @@
 import sys
-from logging import (Formatter, getLogger, StreamHandler, Filter,
-                     INFO, DEBUG)
-from logging.handlers import RotatingFileHandler, MemoryHandler
+from logging import (Formatter, getLogger, Handler, StreamHandler, Filter,
+                     makeLogRecord, INFO, DEBUG, WARNING)
+from logging.handlers import (RotatingFileHandler, MemoryHandler,
+                              QueueHandler, QueueListener)
 import os
-import inspect
+import atexit
+import copy
+import queue
+from collections import deque
 from textwrap import indent, fill
 from pathlib import Path
 import re
 
 
-def modulename():
+# Every logger in the package is a child of this one, so handlers only need
+# adding here.
+ROOT = __name__.split(".")[0]
+
+_loggers = {}
+
+
+def get_logger(name=ROOT):
     """
-    'module.child.grandchild'
+    Cached logger for module 'name' - pass __name__.
+    Names from outside the package (e.g. '__main__' or the script) are put
+    under ROOT so their messages go to the same place.
     """
-    modlist = [x for x in inspect.stack() if x[3] == "<module>"][::-1]
-    modnames = []
-    for i, _ in enumerate(modlist):
-        modname = inspect.getmodulename(modlist[i][1])
-        if modname:
-            modnames.append(modname)
-    return ".".join(modnames)
+    try:
+        return _loggers[name]
+    except KeyError:
+        pass
+    fullname = name
+    if name != ROOT and not name.startswith(ROOT + "."):
+        fullname = f"{ROOT}.{name.rsplit('.', 1)[-1]}"
+    logger = _loggers[name] = getLogger(fullname)
+    return logger
 
 
-log = getLogger(modulename())
+log = get_logger(__name__)
 
 class DuplicateFilter(Filter):
 # https://stackoverflow.com/a/44692178
@@ -62,38 +77,221 @@ class StripANSIFormatter(Formatter):
 
 
 class BufferDebugHandler(MemoryHandler):
+    """
+    Holds on to records until set_debug() decides whether we're showing
+    debug messages, then writes the ones that should be seen to the
+    target's stream in one go.
+    The buffer is a ring: past max_records records or max_bytes of
+    message text, the oldest are dropped (and counted in self.dropped).
+    Only what's needed to print a record is kept, not the whole LogRecord.
+    """
+    def __init__(self, capacity, flushLevel=INFO, target=None,
+                 max_records=5000, max_bytes=1048576):
+        super().__init__(capacity, flushLevel, target)
+        self.buffer = deque()
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.buffered_bytes = 0
+        self.dropped = 0
+
+
     def shouldFlush(self, record):
         return (len(self.buffer) >= self.capacity)
 
 
+    def emit(self, record):
+        exc_text = record.exc_text
+        if record.exc_info and not exc_text:
+            exc_text = Formatter().formatException(record.exc_info)
+        msg = record.getMessage()
+        self.buffer.append((record.levelno, record.levelname, record.name,
+                            msg, exc_text))
+        self.buffered_bytes += len(msg) + len(exc_text or "")
+        self.trim()
+        if self.shouldFlush(record):
+            self.flush()
+
+
+    def trim(self):
+        """
+        Drop the oldest records until we're within the limits.
+        """
+        while self.buffer and (len(self.buffer) > self.max_records
+                               or self.buffered_bytes > self.max_bytes):
+            _, _, _, old_msg, old_exc = self.buffer.popleft()
+            self.buffered_bytes -= len(old_msg) + len(old_exc or "")
+            self.dropped += 1
+
+
     def flush(self):
         self.acquire()
         try:
-            if self.target:
-                for record in self.buffer:
-                    if record.levelno >= self.flushLevel:
-                        self.target.stream = sys.stderr
-                        self.target.handle(record)
-                self.buffer = []
+            if self.target and self.buffer:
+                # stderr can be swapped out under us by attach_console()
+                stream = self.target.stream = sys.stderr
+                minlevel = max(self.flushLevel, self.target.level)
+                lines = []
+                for levelno, levelname, name, msg, exc_text in self.buffer:
+                    if levelno >= minlevel:
+                        record = makeLogRecord({
+                            "levelno": levelno, "levelname": levelname,
+                            "name": name, "msg": msg, "exc_text": exc_text})
+                        lines.append(self.target.format(record)
+                                     + self.target.terminator)
+                if stream is not None and lines:
+                    stream.write("".join(lines))
+                    stream.flush()
+                self.buffer.clear()
+                self.buffered_bytes = 0
         finally:
             self.release()
 
 
 
+class BackgroundQueueHandler(QueueHandler):
+    """
+    Hands records to a QueueListener thread which does the formatting,
+    ANSI stripping, writing and rotating, so a slow disk doesn't hold up
+    whoever is logging.
+    With policy 'drop', records below WARNING are thrown away (and
+    counted) when the queue is full instead of waiting for room.
+    """
+    policies = ("block", "drop")
+
+    def __init__(self, log_queue, policy="block"):
+        super().__init__(log_queue)
+        self.policy = policy
+        self.dropped = 0
+        self.listener = None
+
+
+    def prepare(self, record):
+        # Only the message has to be worked out now, while its args are
+        # still what they were. Everything else happens on the listener's
+        # thread. Copied because other handlers get the same record.
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+    def enqueue(self, record):
+        if self.policy == "drop" and record.levelno < WARNING:
+            try:
+                self.queue.put_nowait(record)
+            except queue.Full:
+                self.dropped += 1
+            return
+        self.queue.put(record)
+
+
+    def flush(self):
+        """
+        Wait until the listener has written everything queued so far.
+        """
+        if self.listener and self.listener._thread:
+            self.queue.join()
+
+
+
+class ForwardHandler(Handler):
+    """
+    Hands records that came from another process to our own loggers, so
+    they go wherever ours go.
+    """
+    def emit(self, record):
+        logger = getLogger(record.name)
+        if logger.isEnabledFor(record.levelno):
+            logger.handle(record)
+
+
+
+def listen_to_processes(log_queue):
+    """
+    Starts writing what child processes send through 'log_queue'
+    (a multiprocessing.Queue, see log_to_queue()). Returns the listener
+    to stop() when they're done.
+    """
+    listener = QueueListener(log_queue, ForwardHandler())
+    listener.start()
+    return listener
+
+
+def log_to_queue(log_queue):
+    """
+    In a child process: send every record to the parent through
+    'log_queue' instead of the handlers inherited from it, whose writer
+    threads don't exist here.
+    """
+    log = get_logger()
+    for handler in list(log.handlers):
+        log.removeHandler(handler)
+    log.addHandler(QueueHandler(log_queue))
+    log.setLevel(DEBUG)
+
+
+def flush_log(logger):
+    """
+    Make sure everything logged so far has actually been written.
+    """
+    for handler in logger.handlers:
+        handler.flush()
+
+
+def set_log_queue(logger, maxsize=None, policy=None):
+    """
+    Change the size and full-queue policy of the background log writer.
+    """
+    for handler in logger.handlers:
+        if isinstance(handler, BackgroundQueueHandler):
+            if maxsize is not None:
+                handler.queue.maxsize = maxsize
+            if policy is not None:
+                if policy not in handler.policies:
+                    logger.warning(f"Unknown log queue policy '{policy}'. "
+                                   "Using 'block'.")
+                    policy = "block"
+                handler.policy = policy
+
+
+def set_debug_buffer(logger, max_records=None, max_bytes=None):
+    """
+    Change how much the console's debug buffer holds before set_debug().
+    """
+    for handler in logger.handlers:
+        if isinstance(handler, BufferDebugHandler):
+            handler.acquire()
+            try:
+                if max_records is not None:
+                    handler.max_records = max(max_records, 1)
+                if max_bytes is not None:
+                    handler.max_bytes = max(max_bytes, 1)
+                handler.trim()
+            finally:
+                handler.release()
+
+
 def handle_exception(logger, exc_type, exc_value, exc_trace):
     if issubclass(exc_type, KeyboardInterrupt):
         sys.__excepthook__(exc_type, exc_value, exc_trace)
         return
     logger.error("Uncaught exception",
                  exc_info=(exc_type, exc_value, exc_trace))
+    # we're about to die, the log file is the only record of why
+    flush_log(logger)
 
 
-def logger_setup(output_dir, script_fn):
+def logger_setup(output_dir, script_fn, queue_size=10000, policy="block",
+                 debug_buffer_records=5000, debug_buffer_bytes=1048576):
     """ Set up logging. getlogger, add handlers, formatters, etc.
     script_fn should probably be __file__.
+    The log file is written on a background thread, see
+    BackgroundQueueHandler for queue_size and policy.
+    Console messages are held until set_debug(), in a buffer capped at
+    debug_buffer_records messages / debug_buffer_bytes of text.
     returns logger
     """
-    log = getLogger(modulename())
+    log = get_logger()
     log.setLevel(DEBUG)
     logfn = os.path.basename(script_fn).rsplit('.', 1)[0]
     logfp = os.path.join(output_dir, "{}.log".format(logfn))
@@ -108,7 +306,12 @@ def logger_setup(output_dir, script_fn):
     conhandler.setFormatter(conformat)
     #log.addHandler(conhandler)
 
-    memhandler = BufferDebugHandler(999999, flushLevel=INFO, target=conhandler)
+    # capacity only matters once set_debug() drops it to 1 - until then the
+    # ring buffer caps how much is held
+    memhandler = BufferDebugHandler(sys.maxsize, flushLevel=INFO,
+                                    target=conhandler,
+                                    max_records=debug_buffer_records,
+                                    max_bytes=debug_buffer_bytes)
     log.addHandler(memhandler)
 
     filehandler = RotatingFileHandler(logfp,
@@ -121,8 +324,16 @@ def logger_setup(output_dir, script_fn):
                                     "%(name)-25s:\t"
                                     "%(message)s\n")
     filehandler.setFormatter(fileformat)
-    # Filehandler needs to be added last so its custom formatter will work?
-    log.addHandler(filehandler)
+
+    queuehandler = BackgroundQueueHandler(queue.Queue(queue_size), policy)
+    queuehandler.setLevel(DEBUG)
+    listener = QueueListener(queuehandler.queue, filehandler,
+                             respect_handler_level=True)
+    queuehandler.listener = listener
+    listener.start()
+    # drain the queue before logging.shutdown() closes the file
+    atexit.register(listener.stop)
+    log.addHandler(queuehandler)
     log.logfp = logfp
 
     log.addFilter(DuplicateFilter())
@@ -0,0 +1,180 @@
+"""
+Extra outputs: every capture saved again somewhere else, e.g. a small
+jpeg for a dashboard and a thumbnail, as well as the full size original.
+They're defined by [output NAME] sections in the config file, each with
+its own directory, filename (whose extension picks the format), scale
+and encoder profile.
+All of them come from the one capture. Each size is only made once, and
+from the smallest image already made that's big enough, so a thumbnail
+is shrunk from the dashboard copy rather than from the whole desktop.
+The encoding of every output is queued on the encoder pipeline, so they
+all happen at the same time.
+"""
+from .log import get_logger
+
+log = get_logger(__name__)
+
+_outputs = None
+
+
+def parse_scale(s, size):
+    """
+    Size to scale an image of 'size' to, or None to leave it alone.
+    's' is a fraction ('0.5') or a box to fit inside ('320x180', '640x').
+    """
+    w, h = size
+    s = s.strip().lower()
+    if "x" in s:
+        bw, _, bh = s.partition("x")
+        factor = min(int(bw) / w if bw else 1.0, int(bh) / h if bh else 1.0)
+    else:
+        factor = float(s)
+    assert factor > 0, f"scale '{s}' has to be more than 0"
+    if factor >= 1:
+        return None
+    return max(round(w * factor), 1), max(round(h * factor), 1)
+
+
+def get_outputs():
+    """
+    [(name, options)] for the outputs in the config file, checked once.
+    """
+    global _outputs
+    if _outputs is None:
+        import os
+        from . import config
+        from .encoders import PROFILE_NAMES, image_format
+        from .util import compile_filename
+
+        img_dir = os.path.abspath(config.data["img_dir"])
+        main_ext = os.path.splitext(config.data["filename"])[1].lower()
+        _outputs = []
+        for name, options in config.outputs.items():
+            try:
+                compile_filename(options["filename"],
+                                 config.data["strftime"])
+                image_format(options["filename"])
+                parse_scale(options["scale"], (1000, 1000))
+            except (ValueError, AssertionError) as exc:
+                log.warning(f"Ignoring output '{name}': {exc}")
+                continue
+            ext = os.path.splitext(options["filename"])[1].lower()
+            if ((not options["dir"]
+                 or os.path.abspath(options["dir"]) == img_dir)
+                    and ext == main_ext):
+                # its copies couldn't be told apart from the screenshots
+                log.warning(f"Ignoring output '{name}': it needs a dir of "
+                            "its own or a different file type from the "
+                            "main screenshots")
+                continue
+            profile = options["encoder_profile"] or None
+            if profile and profile not in PROFILE_NAMES:
+                log.warning(f"Unknown encoder_profile '{profile}' for "
+                            f"output '{name}'. Using the usual one.")
+                options["encoder_profile"] = ""
+            _outputs.append((name, options))
+    return _outputs
+
+
+def output_dirs(img_dir):
+    """
+    {directory: output name} for extra outputs with a directory of their
+    own, i.e. not img_dir.
+    """
+    import os
+    from . import config
+
+    img_dir = os.path.abspath(img_dir)
+    dirs = {}
+    for name, options in config.outputs.items():
+        if options["dir"] and os.path.abspath(options["dir"]) != img_dir:
+            dirs.setdefault(os.path.abspath(options["dir"]), name)
+    return dirs
+
+
+def shared_exts(img_dir):
+    """
+    {extension: output name} for extra outputs saved in img_dir alongside
+    the main screenshots, where their extension tells them apart.
+    """
+    import os
+    from . import config
+
+    img_dir = os.path.abspath(img_dir)
+    main_ext = os.path.splitext(config.data["filename"])[1].lower()
+    exts = {}
+    for name, options in config.outputs.items():
+        if options["dir"] and os.path.abspath(options["dir"]) != img_dir:
+            continue
+        ext = os.path.splitext(options["filename"])[1].lower()
+        if ext != main_ext:
+            exts.setdefault(ext, name)
+    return exts
+
+
+
+class Variants:
+    """
+    Scaled copies of one captured image, each made at most once.
+    """
+    def __init__(self, img):
+        self.images = {img.size: img}
+
+
+    def get(self, size):
+        from PIL import Image
+
+        if size is None:
+            size = max(self.images)
+        if size not in self.images:
+            # the smallest one we've got that's still at least as big
+            source = min((s for s in self.images
+                          if s[0] >= size[0] and s[1] >= size[1]),
+                         key=lambda s: s[0] * s[1])
+            self.images[size] = self.images[source].resize(size,
+                                                           Image.LANCZOS)
+        return self.images[size]
+
+
+
+def fan_out(img, dt, event, label=None, link=False, seq=None):
+    """
+    Queues 'img' to be saved to every extra output, as capture number
+    'seq'.
+    'link' is True if the screen hasn't changed, in which case outputs
+    hard link their last image where they can, like the main one.
+    Returns the paths.
+    """
+    from .dedup import get_deduplicator
+    from .pipeline import get_pipeline
+    from .util import allocate_fp, image_fp, target_fp
+
+    outputs = get_outputs()
+    if not outputs:
+        return []
+    # biggest first, so smaller copies can be made from bigger ones
+    sized = sorted(((parse_scale(options["scale"], img.size), name, options)
+                    for name, options in outputs),
+                   key=lambda x: -(x[0][0] * x[0][1]) if x[0] else -1e18)
+    variants = Variants(img)
+    pipeline = get_pipeline()
+    paths = []
+    for size, name, options in sized:
+        imgfp = allocate_fp(
+            dt, lambda dt, seq: target_fp(image_fp(dt, seq, options), label),
+            options["filename"], seq)
+        copy_event = dict(event, output=name)
+        dedup = get_deduplicator((label, name))
+        if link and dedup.link(imgfp):
+            from . import events, retention
+            retention.added(imgfp, 0)
+            copy_event["path"] = str(imgfp)
+            events.record(copy_event)
+        else:
+            dedup.kept(imgfp)
+            out = variants.get(size)
+            copy_event["w"], copy_event["h"] = out.size
+            pipeline.submit(out, imgfp, copy_event,
+                            options["encoder_profile"] or None)
+        paths.append(imgfp)
+    return paths
@@ -0,0 +1,184 @@
+"""
+Background encode/save workers.
+Capturing is quick, compressing a multi-monitor PNG is not. The capture
+side drops frames into a bounded queue and a pool of threads encodes and
+writes them. Pillow releases the GIL for most of the zlib work so the
+threads really do run in parallel.
+"""
+import atexit
+import queue
+import threading
+from collections import deque
+from time import perf_counter
+
+from .log import get_logger
+
+log = get_logger(__name__)
+
+POLICIES = ("block", "drop_newest", "drop_oldest")
+
+_pipeline = None
+
+
+def get_pipeline():
+    """
+    The shared pipeline, started on first use with the config options.
+    """
+    global _pipeline
+    if _pipeline is None:
+        _pipeline = new_pipeline()
+    return _pipeline
+
+
+def new_pipeline():
+    """
+    Encoder threads, or processes if 'encoder_processes' is set.
+    """
+    from . import config
+
+    if config.get_int("encoder_processes") > 0:
+        from .shmring import ProcessPipeline
+        return ProcessPipeline()
+    return SavePipeline()
+
+
+
+def give_back(imgfp):
+    """
+    A frame for 'imgfp' was dropped.
+    """
+    from .util import release
+
+    log.warning(f"Encoder queue full. Dropped frame for '{imgfp}'")
+    release(imgfp)
+
+
+
+class SavePipeline:
+    """
+    When the queue is full, 'policy' decides what happens to a new frame:
+    'block' waits for room, 'drop_newest' throws the new frame away,
+    'drop_oldest' throws away the oldest queued frame to make room.
+    Everything still queued is written out at exit.
+    """
+    def __init__(self, workers=None, maxsize=None, policy=None):
+        from . import config
+
+        if workers is None:
+            workers = config.get_int("encoder_workers")
+        if maxsize is None:
+            maxsize = config.get_int("queue_size")
+        if policy is None:
+            policy = config.data["queue_policy"]
+        if policy not in POLICIES:
+            log.warning(f"Unknown queue_policy '{policy}'. Using 'block'.")
+            policy = "block"
+        self.policy = policy
+        self.queue = queue.Queue(max(maxsize, 1))
+        self.dropped = 0
+        self.saved = 0
+        self.failed = 0
+        # seconds each frame took to encode and write, most recent last
+        self.encode_times = deque(maxlen=100000)
+        self._lock = threading.Lock()
+        self._threads = []
+        for i in range(max(workers, 1)):
+            t = threading.Thread(target=self._work, name=f"encoder-{i}",
+                                 daemon=True)
+            t.start()
+            self._threads.append(t)
+        self._closed = False
+        atexit.register(self.close)
+        log.debug(f"Started {len(self._threads)} encoder thread(s), "
+                  f"queue of {self.queue.maxsize}, policy '{policy}'")
+
+
+    def submit(self, img, imgfp, event=None, profile=None):
+        """
+        Queue 'img' to be saved to 'imgfp' (with encoder 'profile').
+        Returns False if the frame was dropped.
+        """
+        assert not self._closed, "Pipeline is closed"
+        item = (img, imgfp, event, profile)
+        if self.policy == "block":
+            self.queue.put(item)
+            return True
+        try:
+            self.queue.put_nowait(item)
+            return True
+        except queue.Full:
+            pass
+        if self.policy == "drop_newest":
+            self._drop(imgfp)
+            return False
+        # drop_oldest
+        while True:
+            try:
+                _, oldfp, _, _ = self.queue.get_nowait()
+                self.queue.task_done()
+                self._drop(oldfp)
+            except queue.Empty:
+                pass
+            try:
+                self.queue.put_nowait(item)
+                return True
+            except queue.Full:
+                continue
+
+
+    def _drop(self, imgfp):
+        with self._lock:
+            self.dropped += 1
+        give_back(imgfp)
+
+
+    def _work(self):
+        from .util import write_frame
+
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                img, imgfp, event, profile = item
+                t0 = perf_counter()
+                write_frame(img, imgfp, event, profile)
+                self.encode_times.append(perf_counter() - t0)
+                with self._lock:
+                    self.saved += 1
+            except Exception:
+                log.exception(f"Failed to save '{item[1]}'")
+                with self._lock:
+                    self.failed += 1
+            finally:
+                self.queue.task_done()
+
+
+    def flush(self):
+        """
+        Wait until everything queued so far has been written.
+        """
+        self.queue.join()
+
+
+    def close(self):
+        """
+        Write out everything still queued and stop the workers.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        pending = self.queue.qsize()
+        if pending:
+            log.info(f"Saving {pending} queued screenshot(s) before exit")
+        for _ in self._threads:
+            self.queue.put(None)
+        for t in self._threads:
+            t.join()
+        # atexit runs this after the syncer's own flush
+        from . import catalog
+        from .durable import flush
+        flush()
+        catalog.close()
+        log.debug(f"Encoder pipeline closed. {self.saved} saved, "
+                  f"{self.dropped} dropped, {self.failed} failed")
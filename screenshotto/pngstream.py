@@ -0,0 +1,128 @@
+"""
+PNG encoder that works through a frame a band of rows at a time.
+Pillow needs the whole image in its own memory to save it. This takes a
+NumPy array (e.g. a view of a shared memory frame slot) or a PIL image and
+filters and compresses 'rows' rows at a time, so on top of the frame
+itself it only ever holds a few bands and zlib's buffers. It's enabled by
+the 'png_stream_rows' config option.
+
+Each row gets the PNG filter (none, sub or up) with the smallest sum of
+absolute values, which is the usual heuristic and close to what Pillow
+picks for screenshots.
+"""
+import struct
+import zlib
+
+SIGNATURE = b"\x89PNG\r\n\x1a\n"
+COLOR_TYPES = {1: 0, 3: 2, 4: 6}    # channels -> PNG colour type
+MODES = {"L": 1, "RGB": 3, "RGBA": 4}
+CHUNK_SIZE = 1 << 16
+
+
+def chunk(kind, data):
+    return (struct.pack(">I", len(data)) + kind + data
+            + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff))
+
+
+def array_bands(arr, rows):
+    """
+    Views of 'rows' rows at a time of an HxWxC array. No copies.
+    """
+    for y in range(0, arr.shape[0], rows):
+        yield arr[y:y + rows]
+
+
+def image_bands(img, rows):
+    """
+    'rows' rows at a time of a PIL image, as HxWxC arrays.
+    """
+    import numpy as np
+
+    w, h = img.size
+    for y in range(0, h, rows):
+        band = np.asarray(img.crop((0, y, w, min(y + rows, h))))
+        if band.ndim == 2:
+            band = band[:, :, None]
+        yield band
+
+
+def filter_band(band, prev, bpp):
+    """
+    PNG filters 'band' (rows x bytes, uint8), given the row before it.
+    Returns rows x (1 + bytes): each row's filter type, then its data.
+    """
+    import numpy as np
+
+    n, width = band.shape
+    out = np.empty((n, width + 1), np.uint8)
+    # sub: each byte minus the one a pixel to the left
+    sub = band.copy()
+    sub[:, bpp:] -= band[:, :-bpp]
+    # up: each byte minus the one above
+    above = np.empty_like(band)
+    above[0] = prev
+    above[1:] = band[:-1]
+    up = band - above
+    candidates = (band, sub, up)
+    costs = np.stack([np.abs(c.view(np.int8).astype(np.int16)).sum(axis=1)
+                      for c in candidates])
+    best = costs.argmin(axis=0)
+    out[:, 0] = best
+    for kind, filtered in enumerate(candidates):
+        rows = best == kind
+        out[rows, 1:] = filtered[rows]
+    return out
+
+
+def write_png(f, bands, width, height, channels=3, level=6):
+    """
+    Writes a PNG to file object 'f' from an iterable of HxWxC uint8 bands.
+    Returns the number of bytes written.
+    """
+    import numpy as np
+
+    written = f.write(SIGNATURE)
+    ihdr = struct.pack(">IIBBBBB", width, height, 8, COLOR_TYPES[channels],
+                       0, 0, 0)
+    written += f.write(chunk(b"IHDR", ihdr))
+    compressor = zlib.compressobj(level)
+    prev = np.zeros(width * channels, np.uint8)
+    pending = []
+    pending_bytes = 0
+    for band in bands:
+        band = np.ascontiguousarray(band).reshape(band.shape[0], -1)
+        if level == 0:
+            # stored, not compressed - filtering wouldn't gain anything
+            rows = np.zeros((band.shape[0], band.shape[1] + 1), np.uint8)
+            rows[:, 1:] = band
+        else:
+            rows = filter_band(band, prev, channels)
+        prev = band[-1].copy()
+        data = compressor.compress(rows.tobytes())
+        if data:
+            pending.append(data)
+            pending_bytes += len(data)
+        if pending_bytes >= CHUNK_SIZE:
+            written += f.write(chunk(b"IDAT", b"".join(pending)))
+            pending, pending_bytes = [], 0
+    pending.append(compressor.flush())
+    written += f.write(chunk(b"IDAT", b"".join(pending)))
+    written += f.write(chunk(b"IEND", b""))
+    return written
+
+
+def encode_array(arr, f, rows=64, level=6):
+    """
+    Streams an HxWxC array (C = 1, 3 or 4) to 'f' as a PNG.
+    """
+    h, w, c = arr.shape
+    return write_png(f, array_bands(arr, rows), w, h, c, level)
+
+
+def encode_image(img, f, rows=64, level=6):
+    """
+    Streams a PIL image to 'f' as a PNG.
+    Only L, RGB and RGBA. Anything else should go through Pillow.
+    """
+    w, h = img.size
+    return write_png(f, image_bands(img, rows), w, h, MODES[img.mode], level)
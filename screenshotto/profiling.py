@@ -0,0 +1,236 @@
+"""
+Timing spans and profilers.
+Stages of a capture are wrapped in span("name"). Every finished span is
+passed to each registered sink:
+    LogSink         a debug message per span
+    JSONSink        a JSON line per span, appended to a file
+    HistogramSink   percentiles per span name, kept in memory
+With no sinks registered a span costs next to nothing.
+The 'trace_sinks' config option picks sinks for normal runs, and --profile
+on the command line adds a histogram plus a cProfile or sampling report.
+"""
+import json
+import sys
+import threading
+from contextlib import contextmanager
+from time import perf_counter, time
+
+from .log import get_logger
+
+log = get_logger(__name__)
+
+_sinks = []
+_configured = False
+
+
+def add_sink(sink):
+    _sinks.append(sink)
+    return sink
+
+
+def remove_sink(sink):
+    _sinks.remove(sink)
+
+
+@contextmanager
+def span(name):
+    if not _sinks:
+        yield
+        return
+    t0 = perf_counter()
+    try:
+        yield
+    finally:
+        secs = perf_counter() - t0
+        for sink in _sinks:
+            sink.record(name, secs)
+
+
+def configure():
+    """
+    Registers the sinks named in the config file, once per process.
+    """
+    global _configured
+    if _configured:
+        return
+    _configured = True
+    from . import config
+
+    names = [x.strip() for x in config.data["trace_sinks"].split(",")]
+    for name in filter(None, names):
+        if name == "log":
+            add_sink(LogSink())
+        elif name == "json":
+            add_sink(JSONSink(config.data["trace_file"]))
+        elif name == "histogram":
+            add_sink(HistogramSink())
+        else:
+            log.warning(f"Unknown trace sink '{name}'")
+
+
+
+class LogSink:
+    def record(self, name, secs):
+        log.debug(f"{name} took {secs * 1000:.2f} ms")
+
+
+
+class JSONSink:
+    def __init__(self, path):
+        from pathlib import Path
+
+        assert path, "trace_file needs to be set to use the json trace sink"
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.f = open(path, "a", encoding="utf-8")
+        self._lock = threading.Lock()
+
+
+    def record(self, name, secs):
+        line = json.dumps({"t": round(time(), 6), "span": name,
+                           "ms": round(secs * 1000, 3),
+                           "thread": threading.current_thread().name})
+        with self._lock:
+            self.f.write(line + "\n")
+            self.f.flush()
+
+
+
+class HistogramSink:
+    def __init__(self):
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+
+    def record(self, name, secs):
+        from .bench import Histogram
+
+        with self._lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].add(secs * 1000)
+
+
+    def report(self):
+        return [f"{self.histograms[name].summary(name)}   "
+                f"n {self.histograms[name].count}"
+                for name in sorted(self.histograms)]
+
+
+
+class Sampler:
+    """
+    Samples the stack of every thread every 'interval' seconds.
+    The result is in the 'folded' format flame graph tools (flamegraph.pl,
+    speedscope, ...) read: one line per unique stack, frames separated by
+    semicolons, then the number of samples.
+    """
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = {}
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="sampler",
+                                        daemon=True)
+
+
+    def start(self):
+        self._thread.start()
+
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+
+    def _run(self):
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} "
+                                 f"({code.co_filename}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                key = ";".join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.samples += 1
+
+
+    def folded(self):
+        return "".join(f"{stack} {count}\n"
+                       for stack, count in sorted(self.stacks.items()))
+
+
+    def top(self, n=20):
+        """
+        Functions that were on top of the stack the most.
+        """
+        leaves = {}
+        for stack, count in self.stacks.items():
+            leaf = stack.rsplit(";", 1)[-1]
+            leaves[leaf] = leaves.get(leaf, 0) + count
+        total = sum(leaves.values()) or 1
+        ranked = sorted(leaves.items(), key=lambda x: -x[1])[:n]
+        return [f"{count / total * 100:6.1f}%  {leaf}"
+                for leaf, count in ranked]
+
+
+
+class Profile:
+    """
+    Profiles everything between start() and stop().
+    mode 'cprofile' uses cProfile on the current thread, 'sample' uses
+    Sampler on every thread. Either way spans are collected in a
+    HistogramSink. stop() writes the raw results to 'out_dir' and returns
+    report lines.
+    """
+    def __init__(self, mode, out_dir):
+        self.mode = mode
+        self.out_dir = out_dir
+        self.histogram = HistogramSink()
+
+
+    def start(self):
+        add_sink(self.histogram)
+        if self.mode == "sample":
+            self.profiler = Sampler()
+            self.profiler.start()
+        else:
+            import cProfile
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+
+    def stop(self):
+        import io
+        import os
+        from datetime import datetime
+
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        os.makedirs(self.out_dir, exist_ok=True)
+        if self.mode == "sample":
+            self.profiler.stop()
+            fp = os.path.join(self.out_dir, f"profile-{stamp}.folded")
+            with open(fp, "w", encoding="utf-8") as f:
+                f.write(self.profiler.folded())
+            report = [f"{self.profiler.samples} samples. "
+                      "Most time spent in:"] + self.profiler.top()
+        else:
+            import pstats
+            self.profiler.disable()
+            fp = os.path.join(self.out_dir, f"profile-{stamp}.prof")
+            self.profiler.dump_stats(fp)
+            out = io.StringIO()
+            stats = pstats.Stats(self.profiler, stream=out)
+            stats.sort_stats("cumulative").print_stats(25)
+            report = out.getvalue().strip().splitlines()
+        remove_sink(self.histogram)
+        if self.histogram.histograms:
+            report += ["", "Stages:"] + self.histogram.report()
+        report += ["", f"Profile written to {fp}"]
+        return report
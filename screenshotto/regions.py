@@ -0,0 +1,142 @@
+"""
+Which parts of the screen to capture.
+By default that's the whole desktop as one image. The 'monitors' option
+(or --monitor) picks monitors instead, each saved to its own file, and
+'region' (or --region) picks one rectangle:
+    a name from the 'regions' option      dashboard
+    x,y,width,height                      0,0,1920,1080
+    'window'                              the window in front (windows only)
+Coordinates are pixels from the top left of the whole desktop.
+Only the pixels we need are grabbed, held and encoded.
+"""
+import sys
+
+from .log import get_logger
+
+log = get_logger(__name__)
+
+
+def parse_rect(s):
+    """
+    'x,y,w,h' -> (left, top, right, bottom)
+    """
+    try:
+        x, y, w, h = (int(v) for v in s.split(","))
+    except ValueError:
+        raise ValueError(f"'{s}' should be x,y,width,height")
+    if w <= 0 or h <= 0:
+        raise ValueError(f"'{s}' has no area")
+    return x, y, x + w, y + h
+
+
+def parse_regions(s):
+    """
+    'dashboard=0,0,1920,1080; clock=3640,0,200,80'
+    -> {'dashboard': (0, 0, 1920, 1080), 'clock': (3640, 0, 3840, 80)}
+    """
+    regions = {}
+    for part in filter(None, (x.strip() for x in s.split(";"))):
+        name, _, rect = part.partition("=")
+        regions[name.strip()] = parse_rect(rect.strip())
+    return regions
+
+
+def parse_monitors(s):
+    """
+    '' -> None (whole desktop), 'all' -> 'all', '1, 3' -> [1, 3]
+    """
+    s = s.strip().lower()
+    if not s:
+        return None
+    if s == "all":
+        return "all"
+    try:
+        return [int(x) for x in s.replace(" ", "").split(",")]
+    except ValueError:
+        raise ValueError(f"monitors should be 'all' or numbers like '1,3', "
+                         f"not '{s}'")
+
+
+def foreground_window():
+    """
+    (left, top, right, bottom) of the window in front, in desktop
+    coordinates, or None if we can't tell.
+    """
+    if sys.platform != "win32":
+        return None
+    import ctypes
+    from ctypes import wintypes
+
+    user32 = ctypes.windll.user32
+    hwnd = user32.GetForegroundWindow()
+    rect = wintypes.RECT()
+    if not hwnd or not user32.GetWindowRect(hwnd, ctypes.byref(rect)):
+        return None
+    # SM_XVIRTUALSCREEN, SM_YVIRTUALSCREEN: the desktop's top left
+    left, top = user32.GetSystemMetrics(76), user32.GetSystemMetrics(77)
+    return (rect.left - left, rect.top - top,
+            rect.right - left, rect.bottom - top)
+
+
+def clamp(rect, desktop):
+    l, t, r, b = rect
+    dl, dt, dr, db = desktop
+    rect = (max(l, dl), max(t, dt), min(r, dr), min(b, db))
+    if rect[0] >= rect[2] or rect[1] >= rect[3]:
+        return None
+    return rect
+
+
+def targets(backend, monitors=None, region=None):
+    """
+    What to grab, as a list of (label, rect). A rect of None means the
+    whole desktop. Labels tell the files apart when there's more than one
+    (or when it's not the whole desktop).
+    'monitors' and 'region' default to the config options.
+    """
+    from . import config
+
+    if monitors is None:
+        monitors = config.data["monitors"]
+    if region is None:
+        region = config.data["region"]
+    region = region.strip()
+    monitors = parse_monitors(monitors)
+    if region and monitors:
+        log.warning("Both a region and monitors are set. Using the region.")
+
+    if region:
+        rects = backend.monitors()
+        desktop = (min(r[0] for r in rects), min(r[1] for r in rects),
+                   max(r[2] for r in rects), max(r[3] for r in rects))
+        named = parse_regions(config.data["regions"])
+        if region == "window":
+            rect = foreground_window()
+            if rect is None:
+                log.warning("Can't find the window in front. "
+                            "Capturing the whole desktop.")
+                return [(None, None)]
+            label = "window"
+        elif region in named:
+            rect, label = named[region], region
+        else:
+            rect, label = parse_rect(region), "region"
+        rect = clamp(rect, desktop)
+        assert rect, f"Region '{region}' is off the screen"
+        return [(label, rect)]
+
+    if monitors:
+        rects = backend.monitors()
+        if monitors == "all":
+            monitors = range(1, len(rects) + 1)
+        chosen = []
+        for n in monitors:
+            if not 1 <= n <= len(rects):
+                log.warning(f"There is no monitor {n}. "
+                            f"There are {len(rects)}.")
+                continue
+            chosen.append((f"m{n}", tuple(rects[n - 1])))
+        assert chosen, "None of the monitors asked for exist"
+        return chosen
+
+    return [(None, None)]
@@ -0,0 +1,92 @@
+"""
+Moves existing screenshots into the directory layout picked by the
+subdirs option, e.g. from one big flat img_dir into {Y}/{m}/{d}.
+Each image goes in the directory for the time it was taken (its
+modification time, which compact keeps). Only images are moved, not
+session files, and directories that extra outputs ([output NAME]) save
+to are left alone. The target directories are
+made first, then the renames run on a pool of threads - on a big
+directory the time goes on waiting for the filesystem, not on python.
+"""
+import os
+from datetime import datetime
+from pathlib import Path
+from time import perf_counter
+
+from .log import get_logger
+
+log = get_logger(__name__)
+
+
+def plan(img_dir, template):
+    """
+    [(current path, new path)] for every image that isn't where it
+    should be.
+    """
+    from .compact import find_images
+    from .outputs import output_dirs
+    from .util import compile_subdirs
+
+    render = compile_subdirs(template) if template else lambda dt: ""
+    moves = []
+    for fp in find_images(img_dir, output_dirs(img_dir)):
+        dt = datetime.fromtimestamp(fp.stat().st_mtime)
+        dest = Path(img_dir) / render(dt) / fp.name
+        if dest != fp:
+            moves.append((fp, dest))
+    return moves
+
+
+def move(src, dest):
+    """
+    Renames 'src' to 'dest', adding ' (2)', ' (3)'... to the name rather
+    than replacing something that's already there.
+    Returns where it ended up.
+    """
+    from .util import move_free
+
+    return move_free(src, dest)
+
+
+def reshard(img_dir, template, workers=None):
+    """
+    Moves every image under 'img_dir' into the layout 'template'.
+    Returns a dict of stats.
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    from . import catalog
+    from .retention import remove_empty_dirs
+
+    img_dir = Path(img_dir)
+    moves = plan(img_dir, template)
+    stats = {"files": len(moves), "moved": 0, "failed": 0, "dirs": 0,
+             "seconds": 0.0}
+    if not moves:
+        return stats
+    log.info(f"Moving {len(moves)} image(s) in '{img_dir}' "
+             f"into '{template or '.'}'")
+
+    start = perf_counter()
+    dirs = {dest.parent for _, dest in moves}
+    for dirpath in dirs:
+        dirpath.mkdir(parents=True, exist_ok=True)
+    stats["dirs"] = len(dirs)
+    old_dirs = set()
+    with ThreadPoolExecutor(max_workers=workers or 16) as pool:
+        futures = {pool.submit(move, src, dest): src for src, dest in moves}
+        for future in as_completed(futures):
+            src = futures[future]
+            try:
+                dest = future.result()
+            except OSError as exc:
+                log.warning(f"Couldn't move '{src}': {exc}")
+                stats["failed"] += 1
+                continue
+            catalog.moved(src, dest)
+            stats["moved"] += 1
+            old_dirs.add(src.parent)
+    # tidy up whatever the old layout left empty, deepest first
+    for dirpath in sorted(old_dirs - dirs, key=lambda d: -len(d.parts)):
+        remove_empty_dirs(dirpath, img_dir)
+    stats["seconds"] = perf_counter() - start
+    return stats
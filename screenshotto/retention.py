@@ -0,0 +1,362 @@
+"""
+Deletes old screenshots from img_dir.
+Rules come from the config file, and any of them can be combined:
+    keep_for    delete images older than this, e.g. '30d'
+    keep_count  keep at most this many images
+    keep_size   keep at most this much, e.g. '20G'
+    thinning    fewer images the older they get. '1h:1m, 1d:1h' keeps
+                everything from the last hour, one a minute from before
+                that, and one an hour from more than a day ago.
+img_dir is scanned once when the manager starts. After that every saved
+image is added to an in-memory index, kept in time order and split into
+one deque per thinning step. Images only ever move from one end of a
+deque to the other end of the next, so enforcing the rules costs about
+the same whether there are a hundred images or millions.
+Hard links (see dedup) are counted by inode: an image's bytes count once
+however many names it has, and are only freed when the last one goes.
+"""
+import os
+import re
+import threading
+from collections import deque
+from time import time
+
+from .log import get_logger
+
+log = get_logger(__name__)
+
+# how often to check for images that have got too old, in seconds
+CHECK_EVERY = 30
+DURATION_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+SIZE_UNITS = {"": 1, "k": 2**10, "m": 2**20, "g": 2**30, "t": 2**40}
+
+_manager = None
+
+
+def parse_duration(s):
+    """
+    '90s', '5m', '1h', '30d', '2w' -> seconds. A bare number is seconds.
+    """
+    m = re.fullmatch(r"\s*([\d.]+)\s*([smhdw]?)\s*", s.lower())
+    if not m:
+        raise ValueError(f"'{s}' is not a duration like '30m' or '7d'")
+    return float(m.group(1)) * DURATION_UNITS.get(m.group(2) or "s")
+
+
+def parse_size(s):
+    """
+    '500M', '20G', '1.5T' -> bytes. A bare number is bytes.
+    """
+    m = re.fullmatch(r"\s*([\d.]+)\s*([kmgt]?)i?b?\s*", s.lower())
+    if not m:
+        raise ValueError(f"'{s}' is not a size like '500M' or '20G'")
+    return int(float(m.group(1)) * SIZE_UNITS[m.group(2)])
+
+
+def parse_thinning(s):
+    """
+    '1h:1m, 1d:1h' -> [(3600, 60), (86400, 3600)]
+    i.e. (older than, keep one per) in seconds, youngest first.
+    """
+    steps = []
+    for part in filter(None, (x.strip() for x in s.split(","))):
+        try:
+            age, interval = part.split(":")
+        except ValueError:
+            raise ValueError(f"'{part}' should look like 'AGE:INTERVAL', "
+                             "e.g. '1d:1h'")
+        steps.append((parse_duration(age), parse_duration(interval)))
+    steps.sort()
+    return steps
+
+
+def remove_empty_dirs(dirpath, top):
+    """
+    Removes 'dirpath' and its parents, up to but not including 'top',
+    for as long as they're empty.
+    """
+    top = os.path.abspath(top)
+    dirpath = os.path.abspath(dirpath)
+    while dirpath != top and dirpath.startswith(top):
+        try:
+            os.rmdir(dirpath)
+        except OSError:
+            return
+        dirpath = os.path.dirname(dirpath)
+
+
+def get_manager():
+    return _manager
+
+
+def start():
+    """
+    Starts enforcing the retention rules in the background, if there are
+    any. Meant for long running commands (schedule, daemon).
+    """
+    global _manager
+    if _manager is None:
+        manager = Retention()
+        if manager.enabled:
+            manager.start()
+            _manager = manager
+    return _manager
+
+
+def added(imgfp, size, t=None):
+    """
+    Tell the running manager (if any) about a newly saved image.
+    """
+    if _manager is not None:
+        _manager.add(imgfp, size, t)
+
+
+
+class Tier:
+    """
+    Images older than 'age', thinned to one per 'interval' seconds.
+    """
+    def __init__(self, age=0.0, interval=0.0):
+        self.age = age
+        self.interval = interval
+        self.files = deque()
+        self.last_bucket = None
+
+
+    def accept(self, t):
+        """
+        Whether an image from 't' moving into this tier should be kept.
+        """
+        if not self.interval:
+            return True
+        bucket = int(t // self.interval)
+        if bucket == self.last_bucket:
+            return False
+        self.last_bucket = bucket
+        return True
+
+
+
+class Retention:
+    def __init__(self, img_dir=None, keep_for=None, keep_count=None,
+                 keep_size=None, thinning=None):
+        from . import config
+
+        self.img_dir = img_dir or config.data["img_dir"]
+        if keep_for is None:
+            keep_for = self._option(parse_duration, "keep_for")
+        if keep_count is None:
+            keep_count = config.get_int("keep_count")
+        if keep_size is None:
+            keep_size = self._option(parse_size, "keep_size")
+        if thinning is None:
+            thinning = self._option(parse_thinning, "thinning") or []
+        self.keep_for = keep_for or None
+        self.keep_count = keep_count or None
+        self.keep_size = keep_size or None
+        self.tiers = [Tier()] + [Tier(age, interval)
+                                 for age, interval in thinning]
+        self.count = 0
+        self.bytes = 0
+        # (st_dev, st_ino) -> how many of the images are that file
+        self.links = {}
+        self.deleted = 0
+        self.freed = 0
+        self._lock = threading.Lock()
+        # images saved while load() is still scanning, so they aren't
+        # counted twice if the scan finds them too
+        self._loaded = False
+        self._early = []
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+
+    @staticmethod
+    def _option(parse, key):
+        from . import config
+
+        value = config.data[key].strip()
+        if not value:
+            return None
+        try:
+            return parse(value)
+        except ValueError as exc:
+            log.warning(f"Ignoring {key}: {exc}")
+            return None
+
+
+    @property
+    def enabled(self):
+        return bool(self.keep_for or self.keep_count or self.keep_size
+                    or len(self.tiers) > 1)
+
+
+    def load(self):
+        """
+        Index everything already in img_dir. The only full scan we do.
+        """
+        from .compact import find_images
+
+        found = []
+        for fp in find_images(self.img_dir):
+            try:
+                st = fp.stat()
+            except OSError:
+                continue
+            found.append((st.st_mtime, str(fp), st.st_size,
+                          (st.st_dev, st.st_ino)))
+        with self._lock:
+            # what add() was told is more up to date than what the scan
+            # saw (it may have caught a file before it was written)
+            by_path = {entry[1]: entry for entry in found}
+            for entry in self._early:
+                by_path[entry[1]] = entry
+            self._early = []
+            self._loaded = True
+            for entry in sorted(by_path.values()):
+                self._insert(entry)
+        log.debug(f"Retention is keeping track of {self.count} image(s), "
+                  f"{self.bytes / 2**20:.1f} MiB, in '{self.img_dir}'")
+
+
+    def add(self, imgfp, size, t=None):
+        if not os.path.abspath(imgfp).startswith(
+                os.path.abspath(self.img_dir)):
+            # an extra output somewhere else
+            return
+        try:
+            st = os.stat(imgfp)
+            size, inode = st.st_size, (st.st_dev, st.st_ino)
+        except OSError:
+            inode = None
+        entry = (time() if t is None else t, str(imgfp), size, inode)
+        with self._lock:
+            if not self._loaded:
+                self._early.append(entry)
+                return
+            self._insert(entry)
+        self._wake.set()
+
+
+    def _insert(self, entry):
+        # encoder threads can finish a little out of order, so walk back
+        # from the newest end. That's almost always zero steps.
+        files = self.tiers[0].files
+        i = len(files)
+        while i and files[i - 1][0] > entry[0]:
+            i -= 1
+        files.insert(i, entry)
+        self.count += 1
+        inode = entry[3]
+        if inode is None or inode not in self.links:
+            self.bytes += entry[2]
+        if inode is not None:
+            self.links[inode] = self.links.get(inode, 0) + 1
+
+
+    def _forget(self, entry):
+        """
+        Takes 'entry', already out of its tier, off the totals.
+        Returns the bytes deleting it will free.
+        """
+        self.count -= 1
+        inode = entry[3]
+        if inode is not None:
+            self.links[inode] -= 1
+            if self.links[inode]:
+                # other names still hold on to it
+                return 0
+            del self.links[inode]
+        self.bytes -= entry[2]
+        return entry[2]
+
+
+    def _oldest(self):
+        for tier in reversed(self.tiers):
+            if tier.files:
+                return tier
+        return None
+
+
+    def expired(self, now=None):
+        """
+        Works out which images the rules say should go, and drops them
+        from the index.
+        Returns [(time, path, bytes deleting it frees)].
+        """
+        now = time() if now is None else now
+        doomed = []
+        with self._lock:
+            # age images into the next thinning step
+            for older, tier in zip(self.tiers[1:], self.tiers):
+                cutoff = now - older.age
+                while tier.files and tier.files[0][0] < cutoff:
+                    entry = tier.files.popleft()
+                    if older.accept(entry[0]):
+                        older.files.append(entry)
+                    else:
+                        doomed.append(entry[:2] + (self._forget(entry),))
+            # then the hard limits, oldest first
+            while self.count:
+                tier = self._oldest()
+                entry = tier.files[0]
+                if not ((self.keep_for and entry[0] < now - self.keep_for)
+                        or (self.keep_count and self.count > self.keep_count)
+                        or (self.keep_size and self.bytes > self.keep_size)):
+                    break
+                tier.files.popleft()
+                doomed.append(entry[:2] + (self._forget(entry),))
+        return doomed
+
+
+    def enforce(self, now=None):
+        """
+        Deletes whatever the rules say should go.
+        Returns (number of images, bytes) deleted.
+        """
+        from . import catalog
+
+        doomed = self.expired(now)
+        freed = 0
+        for _, fp, size in doomed:
+            try:
+                os.remove(fp)
+            except FileNotFoundError:
+                pass
+            except OSError as exc:
+                log.warning(f"Couldn't delete '{fp}': {exc}")
+                continue
+            freed += size
+            remove_empty_dirs(os.path.dirname(fp), self.img_dir)
+        if doomed:
+            catalog.removed(fp for _, fp, _ in doomed)
+            self.deleted += len(doomed)
+            self.freed += freed
+            log.info(f"Retention deleted {len(doomed)} old screenshot(s), "
+                     f"{freed / 2**20:.1f} MiB")
+        return len(doomed), freed
+
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="retention",
+                                        daemon=True)
+        self._thread.start()
+
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+    def _run(self):
+        self.load()
+        while not self._stop.is_set():
+            try:
+                self.enforce()
+            except Exception:
+                log.exception("Retention failed")
+            self._wake.wait(CHECK_EVERY)
+            self._wake.clear()
@@ -0,0 +1,332 @@
+"""
+Runs screenshot jobs from schedule.txt.
+The file uses the same syntax as the 'schedule' library, e.g.
+    schedule.every(10).seconds.do(job)
+    schedule.every().day.at("06:30").do(job)
+but it's parsed (not exec'd) once, into a heap of deadlines. The loop
+sleeps until exactly the next deadline instead of polling every second
+(waking up at least once a second only so ctrl+c works).
+Intervals can be fractions of a second. Each run is scheduled from the
+previous deadline rather than from when the job actually finished, so
+the schedule doesn't drift, and we keep track of how late each job ran.
+"""
+import ast
+import heapq
+import random
+import threading
+from collections import deque
+from datetime import datetime, timedelta
+from time import monotonic, time
+
+from .log import get_logger
+
+log = get_logger(__name__)
+
+UNITS = {"second": 1, "minute": 60, "hour": 3600, "day": 86400,
+         "week": 604800}
+WEEKDAYS = ["monday", "tuesday", "wednesday", "thursday", "friday",
+            "saturday", "sunday"]
+# longest we wait in one go. ctrl+c can't interrupt a timed wait on windows
+# until it's over.
+WAIT_SLICE = 1.0
+
+
+
+class ScheduleError(ValueError):
+    pass
+
+
+
+class Job:
+    def __init__(self, source, interval=1, latest=None, unit=None,
+                 at=None, weekday=None):
+        self.source = source
+        self.interval = interval
+        self.latest = latest
+        self.unit = unit
+        self.at = at
+        self.weekday = weekday
+        self.runs = 0
+        self.missed = 0
+        self.lateness = deque(maxlen=1000)
+        self.max_lateness = 0.0
+
+
+    def __repr__(self):
+        return f"Job({self.source!r})"
+
+
+    def period(self):
+        """
+        Seconds between runs. Random each time for every(x).to(y) jobs.
+        """
+        n = self.interval
+        if self.latest is not None:
+            n = random.uniform(self.interval, self.latest)
+        return n * UNITS[self.unit]
+
+
+    @property
+    def calendar(self):
+        """
+        True for jobs pinned to a time of day / day of the week.
+        These are worked out in wall clock time.
+        """
+        return self.at is not None or self.weekday is not None
+
+
+    def first_deadline(self, now_mono, now_wall):
+        if not self.calendar:
+            return now_mono + self.period()
+        target = self._next_wall(datetime.fromtimestamp(now_wall))
+        return now_mono + (target.timestamp() - now_wall)
+
+
+    def next_deadline(self, deadline, now_mono, now_wall):
+        """
+        The deadline after 'deadline'. Runs we were too late for are
+        skipped (and counted) rather than fired all at once.
+        """
+        if self.calendar:
+            return self.first_deadline(now_mono, now_wall)
+        period = self.period()
+        nxt = deadline + period
+        if nxt <= now_mono:
+            skipped = int((now_mono - nxt) // period) + 1
+            self.missed += skipped
+            nxt += skipped * period
+        return nxt
+
+
+    def _next_wall(self, now):
+        hour, minute, second = self.at or (0, 0, 0)
+        if self.weekday is not None:
+            target = now.replace(hour=hour, minute=minute, second=second,
+                                 microsecond=0)
+            target += timedelta(days=(self.weekday - now.weekday()) % 7)
+            if target <= now:
+                target += timedelta(weeks=self.interval)
+            return target
+        if self.unit == "day":
+            target = now.replace(hour=hour, minute=minute, second=second,
+                                 microsecond=0)
+            if target <= now:
+                target += timedelta(days=self.interval)
+            return target
+        if self.unit == "hour":
+            target = now.replace(minute=minute, second=second, microsecond=0)
+            if target <= now:
+                target += timedelta(hours=self.interval)
+            return target
+        # minute
+        target = now.replace(second=second, microsecond=0)
+        if target <= now:
+            target += timedelta(minutes=self.interval)
+        return target
+
+
+    def record(self, late):
+        self.runs += 1
+        self.lateness.append(late)
+        self.max_lateness = max(self.max_lateness, late)
+
+
+    def stats(self):
+        from .bench import percentile
+
+        ms = [x * 1000 for x in self.lateness]
+        return {
+            "runs": self.runs,
+            "missed": self.missed,
+            "mean_ms": sum(ms) / len(ms) if ms else 0.0,
+            "p95_ms": percentile(ms, 95),
+            "max_ms": self.max_lateness * 1000,
+        }
+
+
+
+def _chain(node):
+    """
+    schedule.every(5).to(10).minutes.do(job)
+    -> [("schedule", None), ("every", [5]), ("to", [10]),
+        ("minutes", None), ("do", ["job"])]
+    """
+    links = []
+    while True:
+        if isinstance(node, ast.Call):
+            func = node.func
+            if not isinstance(func, ast.Attribute):
+                raise ScheduleError("expected schedule.every(...)")
+            args = []
+            for arg in node.args:
+                if isinstance(arg, ast.Name):
+                    args.append(arg.id)
+                    continue
+                try:
+                    args.append(ast.literal_eval(arg))
+                except (ValueError, SyntaxError):
+                    raise ScheduleError(f".{func.attr}() only takes plain "
+                                        "numbers and strings")
+            links.append((func.attr, args))
+            node = func.value
+        elif isinstance(node, ast.Attribute):
+            links.append((node.attr, None))
+            node = node.value
+        elif isinstance(node, ast.Name):
+            links.append((node.id, None))
+            break
+        else:
+            raise ScheduleError("expected schedule.every(...)")
+    return links[::-1]
+
+
+def _parse_at(s, unit):
+    parts = s.split(":")
+    try:
+        if unit == "minute":
+            # ":SS"
+            assert parts[0] == "" and len(parts) == 2
+            return 0, 0, int(parts[1])
+        if unit == "hour":
+            # ":MM" or "MM:SS"
+            if parts[0] == "":
+                return 0, int(parts[1]), 0
+            return 0, int(parts[0]), int(parts[1])
+        # "HH:MM" or "HH:MM:SS"
+        assert len(parts) in (2, 3)
+        nums = [int(x) for x in parts] + [0]
+        return nums[0], nums[1], nums[2]
+    except (AssertionError, ValueError, IndexError):
+        raise ScheduleError(f"bad time '{s}' for a per-{unit} job")
+
+
+def parse_line(line):
+    """
+    Turns one line of schedule.txt into a Job.
+    """
+    try:
+        tree = ast.parse(line.strip(), mode="eval")
+    except SyntaxError:
+        raise ScheduleError("not valid python")
+    links = _chain(tree.body)
+    if [name for name, _ in links[:2]] != ["schedule", "every"]:
+        raise ScheduleError("lines should start with schedule.every")
+    if links[-1][0] != "do":
+        raise ScheduleError("lines should end with .do(job)")
+
+    job = Job(line.strip())
+    job.interval = (links[1][1] or [1])[0]
+    for name, args in links[2:-1]:
+        if name in ("to", "at") and (not args or len(args) > 1):
+            raise ScheduleError(f".{name}() takes one argument")
+        if name == "to":
+            job.latest = args[0]
+        elif name == "at":
+            job.at = args[0]
+        elif name.rstrip("s") in UNITS:
+            job.unit = name.rstrip("s")
+        elif name in WEEKDAYS:
+            job.unit = "week"
+            job.weekday = WEEKDAYS.index(name)
+        else:
+            raise ScheduleError(f"don't know what '{name}' means")
+    if job.unit is None:
+        raise ScheduleError("no unit, e.g. .seconds or .day")
+    if not isinstance(job.interval, (int, float)) or job.interval <= 0:
+        raise ScheduleError("the interval has to be a positive number")
+    if job.latest is not None and (
+            not isinstance(job.latest, (int, float))
+            or job.latest < job.interval):
+        raise ScheduleError("every(x).to(y) needs y to be a number at "
+                            "least x")
+    if job.at is not None:
+        if job.unit not in ("minute", "hour", "day", "week"):
+            raise ScheduleError(".at() only works for minutes, hours, "
+                                "days and weekdays")
+        if not isinstance(job.at, str):
+            raise ScheduleError(".at() takes a time in quotes, e.g. "
+                                ".at(\"06:30\")")
+        job.at = _parse_at(job.at, "day" if job.unit == "week"
+                                   else job.unit)
+    return job
+
+
+def parse_schedule(text):
+    """
+    Parses the contents of schedule.txt into a list of Jobs.
+    Blank lines and # comments are ignored.
+    """
+    jobs = []
+    for lineno, line in enumerate(text.splitlines(), 1):
+        line = line.split("#", 1)[0].strip()
+        if not line:
+            continue
+        try:
+            jobs.append(parse_line(line))
+        except ScheduleError as exc:
+            raise ScheduleError(f"Line {lineno} of the schedule ({line}): "
+                                f"{exc}")
+    return jobs
+
+
+
+class Scheduler:
+    def __init__(self, jobs, action):
+        self.jobs = jobs
+        self.action = action
+        self._stop = threading.Event()
+        now_mono, now_wall = monotonic(), time()
+        self.heap = [(job.first_deadline(now_mono, now_wall), i, job)
+                     for i, job in enumerate(jobs)]
+        heapq.heapify(self.heap)
+
+
+    def next_run(self):
+        """
+        datetime of the next run, or None if there are no jobs.
+        """
+        if not self.heap:
+            return None
+        return datetime.fromtimestamp(time() + self.heap[0][0] - monotonic())
+
+
+    def stop(self):
+        self._stop.set()
+
+
+    def run(self, on_wait=None):
+        """
+        Runs jobs until stop() is called.
+        'on_wait' is called with the datetime of the next run whenever we
+        start waiting for one.
+        """
+        waiting_for = None
+        while self.heap and not self._stop.is_set():
+            deadline, i, job = self.heap[0]
+            remaining = deadline - monotonic()
+            if remaining > 0:
+                if on_wait and waiting_for != deadline:
+                    on_wait(self.next_run())
+                waiting_for = deadline
+                self._stop.wait(min(remaining, WAIT_SLICE))
+                continue
+            heapq.heappop(self.heap)
+            now = monotonic()
+            job.record(now - deadline)
+            try:
+                self.action(job)
+            except Exception:
+                log.exception(f"Scheduled job failed: {job.source}")
+            nxt = job.next_deadline(deadline, monotonic(), time())
+            heapq.heappush(self.heap, (nxt, i, job))
+
+
+    def report(self):
+        lines = []
+        for job in self.jobs:
+            s = job.stats()
+            lines.append(f"{job.source}\n"
+                         f"    {s['runs']} runs, {s['missed']} missed, "
+                         f"late by {s['mean_ms']:.1f} ms on average, "
+                         f"p95 {s['p95_ms']:.1f} ms, max {s['max_ms']:.1f} ms")
+        return lines
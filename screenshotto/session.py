@@ -0,0 +1,382 @@
+"""
+Session files: lots of screenshots in one file, stored as deltas.
+Every 'keyframe_interval' frames a whole frame is stored as a PNG. In
+between, only the tiles that changed since the previous frame are stored
+(merged into rectangles along each row of tiles, zlib compressed).
+
+A session is two files:
+    name.sshot      header, then one record per frame
+    name.sshot.idx  one fixed size entry per frame:
+                    timestamp, offset of the record, offset of its keyframe
+The index is sorted by time so any frame can be found with a binary search
+and rebuilt from its keyframe plus at most keyframe_interval deltas.
+Before appending to an existing session (e.g. after a crash), the end of
+the file is checked against the index. Complete records the index missed
+are added to it, and anything after the last complete record is cut off.
+Otherwise the first new record would be unreadable.
+
+Each writer starts with a keyframe, and so does every 'screenshot' run,
+so deltas only pay off when one process keeps going ('schedule' or
+'daemon'). Writers lock the file while they append. If another process
+added frames since, the next frame is a keyframe, as a delta from our
+own last frame would be garbage.
+"""
+import os
+import struct
+import zlib
+from contextlib import contextmanager
+from io import BytesIO
+from pathlib import Path
+
+from .log import get_logger
+
+log = get_logger(__name__)
+
+MAGIC = b"SSHOTSES\x01"
+KEYFRAME = b"K"
+DELTA = b"D"
+RECORD = struct.Struct("<cdI")      # kind, timestamp, payload length
+RECT = struct.Struct("<HHHHI")      # x, y, w, h, compressed length
+COUNT = struct.Struct("<I")
+INDEX = struct.Struct("<dQQ")       # timestamp, offset, keyframe offset
+INDEX_DTYPE = [("t", "<f8"), ("offset", "<u8"), ("keyoffset", "<u8")]
+EXT = ".sshot"
+# windows locks byte ranges, and readers need the real ones
+LOCK_OFFSET = 1 << 62
+
+_writers = {}
+
+
+def index_path(path):
+    return Path(str(path) + ".idx")
+
+
+def session_fp(dt, label=None):
+    """
+    Takes a datetime.datetime.
+    Returns the pathlib.Path of the session file a frame captured at 'dt'
+    belongs to. Each monitor / region ('label') has its own.
+    """
+    from . import config
+    from .util import image_dir
+
+    name = dt.strftime(config.data["session_strftime"])
+    if label:
+        name += f" {label}"
+    return image_dir(dt) / (name + EXT)
+
+
+def save_to_session(img, dt, label=None):
+    """
+    Appends 'img' to the session file for 'dt', starting a new session
+    file whenever the name changes.
+    Returns the session file's path.
+    """
+    from . import config
+
+    fp = session_fp(dt, label)
+    writer = _writers.get(label)
+    if writer is None or writer.path != fp:
+        if writer is not None:
+            writer.close()
+        writer = _writers[label] = SessionWriter(
+            fp, config.get_int("keyframe_interval"),
+            config.get_int("tile_size"))
+    writer.add(img, dt.timestamp())
+    log.debug(f"Screenshot added to session '{fp}'")
+    return fp
+
+
+def scan_records(f, offset, size, keyoffset=0):
+    """
+    Walks the records in session file 'f' from 'offset', up to 'size'.
+    Yields (timestamp, offset, keyframe offset, end) for each complete one.
+    """
+    while offset + RECORD.size <= size:
+        f.seek(offset)
+        kind, timestamp, length = RECORD.unpack(f.read(RECORD.size))
+        end = offset + RECORD.size + length
+        if kind not in (KEYFRAME, DELTA) or end > size:
+            return
+        if kind == KEYFRAME:
+            keyoffset = offset
+        yield timestamp, offset, keyoffset, end
+        offset = end
+
+
+@contextmanager
+def locked(f):
+    """
+    Holds an exclusive lock on open file 'f', waiting for it if another
+    process has it.
+    """
+    if os.name == "nt":
+        import msvcrt
+        f.seek(LOCK_OFFSET)
+        msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            f.seek(LOCK_OFFSET)
+            msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+    else:
+        import fcntl
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def recover(path):
+    """
+    Gets an existing session file ready to be appended to: the index and
+    the file agree, and the file ends with a complete record.
+    Call with the session locked.
+    """
+    path = Path(path)
+    size = path.stat().st_size
+    idxfp = index_path(path)
+    idx = idxfp.read_bytes() if idxfp.exists() else b""
+    idx = idx[:len(idx) - len(idx) % INDEX.size]
+    extra = []
+    with open(path, "r+b") as f:
+        header = f.read(len(MAGIC))
+        if header != MAGIC:
+            if len(header) == len(MAGIC) or not MAGIC.startswith(header):
+                raise ValueError(f"'{path}' is not a screenshotto session "
+                                 "file")
+            # the crash came while the header was being written
+            log.warning(f"Rewriting the incomplete header of '{path}'")
+            f.seek(0)
+            f.truncate()
+            f.write(MAGIC)
+            idx, size = b"", len(MAGIC)
+        # where the last record the index knows about ends
+        end, keyoffset = len(MAGIC), 0
+        if idx:
+            _, offset, keyoffset = INDEX.unpack_from(idx, len(idx) - INDEX.size)
+            for _, _, _, end in scan_records(f, offset, size, keyoffset):
+                break
+            else:
+                log.warning(f"Index for '{path}' doesn't match the file. "
+                            "Rebuilding it.")
+                idx, end, keyoffset = b"", len(MAGIC), 0
+        # complete records written after the index was (the crash came
+        # between the two)
+        for timestamp, offset, keyoffset, end in scan_records(f, end, size,
+                                                              keyoffset):
+            extra.append(INDEX.pack(timestamp, offset, keyoffset))
+        if end < size:
+            log.warning(f"Cutting {size - end} byte(s) of an incomplete "
+                        f"record off the end of '{path}'")
+            f.truncate(end)
+    with open(idxfp, "wb") as f:
+        f.write(idx + b"".join(extra))
+
+
+def dirty_rects(prev, arr, tile):
+    """
+    Compares two HxWx3 uint8 arrays tile by tile.
+    Returns a list of (x, y, w, h) rects covering every tile that changed.
+    Neighbouring dirty tiles on the same row are merged.
+    """
+    import numpy as np
+
+    h, w = arr.shape[:2]
+    rows, cols = -(-h // tile), -(-w // tile)
+    changed = (prev != arr).any(axis=2)
+    padded = np.zeros((rows * tile, cols * tile), dtype=bool)
+    padded[:h, :w] = changed
+    dirty = padded.reshape(rows, tile, cols, tile).any(axis=(1, 3))
+
+    rects = []
+    for row in np.flatnonzero(dirty.any(axis=1)):
+        line = dirty[row]
+        # run boundaries: where a run of dirty tiles starts and stops
+        edges = np.flatnonzero(np.diff(np.concatenate(([0], line, [0]))))
+        y = row * tile
+        rh = min(tile, h - y)
+        for start, stop in zip(edges[::2], edges[1::2]):
+            x = start * tile
+            rects.append((x, y, min(stop * tile, w) - x, rh))
+    return rects
+
+
+
+class SessionWriter:
+    def __init__(self, path, keyframe_interval=60, tile_size=64):
+        self.path = Path(path)
+        self.keyframe_interval = max(keyframe_interval, 1)
+        self.tile_size = max(tile_size, 8)
+        self.prev = None
+        self.since_key = 0
+        self.keyoffset = 0
+        self.f = open(self.path, "ab")
+        self.idx = open(index_path(self.path), "ab")
+        with locked(self.f):
+            self.end = self._ready()
+        log.debug(f"Opened session '{self.path}'")
+
+
+    def _ready(self):
+        """
+        Makes sure the file has a header and ends with a complete record.
+        Returns where it ends.
+        """
+        if os.fstat(self.f.fileno()).st_size:
+            recover(self.path)
+        else:
+            self.f.write(MAGIC)
+            self.f.flush()
+        return os.fstat(self.f.fileno()).st_size
+
+
+    def add(self, img, timestamp):
+        import numpy as np
+
+        arr = np.asarray(img.convert("RGB"))
+        with locked(self.f):
+            if os.fstat(self.f.fileno()).st_size != self.end:
+                # another process has added to the session
+                log.debug(f"'{self.path}' changed under us. "
+                          "Starting with a keyframe.")
+                self.end = self._ready()
+                self.prev = None
+            keyframe = (self.prev is None
+                        or self.prev.shape != arr.shape
+                        or self.since_key >= self.keyframe_interval)
+            if keyframe:
+                buf = BytesIO()
+                img.save(buf, "PNG", compress_level=1)
+                kind, payload = KEYFRAME, buf.getvalue()
+                self.since_key = 0
+            else:
+                kind, payload = DELTA, self._delta(arr)
+                self.since_key += 1
+
+            offset = self.end
+            if keyframe:
+                self.keyoffset = offset
+            self.f.write(RECORD.pack(kind, timestamp, len(payload)))
+            self.f.write(payload)
+            self.f.flush()
+            # index entry only once the record is safely in the file
+            self.idx.write(INDEX.pack(timestamp, offset, self.keyoffset))
+            self.idx.flush()
+            self.end = offset + RECORD.size + len(payload)
+        self.prev = arr
+
+
+    def _delta(self, arr):
+        parts = []
+        rects = dirty_rects(self.prev, arr, self.tile_size)
+        parts.append(COUNT.pack(len(rects)))
+        for x, y, w, h in rects:
+            data = zlib.compress(arr[y:y + h, x:x + w].tobytes(), 1)
+            parts.append(RECT.pack(x, y, w, h, len(data)))
+            parts.append(data)
+        return b"".join(parts)
+
+
+    def close(self):
+        self.f.close()
+        self.idx.close()
+
+
+
+class SessionReader:
+    def __init__(self, path):
+        import numpy as np
+
+        self.path = Path(path)
+        self.f = open(self.path, "rb")
+        assert self.f.read(len(MAGIC)) == MAGIC, \
+               f"'{self.path}' is not a screenshotto session file"
+        idxfp = index_path(self.path)
+        if not idxfp.exists() or idxfp.stat().st_size % INDEX.size:
+            log.warning(f"Index for '{self.path}' is missing or damaged. "
+                        "Rebuilding it.")
+            self.rebuild_index()
+        if idxfp.stat().st_size:
+            self.index = np.memmap(idxfp, dtype=INDEX_DTYPE, mode="r")
+        else:
+            self.index = np.zeros(0, dtype=INDEX_DTYPE)
+
+
+    def __len__(self):
+        return len(self.index)
+
+
+    def rebuild_index(self):
+        """
+        Scan the whole session file and write a fresh index.
+        Stops at the first incomplete record (e.g. after a crash).
+        """
+        size = os.path.getsize(self.path)
+        entries = [INDEX.pack(timestamp, offset, keyoffset)
+                   for timestamp, offset, keyoffset, _
+                   in scan_records(self.f, len(MAGIC), size)]
+        with open(index_path(self.path), "wb") as f:
+            f.write(b"".join(entries))
+
+
+    def find(self, timestamp):
+        """
+        Index of the last frame captured at or before 'timestamp'.
+        """
+        import numpy as np
+
+        i = int(np.searchsorted(self.index["t"], timestamp, side="right")) - 1
+        assert i >= 0, "No frames that early in this session"
+        return i
+
+
+    def _read(self, offset):
+        self.f.seek(offset)
+        kind, timestamp, length = RECORD.unpack(self.f.read(RECORD.size))
+        return kind, timestamp, self.f.read(length)
+
+
+    def frame(self, i):
+        """
+        Rebuilds frame number 'i'.
+        Returns (PIL image, timestamp).
+        """
+        import numpy as np
+        from PIL import Image
+
+        entry = self.index[i]
+        keyoffset = int(entry["keyoffset"])
+        kind, timestamp, payload = self._read(keyoffset)
+        assert kind == KEYFRAME, "Session index is damaged"
+        with Image.open(BytesIO(payload)) as img:
+            arr = np.array(img.convert("RGB"))
+
+        # apply every delta between the keyframe and the frame we want
+        j = int(np.searchsorted(self.index["offset"], keyoffset))
+        for k in range(j + 1, i + 1):
+            kind, timestamp, payload = self._read(int(self.index[k]["offset"]))
+            self._apply(arr, payload)
+        return Image.fromarray(arr), float(entry["t"])
+
+
+    def _apply(self, arr, payload):
+        import numpy as np
+
+        count, = COUNT.unpack_from(payload)
+        pos = COUNT.size
+        for _ in range(count):
+            x, y, w, h, length = RECT.unpack_from(payload, pos)
+            pos += RECT.size
+            data = zlib.decompress(payload[pos:pos + length])
+            pos += length
+            arr[y:y + h, x:x + w] = np.frombuffer(data, np.uint8).reshape(h, w, 3)
+
+
+    def frame_at(self, timestamp):
+        return self.frame(self.find(timestamp))
+
+
+    def close(self):
+        self.f.close()
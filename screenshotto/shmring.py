@@ -0,0 +1,485 @@
+"""
+Encoder processes fed through a ring of shared memory frame slots.
+The thread pipeline is limited by how much of the encoding Pillow does
+without the GIL. This one encodes in separate processes instead, without
+pickling images across: every frame slot is allocated once, in one
+multiprocessing.shared_memory block, and only (slot, sequence number)
+goes through the task queue.
+
+Each slot has a small header:
+    seq     sequence number of the frame in it
+    state   FREE, WRITING, QUEUED or BUSY
+    w, h    size of the frame
+followed by room for the biggest frame the capture backend can produce,
+as packed RGB. The capture side copies a frame's pixels in, and an encoder
+maps them straight out as a NumPy array without copying. With
+'png_stream_rows' set, PNGs are encoded straight from that array a band
+at a time. Otherwise Pillow unpacks the slot into a PIL image first.
+
+A task only counts if the slot still holds that sequence number when an
+encoder claims it. That's how 'drop_oldest' works: it reuses the slot of
+the oldest frame nobody's started on, and the stale task is ignored.
+
+Encoders log through a queue to this process. Each one also says which
+frame it's working on, so if one dies that frame is failed (and its slot
+freed) rather than waited on forever.
+"""
+import atexit
+import itertools
+import struct
+import threading
+import queue
+from collections import deque
+from time import perf_counter
+
+from .log import get_logger
+
+log = get_logger(__name__)
+
+HEADER = struct.Struct("<QIII")     # seq, state, width, height
+HEADER_SIZE = 64                    # keeps the pixels nicely aligned
+FREE, WRITING, QUEUED, BUSY = range(4)
+# how often flush() and a blocked submit() check the encoders are alive
+CHECK_SECS = 1.0
+
+
+
+class FrameRing:
+    """
+    'slots' frames of up to 'frame_bytes' each in one shared memory block.
+    Create it in the capture process, attach to it by 'name' elsewhere.
+    """
+    def __init__(self, slots, frame_bytes, name=None):
+        from multiprocessing import shared_memory
+
+        self.slots = slots
+        self.frame_bytes = frame_bytes
+        self.slot_size = HEADER_SIZE + -(-frame_bytes // 64) * 64
+        if name is None:
+            self.shm = shared_memory.SharedMemory(
+                create=True, size=self.slot_size * slots)
+            self.owner = True
+            for slot in range(slots):
+                self.set_header(slot, 0, FREE, 0, 0)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            self.owner = False
+        self.name = self.shm.name
+
+
+    def header(self, slot):
+        return HEADER.unpack_from(self.shm.buf, slot * self.slot_size)
+
+
+    def set_header(self, slot, seq, state, w, h):
+        HEADER.pack_into(self.shm.buf, slot * self.slot_size, seq, state, w, h)
+
+
+    def set_state(self, slot, state):
+        seq, _, w, h = self.header(slot)
+        self.set_header(slot, seq, state, w, h)
+
+
+    def write(self, slot, img):
+        """
+        Copies the pixels of RGB image 'img' into 'slot'.
+        They're packed straight into the slot a chunk at a time, rather
+        than into a frame sized bytes object first like img.tobytes().
+        """
+        from PIL import Image
+
+        img.load()
+        encoder = Image._getencoder("RGB", "raw", "RGB")
+        encoder.setimage(img.im, (0, 0) + img.size)
+        # the chunks tobytes() would join together
+        chunk = max(65536, img.size[0] * 4)
+        buf = self.shm.buf
+        pos = slot * self.slot_size + HEADER_SIZE
+        while True:
+            _, status, data = encoder.encode(chunk)
+            buf[pos:pos + len(data)] = data
+            pos += len(data)
+            if status:
+                break
+        if status < 0:
+            raise RuntimeError(f"Couldn't pack the frame (error {status})")
+
+
+    def array(self, slot):
+        """
+        The frame in 'slot' as an HxWx3 NumPy array. No copy - it's a view
+        of the shared memory, so let go of it before the slot is reused.
+        """
+        import numpy as np
+
+        _, _, w, h = self.header(slot)
+        return np.ndarray((h, w, 3), np.uint8, buffer=self.shm.buf,
+                          offset=slot * self.slot_size + HEADER_SIZE)
+
+
+    def image(self, slot):
+        """
+        The frame in 'slot' as a PIL image. Pillow unpacks the pixels into
+        its own memory, so this one is safe to keep.
+        """
+        from PIL import Image
+
+        _, _, w, h = self.header(slot)
+        start = slot * self.slot_size + HEADER_SIZE
+        return Image.frombuffer("RGB", (w, h),
+                                self.shm.buf[start:start + w * h * 3],
+                                "raw", "RGB", 0, 1)
+
+
+    def close(self):
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+
+def _encoder(index, ring_name, slots, frame_bytes, lock, tasks, free,
+             results, busy, log_queue):
+    """
+    Runs in each encoder process until it's sent None.
+    busy[index] is the seq of the frame it's working on, 0 for none.
+    """
+    from . import durable
+    from .durable import save, save_with
+    from .encoders import image_format, save_options, stream_rows
+    from .log import log_to_queue
+    from .pngstream import encode_array
+
+    log_to_queue(log_queue)
+    stream = stream_rows()
+    ring = FrameRing(slots, frame_bytes, ring_name)
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            slot, seq, imgfp, profile = task
+            with lock:
+                cur_seq, state, w, h = ring.header(slot)
+                if cur_seq != seq or state != QUEUED:
+                    # the slot was given to a newer frame
+                    continue
+                ring.set_header(slot, seq, BUSY, w, h)
+            busy[index] = seq
+            t0 = perf_counter()
+            img = None
+            try:
+                if stream and image_format(imgfp) == "PNG":
+                    # straight out of the slot, a band at a time
+                    level = save_options("PNG", profile).get(
+                        "compress_level", 6)
+                    img = ring.array(slot)
+                    imgfp, size = save_with(imgfp, lambda f: encode_array(
+                        img, f, stream, level))
+                else:
+                    img = ring.image(slot)
+                    imgfp, size = save(img, imgfp, profile)
+                error = None
+            except Exception as exc:
+                size, error = 0, repr(exc)
+            finally:
+                img = None
+                # under the lock, so _fail() can tell it's been given back
+                with lock:
+                    ring.set_state(slot, FREE)
+                    free.put(slot)
+            results.put((seq, imgfp, size, perf_counter() - t0, error))
+            busy[index] = 0
+        durable.flush()
+    finally:
+        ring.close()
+
+
+
+class ProcessPipeline:
+    """
+    Same interface as pipeline.SavePipeline, but the encoders are
+    processes reading frames from a FrameRing.
+    Frames bigger than 'frame_bytes' (the backend got bigger, e.g. a
+    monitor was plugged in) are written in this process instead.
+    """
+    def __init__(self, workers=None, maxsize=None, policy=None,
+                 frame_bytes=None):
+        import multiprocessing
+        from . import config
+        from .log import listen_to_processes
+        from .pipeline import POLICIES
+
+        if workers is None:
+            workers = config.get_int("encoder_processes")
+        if maxsize is None:
+            maxsize = config.get_int("queue_size")
+        if policy is None:
+            policy = config.data["queue_policy"]
+        if policy not in POLICIES:
+            log.warning(f"Unknown queue_policy '{policy}'. Using 'block'.")
+            policy = "block"
+        if frame_bytes is None:
+            frame_bytes = self._desktop_bytes()
+        workers = max(workers, 1)
+        self.policy = policy
+        self.dropped = 0
+        self.saved = 0
+        self.failed = 0
+        self.encode_times = deque(maxlen=100000)
+        # a slot for every frame that can be waiting, plus one per encoder
+        self.ring = FrameRing(max(maxsize, 1) + workers, frame_bytes)
+        self._lock = multiprocessing.Lock()
+        self._tasks = multiprocessing.Queue()
+        self._free = multiprocessing.Queue()
+        self._results = multiprocessing.Queue()
+        self._busy = multiprocessing.Array("q", workers, lock=False)
+        self._log_queue = multiprocessing.Queue()
+        self._log_listener = listen_to_processes(self._log_queue)
+        for slot in range(self.ring.slots):
+            self._free.put(slot)
+        self._seq = itertools.count(1)
+        # seq -> (slot, imgfp, event) for frames not finished yet
+        self._pending = {}
+        self._queued = deque()
+        self._done = threading.Condition()
+        self._procs = []
+        self._dead = set()
+        for i in range(workers):
+            p = multiprocessing.Process(
+                target=_encoder, name=f"encoder-{i}", daemon=True,
+                args=(i, self.ring.name, self.ring.slots, frame_bytes,
+                      self._lock, self._tasks, self._free, self._results,
+                      self._busy, self._log_queue))
+            p.start()
+            self._procs.append(p)
+        self._collector = threading.Thread(target=self._collect,
+                                           name="encoder-results",
+                                           daemon=True)
+        self._collector.start()
+        self._closed = False
+        atexit.register(self.close)
+        log.debug(f"Started {workers} encoder process(es), "
+                  f"{self.ring.slots} frame slots of "
+                  f"{frame_bytes / 2**20:.1f} MiB, policy '{policy}'")
+
+
+    @staticmethod
+    def _desktop_bytes():
+        from .capture import get_backend
+
+        rects = get_backend().monitors()
+        w = max(r[2] for r in rects) - min(r[0] for r in rects)
+        h = max(r[3] for r in rects) - min(r[1] for r in rects)
+        return w * h * 3
+
+
+    def submit(self, img, imgfp, event=None, profile=None):
+        """
+        Copy 'img' into a free slot and queue it to be saved to 'imgfp'
+        (with encoder 'profile').
+        Returns False if the frame was dropped.
+        """
+        from .util import write_frame
+
+        assert not self._closed, "Pipeline is closed"
+        w, h = img.size
+        if img.mode != "RGB" or w * h * 3 > self.ring.frame_bytes:
+            log.debug("Frame doesn't fit a slot. Saving it directly.")
+            write_frame(img, imgfp, event, profile)
+            return True
+
+        with self._done:
+            alive = self._reap()
+        slot = None
+        if alive and self.policy != "block":
+            try:
+                slot = self._free.get_nowait()
+            except queue.Empty:
+                if self.policy == "drop_newest":
+                    self._drop(imgfp)
+                    return False
+                slot = self._steal_oldest()
+        if alive and slot is None:
+            # everything is being encoded right now
+            slot = self._wait_for_slot()
+        if slot is None:
+            log.error("Every encoder process has died. Saving directly.")
+            write_frame(img, imgfp, event, profile)
+            return True
+
+        seq = next(self._seq)
+        with self._lock:
+            self.ring.set_header(slot, seq, WRITING, *img.size)
+        self.ring.write(slot, img)
+        with self._done:
+            self._pending[seq] = (slot, imgfp, event)
+        if self.policy == "drop_oldest":
+            # forget frames that are already done
+            while self._queued and self._queued[0] not in self._pending:
+                self._queued.popleft()
+            self._queued.append(seq)
+        with self._lock:
+            self.ring.set_state(slot, QUEUED)
+        self._tasks.put((slot, seq, imgfp, profile))
+        return True
+
+
+    def _steal_oldest(self):
+        """
+        Takes the slot of the oldest frame no encoder has started on.
+        """
+        while self._queued:
+            seq = self._queued.popleft()
+            with self._done:
+                entry = self._pending.get(seq)
+            if entry is None:
+                continue
+            slot, imgfp, _ = entry
+            with self._lock:
+                cur_seq, state, w, h = self.ring.header(slot)
+                if cur_seq != seq or state != QUEUED:
+                    continue
+                self.ring.set_header(slot, seq, WRITING, w, h)
+            with self._done:
+                del self._pending[seq]
+                self._done.notify_all()
+            self._drop(imgfp)
+            return slot
+        return None
+
+
+    def _wait_for_slot(self):
+        """
+        Waits for a free slot, as long as there's an encoder left to free
+        one. Returns None if there isn't.
+        """
+        while True:
+            try:
+                return self._free.get(timeout=CHECK_SECS)
+            except queue.Empty:
+                with self._done:
+                    if not self._reap():
+                        return None
+
+
+    def _reap(self):
+        """
+        Fails the frames that encoders which have died were working on, or
+        every frame if none are left. Call with self._done held.
+        Returns the number of encoders still alive.
+        """
+        alive = 0
+        for i, p in enumerate(self._procs):
+            if p.is_alive():
+                alive += 1
+                continue
+            if i in self._dead:
+                continue
+            self._dead.add(i)
+            log.error(f"Encoder process {i} died (exit code {p.exitcode})")
+            seq = self._busy[i]
+            if seq in self._pending:
+                self._fail(seq)
+        if not alive:
+            for seq in list(self._pending):
+                self._fail(seq)
+        return alive
+
+
+    def _fail(self, seq):
+        """
+        Gives up on frame 'seq'. Call with self._done held.
+        """
+        from .util import release
+
+        slot, imgfp, _ = self._pending.pop(seq)
+        log.error(f"Failed to save '{imgfp}': its encoder died")
+        self.failed += 1
+        release(imgfp)
+        with self._lock:
+            cur_seq, state, w, h = self.ring.header(slot)
+            # the encoder may have given the slot back just before it died
+            if cur_seq == seq and state != FREE:
+                self.ring.set_header(slot, seq, FREE, w, h)
+                self._free.put(slot)
+        self._done.notify_all()
+
+
+    def _drop(self, imgfp):
+        from .pipeline import give_back
+
+        self.dropped += 1
+        give_back(imgfp)
+
+
+    def _collect(self):
+        from . import events, retention
+        from .util import release
+
+        while True:
+            result = self._results.get()
+            if result is None:
+                return
+            seq, saved_fp, size, secs, error = result
+            with self._done:
+                entry = self._pending.pop(seq, None)
+                self._done.notify_all()
+            if entry is None:
+                continue
+            _, imgfp, event = entry
+            release(imgfp)
+            # another process may have had the name
+            imgfp = saved_fp
+            if error:
+                log.error(f"Failed to save '{imgfp}': {error}")
+                self.failed += 1
+                continue
+            self.saved += 1
+            self.encode_times.append(secs)
+            retention.added(imgfp, size)
+            if event is not None:
+                event["encode_ms"] = round(secs * 1000, 3)
+                event["bytes"] = size
+                event["path"] = str(imgfp)
+                events.record(event)
+
+
+    def flush(self):
+        """
+        Wait until everything queued so far has been written.
+        """
+        with self._done:
+            while self._pending:
+                self._done.wait(CHECK_SECS)
+                if self._pending:
+                    self._reap()
+
+
+    def close(self):
+        """
+        Write out everything still queued and stop the encoders.
+        """
+        from . import catalog
+
+        if self._closed:
+            return
+        self._closed = True
+        pending = len(self._pending)
+        if pending:
+            log.info(f"Saving {pending} queued screenshot(s) before exit")
+        for _ in self._procs:
+            self._tasks.put(None)
+        for p in self._procs:
+            p.join()
+        self._results.put(None)
+        self._collector.join()
+        with self._done:
+            for seq in list(self._pending):
+                self._fail(seq)
+        self._log_listener.stop()
+        self.ring.close()
+        # the encoders have synced what they wrote, and every event is in
+        catalog.close()
+        log.debug(f"Encoder processes closed. {self.saved} saved, "
+                  f"{self.dropped} dropped, {self.failed} failed")
@@ -1,55 +1,510 @@
-from .log import getLogger, modulename
+import os
+import threading
 
-log = getLogger(modulename())
+from .log import get_logger
+
+log = get_logger(__name__)
 log.debug("Hello from util")
 
+# Directories we've already checked and created, so every screenshot
+# doesn't have to lstat its way down the whole path and mkdir again.
+_ready_dirs = set()
+
 
-def image_fn(dt):
+def ensure_dir(img_dir):
     """
-    Takes a datetime.datetime.
-    Returns a string filename that an image taken at 'dt' should be saved as
-    based on the config options.
+    Checks 'img_dir' is a valid path and creates it, once.
+    After that it's a set lookup. If the directory goes away, forget_dir()
+    it and the next call will check and create it again.
     """
+    from pathlib import Path
+    from .validpath import is_pathname_valid
+
+    key = str(img_dir)
+    if key not in _ready_dirs:
+        assert is_pathname_valid(key), f"'{key}' is not a valid path"
+        Path(key).mkdir(parents=True, exist_ok=True)
+        _ready_dirs.add(key)
+        log.debug(f"'{key}' is ready for screenshots")
+
+
+def forget_dir(img_dir):
+    _ready_dirs.discard(str(img_dir))
+
+
+# Placeholders allowed in the filename option, and how they're padded
+# when no format spec is given
+FILENAME_FIELDS = {"strftime": "", "ms": "03d", "us": "06d", "seq": "d"}
+
+_compiled_filenames = {}
+_seq_patterns = {}
+# the last {seq} handed out, and the directories we've checked for higher
+_seq = 0
+_seq_dirs = set()
+_seq_lock = threading.Lock()
+# names allocate_fp() has handed out for images that aren't saved yet
+_reserved = set()
+_reserved_lock = threading.Lock()
+
+
+def compile_filename(fnformat, strftime):
+    """
+    Parses the filename option once.
+    Returns (function(dt, seq) -> filename, whether it uses {seq}).
+    """
+    from string import Formatter
+
+    parts = []
+    for literal, field, spec, conversion in Formatter().parse(fnformat):
+        if field is not None and field not in FILENAME_FIELDS:
+            raise ValueError(f"Unknown placeholder {{{field}}} in filename. "
+                             "Use " + ", ".join("{%s}" % x
+                                                for x in FILENAME_FIELDS))
+        parts.append((literal, field, spec or FILENAME_FIELDS.get(field)))
+
+    def render(dt, seq=0):
+        values = {"ms": dt.microsecond // 1000, "us": dt.microsecond,
+                  "seq": seq}
+        out = []
+        for literal, field, spec in parts:
+            out.append(literal)
+            if field == "strftime":
+                out.append(dt.strftime(strftime))
+            elif field:
+                out.append(format(values[field], spec))
+        return "".join(out)
+
+    uses_seq = any(field == "seq" for _, field, _ in parts)
+    return render, uses_seq
+
+
+def _filename_renderer(fnformat=None):
     from . import config
 
-    fnformat = config.data["filename"]
-    datestr = dt.strftime(config.data["strftime"])
-    imgfn = fnformat.format(strftime=datestr)
-    return imgfn
+    key = (fnformat or config.data["filename"], config.data["strftime"])
+    if key not in _compiled_filenames:
+        _compiled_filenames[key] = compile_filename(*key)
+    return _compiled_filenames[key]
+
+
+# Placeholders allowed in the subdirs option
+SUBDIR_FIELDS = {"Y": "04d", "m": "02d", "d": "02d", "H": "02d", "M": "02d"}
+
+_compiled_subdirs = {}
+
+
+def compile_subdirs(template):
+    """
+    Parses the subdirs option once, e.g. '{Y}/{m}/{d}'.
+    Returns function(dt) -> relative directory ('' for none).
+    """
+    from string import Formatter
+
+    parts = []
+    for literal, field, spec, conversion in Formatter().parse(template):
+        if field is not None and field not in SUBDIR_FIELDS:
+            raise ValueError(f"Unknown placeholder {{{field}}} in subdirs. "
+                             "Use " + ", ".join("{%s}" % x
+                                                for x in SUBDIR_FIELDS))
+        parts.append((literal.replace("\\", "/"), field,
+                      spec or SUBDIR_FIELDS.get(field)))
+    names = "".join(literal for literal, _, _ in parts).split("/")
+    assert ".." not in names and not template.startswith(("/", "\\")), \
+           "subdirs has to stay inside img_dir"
+
+    def render(dt):
+        values = {"Y": dt.year, "m": dt.month, "d": dt.day, "H": dt.hour,
+                  "M": dt.minute}
+        out = []
+        for literal, field, spec in parts:
+            out.append(literal)
+            if field:
+                out.append(format(values[field], spec))
+        return "".join(out).strip("/")
+
+    return render
+
+
+def image_dir(dt, img_dir=None, template=None):
+    """
+    Directory an image taken at 'dt' goes in: img_dir, or the subdirectory
+    of it picked by the subdirs option. Created (once) if need be.
+    """
+    from pathlib import Path
+    from . import config
+
+    if img_dir is None:
+        img_dir = config.data["img_dir"]
+    if template is None:
+        template = config.data["subdirs"]
+    img_dir = Path(img_dir)
+    if template:
+        if template not in _compiled_subdirs:
+            _compiled_subdirs[template] = compile_subdirs(template)
+        img_dir = img_dir / _compiled_subdirs[template](dt)
+    ensure_dir(img_dir)
+    return img_dir
+
+
+def _seq_pattern(fnformat=None):
+    """
+    Regex matching the start of a filename from 'fnformat' (or the
+    filename option), up to and including {seq}, which is group 1.
+    None if it doesn't use {seq}.
+    """
+    import re
+    from string import Formatter
+    from . import config
+
+    fnformat = fnformat or config.data["filename"]
+    if fnformat not in _seq_patterns:
+        regex = []
+        pattern = None
+        for literal, field, _, _ in Formatter().parse(fnformat):
+            regex.append(re.escape(literal))
+            if field == "seq":
+                pattern = re.compile("".join(regex) + r"(\d+)")
+                break
+            if field == "strftime":
+                regex.append(".*?")
+            elif field:
+                regex.append(r"\d+")
+        _seq_patterns[fnformat] = pattern
+    return _seq_patterns[fnformat]
+
+
+def seen_seqs(directory, fnformat=None):
+    """
+    Makes sure {seq} carries on from the highest one already used in
+    'directory', the first time we save there. Files from an earlier run
+    (or another screenshotto) are counted, so every run doesn't probe its
+    way up from 1.
+    """
+    global _seq
+    key = (str(directory), fnformat)
+    if key in _seq_dirs:
+        return
+    pattern = _seq_pattern(fnformat)
+    highest = 0
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        names = []
+    for name in names:
+        match = pattern.match(name) if pattern else None
+        if match:
+            highest = max(highest, int(match.group(1)))
+    with _seq_lock:
+        _seq_dirs.add(key)
+        _seq = max(_seq, highest)
+
+
+def next_seq():
+    """
+    Next number for the {seq} placeholder. Counts up for as long as the
+    process runs, from past the highest seen_seqs() found.
+    """
+    global _seq
+    with _seq_lock:
+        _seq += 1
+        return _seq
+
+
+def capture_seq(dt):
+    """
+    The {seq} for every file of a capture taken around 'dt': each monitor
+    and region, and each extra output.
+    """
+    _, uses_seq = _filename_renderer()
+    if not uses_seq:
+        return None
+    seen_seqs(image_dir(dt))
+    return next_seq()
+
+
+def image_fn(dt, seq=0, fnformat=None):
+    """
+    Takes a datetime.datetime.
+    Returns a string filename that an image taken at 'dt' should be saved as
+    based on the config options (or 'fnformat' instead of 'filename').
+    """
+    render, _ = _filename_renderer(fnformat)
+    return render(dt, seq)
 
 
-def image_fp(dt):
+def image_fp(dt, seq=0, output=None):
     """
     Takes a datetime.datetime.
     Returns a pathlib.Path that an image taken at 'dt' should be saved to
-    based on the config options. Includes filename.
+    based on the config options, or those of one of the extra outputs.
+    Includes filename.
+    """
+    if output is None:
+        return image_dir(dt) / image_fn(dt, seq)
+    return (image_dir(dt, output["dir"] or None)
+            / image_fn(dt, seq, output["filename"]))
+
+
+def reserve(imgfp):
+    """
+    Claims the name 'imgfp' for an image that's on its way, unless there's
+    a file there already or it's claimed.
+    Returns True if it's ours now. Two captures in this process can't
+    both get the same name.
+    Nothing is written until the image is complete, so this is only
+    remembered in memory. Another process can still take the name first,
+    in which case the image gets the next free one when it's saved (see
+    move_free()). release() it once it's saved or dropped.
+    """
+    key = str(imgfp)
+    with _reserved_lock:
+        if key in _reserved or os.path.lexists(key):
+            return False
+        _reserved.add(key)
+        return True
+
+
+def release(imgfp):
+    with _reserved_lock:
+        _reserved.discard(str(imgfp))
+
+
+def move_free(src, fp):
+    """
+    Renames 'src' to 'fp', or if that's taken to the first free one of
+    'fp (2)', 'fp (3)'... Never replaces a file, even one that was only
+    created a moment ago by another process.
+    Returns where it ended up.
     """
     from pathlib import Path
-    from . import config
 
-    imgfn = image_fn(dt)
-    img_dir = Path(config.data["img_dir"])
-    img_dir.mkdir(parents=True, exist_ok=True)
-    imgfp = img_dir / imgfn
-    return imgfp
+    fp = Path(fp)
+    target = fp
+    n = 1
+    while True:
+        try:
+            _rename_new(src, target)
+            return target
+        except FileExistsError:
+            n += 1
+            target = fp.with_name(f"{fp.stem} ({n}){fp.suffix}")
 
 
-def save_screenshot():
+def _rename_new(src, dest):
+    # rename() won't replace a file on windows. Elsewhere it would, but
+    # a hard link won't, and then the old name can go.
+    if os.name == "nt":
+        os.rename(src, dest)
+        return
+    try:
+        os.link(src, dest)
+    except (FileExistsError, FileNotFoundError):
+        raise
+    except OSError:
+        # a filesystem without hard links
+        if os.path.lexists(dest):
+            raise FileExistsError(dest)
+        os.rename(src, dest)
+        return
+    os.remove(src)
+
+
+def allocate_fp(dt, fp_func=None, fnformat=None, seq=None):
     """
-    Captures a screenshot of the entire screen (all monitors)
-    and saves it.
-    Output directory and filename are based on config options.
+    Works out where an image taken at 'dt' should go, and reserve()s that
+    path.
+    {seq} is 'seq', the capture's from capture_seq(), if given. If the
+    name is taken, the next {seq} is tried, or if the filename has no
+    {seq}, ' (2)', ' (3)', ... is added.
+    'fp_func(dt, seq)' can be given instead of image_fp, and 'fnformat' if
+    it doesn't use the filename option.
     """
-    from datetime import datetime
     from .validpath import is_pathname_valid
-    from desktopmagic.screengrab_win32 import getScreenAsImage
 
-    img = getScreenAsImage()
-    imgfp = image_fp(datetime.now())
-    assert is_pathname_valid(str(imgfp)), \
+    fp_func = fp_func or image_fp
+    _, uses_seq = _filename_renderer(fnformat)
+    if uses_seq:
+        seen_seqs(fp_func(dt, 0).parent, fnformat)
+        if seq is None:
+            seq = next_seq()
+    imgfp = fp_func(dt, seq if uses_seq else 0)
+    # the directory was checked by ensure_dir(), only the name is new
+    assert is_pathname_valid(imgfp.name), \
            "Final image filename is not a valid path."
-    img.save(imgfp)
+    n = 1
+    while not reserve(imgfp):
+        if uses_seq:
+            imgfp = fp_func(dt, next_seq())
+        else:
+            n += 1
+            base = fp_func(dt, 0)
+            imgfp = base.with_name(f"{base.stem} ({n}){base.suffix}")
+    return imgfp
+
+
+def capture_frame(rect=None):
+    """
+    Grabs a frame from the capture backend: the whole desktop, or just
+    'rect' (left, top, right, bottom).
+    Returns (PIL image, datetime it was captured, capture event).
+    """
+    from datetime import datetime
+    from time import perf_counter
+    from .capture import get_backend
+    from .events import new_event
+    from . import profiling
+
+    profiling.configure()
+    backend = get_backend()
+    t0 = perf_counter()
+    with profiling.span("capture"):
+        img = backend.grab() if rect is None else backend.grab_region(rect)
+    dt = datetime.now()
+    event = new_event(img, perf_counter() - t0, backend)
+    if rect is not None:
+        event["rect"] = list(rect)
+    return img, dt, event
+
+
+def target_fp(imgfp, label):
+    """
+    Monitors and regions get their own files, told apart by their label.
+    """
+    if not label:
+        return imgfp
+    return imgfp.with_name(f"{imgfp.stem} {label}{imgfp.suffix}")
+
+
+def write_frame(img, imgfp, event=None, profile=None):
+    """
+    Encodes 'img' and writes it to 'imgfp', with encoder 'profile' or the
+    configured one.
+    If there's a capture event, it's finished off and recorded.
+    """
+    from time import perf_counter
+    from .durable import save
+    from .profiling import span
+    from . import retention
+
+    t0 = perf_counter()
+    reserved = imgfp
+    try:
+        with span("encode"):
+            try:
+                imgfp, size = save(img, imgfp, profile)
+            except FileNotFoundError:
+                # somebody deleted the directory since we last made it
+                log.warning(f"'{imgfp.parent}' disappeared. "
+                            "Making it again.")
+                forget_dir(imgfp.parent)
+                ensure_dir(imgfp.parent)
+                imgfp, size = save(img, imgfp, profile)
+    finally:
+        release(reserved)
     log.debug(f"Screenshot saved to '{imgfp}'")
+    retention.added(imgfp, size)
+    if event is not None:
+        from . import events
+        event["encode_ms"] = round((perf_counter() - t0) * 1000, 3)
+        event["bytes"] = size
+        event["path"] = str(imgfp)
+        events.record(event)
+
+
+def save_screenshot(background=False):
+    """
+    Captures a screenshot of the entire screen (all monitors), or the
+    monitors / region picked in the config, and saves it.
+    Output directory and filename are based on config options.
+    With background=True the frame is handed to the encoder pipeline
+    and this returns as soon as it's queued.
+    Returns a list of the paths saved to: one per monitor or region, minus
+    any that were skipped because the screen hadn't changed.
+    """
+    from datetime import datetime
+    from .capture import get_backend
+    from .regions import targets
+
+    paths = []
+    # the same {seq} for every monitor / region
+    seq = capture_seq(datetime.now())
+    for label, rect in targets(get_backend()):
+        path = save_target(label, rect, background, seq)
+        if path is not None:
+            paths.append(path)
+    return paths
+
+
+def save_target(label, rect, background=False, seq=None):
+    """
+    Captures and saves one monitor or region (or the whole desktop if
+    'rect' is None), as capture number 'seq'.
+    Returns the path of the image, or None if it was skipped because the
+    screen hadn't changed.
+    """
+    from . import config, events
+    from .dedup import get_deduplicator
+    from .profiling import span
+
+    img, dt, event = capture_frame(rect)
+    if label:
+        event["target"] = label
+    session = config.data["storage"] == "session"
+    dedup = get_deduplicator(label)
+    decision = event["dedup"] = "off"
+    if dedup.enabled:
+        with span("dedup"):
+            decision = event["dedup"] = dedup.check(img)
+        if decision == "skip":
+            log.debug("Screen unchanged. Not saving.")
+            events.record(event)
+            return None
+    from .outputs import fan_out, get_outputs
+    # with extra outputs everything goes through the pipeline, so all of
+    # the encodes run at once
+    outputs = get_outputs()
+    # what the outputs' events start from, before this one's filled in
+    base_event = dict(event)
+    if session:
+        # deltas depend on the previous frame so these can't be reordered
+        # by the encoder threads.
+        # An unchanged frame is an empty delta anyway, so no linking.
+        from time import perf_counter
+        from .session import save_to_session
+        t0 = perf_counter()
+        with span("session"):
+            imgfp = save_to_session(img, dt, label)
+        event["encode_ms"] = round((perf_counter() - t0) * 1000, 3)
+        event["path"] = str(imgfp)
+        events.record(event)
+    else:
+        with span("image_fp"):
+            imgfp = allocate_fp(dt, lambda dt, seq: target_fp(image_fp(dt, seq),
+                                                             label),
+                                seq=seq)
+        if decision == "link" and dedup.link(imgfp):
+            from . import retention
+            log.debug(f"Screen unchanged. Linked '{imgfp}' "
+                      f"to '{dedup.last_fp}'")
+            # a link doesn't take up any more space
+            retention.added(imgfp, 0)
+            event["path"] = str(imgfp)
+            events.record(event)
+        else:
+            if dedup.enabled:
+                dedup.kept(imgfp)
+            if background or outputs:
+                from .pipeline import get_pipeline
+                get_pipeline().submit(img, imgfp, event)
+            else:
+                write_frame(img, imgfp, event)
+    if outputs:
+        from .pipeline import get_pipeline
+        with span("outputs"):
+            fan_out(img, dt, base_event, label, link=decision == "link",
+                    seq=seq)
+        if not background:
+            get_pipeline().flush()
     return imgfp
 
 
@@ -9,19 +9,22 @@ setup(
     description="Take screenshots",
     packages=find_packages(),
     include_package_data=True,
+    # multiprocessing.shared_memory, for the encoder processes
+    python_requires=">=3.8",
     install_requires=[
         "click>=4.1.1",
         "appdirs>=1.4.3",
         "Desktopmagic>=14.3.11",
-        "schedule>=0.5.0"
-        "arrow>=0.12.1",
+        "arrow>=1.0",
         "pywin32>=220",
-        "Pillow>=5.1.0"
+        "Pillow>=5.1.0",
+        "numpy>=1.14",
     ],
     scripts=["run_screenshotto.py"],
     entry_points={
         "console_scripts": [
             "screenshotto = run_screenshotto:cli",
+            "screenshotto_trigger = screenshotto.daemon:main",
         ],
         "gui_scripts": [
             "screenshotto_silent = run_screenshotto:cli",